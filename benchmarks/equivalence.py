@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Statistical equivalence of a candidate implementation to the reference
+
+A faster passage, sampling, or propagation path is accepted only if it gives the same distribution of outcomes as the reference.
+The harness runs one row of a mapping file over many seeds twice: once as it is (reference) and once with the candidate,
+which is a set of mapping column overrides (e.g. rng_streams=True) and/or functions patched into community_selection.
+The wells of one seed share the species pool and are not independent, so the richness, biomass, and CommunityPhenotype of each seed are first
+aggregated to their mean and standard deviation over the wells. For each transfer, the per-seed values of the reference and the candidate are then
+compared with a two-sample Kolmogorov-Smirnov test (Bonferroni-corrected over transfers, metrics and statistics). A comparison fails if the difference
+is significant, whether it is a shift of the mean or a change of the spread or shape. The KS statistic is reported as the effect size, and --max-ks
+optionally also fails comparisons whose KS statistic exceeds an equivalence bound. Per-seed values that differ only by rounding (less than --resolution
+relative to the mean absolute value of the metric) are not tested, since KS would see any consistent rounding difference as a shift. With few seeds
+the test has little power, so use at least 20.
+Candidates that keep the random draws of each seed (e.g. precision=float32) can also be held to a tolerance with --rtol: the wells of the same seed must then agree within that difference, relative to the mean absolute value of the metric.
+
+The harness can be called from a test with check_equivalence(), which returns the report; all(report.Pass) is the verdict.
+From the command line it exits with 1 if any comparison fails.
+
+Usage:
+    python benchmarks/equivalence.py --seeds 20 --candidate-set sparse_density=1
+    python benchmarks/equivalence.py --seeds 20 --candidate-set precision=float32 --rtol 1e-4
+    python benchmarks/equivalence.py mapping_file.csv 0 --candidate-patch community_selection.A_experiment_functions.sample_from_pool=my_module:fast_sample_from_pool
+"""
+import os
+import sys
+import argparse
+import tempfile
+import importlib
+import contextlib
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+# Metrics of the function output that are compared
+equivalence_metrics = ["Richness", "Biomass", "CommunityPhenotype"]
+
+# Statistics of the wells of one seed that are compared across seeds
+seed_statistics = ["mean", "std"]
+
+def resolve_object(path):
+    """
+    Import an object from "package.module:name" or "package.module.name" (the longest importable module prefix is used)
+    """
+    if ":" in path:
+        module_name, name = path.split(":")
+        obj = importlib.import_module(module_name)
+        for x in name.split("."):
+            obj = getattr(obj, x)
+        return obj
+    parts = path.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        try:
+            obj = importlib.import_module(".".join(parts[:i]))
+        except ImportError:
+            continue
+        for x in parts[i:]:
+            obj = getattr(obj, x)
+        return obj
+    raise ImportError("Cannot import " + path)
+
+@contextlib.contextmanager
+def patched(patches):
+    """
+    Replace functions or methods while the context is open
+
+    patches = dictionary of target path ("community_selection.A_experiment_functions.sample_from_pool" or "community_selection.Metacommunity.Passage") to the replacement object or its path.
+              A module-level function is also replaced in the community_selection modules that star-imported it
+    """
+    replaced = list()
+    try:
+        for target, replacement in patches.items():
+            if isinstance(replacement, str):
+                replacement = resolve_object(replacement)
+            owner_path, name = target.rsplit(".", 1)
+            owner = resolve_object(owner_path)
+            original = getattr(owner, name)
+            owners = [owner]
+            if isinstance(owner, type(sys)):
+                owners += [m for k, m in list(sys.modules.items()) if k.startswith("community_selection") and m is not owner and getattr(m, name, None) is original]
+            for x in owners:
+                replaced.append((x, name, getattr(x, name)))
+                setattr(x, name, replacement)
+        yield
+    finally:
+        for x, name, original in reversed(replaced):
+            setattr(x, name, original)
+
+def run_seeds(mapping_file, row, seeds, output_dir, overrides = None, patches = None, label = "reference"):
+    """
+    Run one row of the mapping file for each seed. Return the function outputs of all seeds in one data.frame
+
+    overrides = dictionary of mapping columns to values that replace the cells of the row
+    patches = see patched()
+    """
+    from community_selection.usertools import make_assumptions, prepare_experiment, simulate_community
+    import io
+    mapping = pd.read_csv(mapping_file, keep_default_na = False, dtype = str).iloc[[row]].reset_index(drop = True)
+    for k, v in (overrides or dict()).items():
+        mapping[k] = str(v)
+
+    df_list = list()
+    with patched(patches or dict()):
+        for seed in seeds:
+            mapping["seed"] = str(seed)
+            mapping["exp_id"] = label + "-" + str(seed)
+            mapping["output_dir"] = output_dir
+            for k, v in {"save_function": "True", "function_lograte": "1", "save_composition": "False", "save_plate": "False"}.items():
+                mapping[k] = v
+            with contextlib.redirect_stdout(io.StringIO()):
+                assumptions = make_assumptions(mapping, 0)
+                params, params_simulation, params_algorithm, plate = prepare_experiment(assumptions)
+                simulate_community(params, params_simulation, params_algorithm, plate)
+            df = pd.read_csv(os.path.join(output_dir, assumptions["exp_id"] + "_function.txt"))
+            df["seed"] = seed
+            df_list.append(df)
+    return pd.concat(df_list, ignore_index = True)
+
+def aggregate_seeds(df):
+    """
+    Aggregate the metrics over the wells of each seed and transfer
+
+    Return: data.frame with one row per seed and transfer, and one column <metric>_<statistic> for each metric and seed_statistics. The standard deviation of a single well is 0
+    """
+    df_seed = df.groupby(["seed", "Transfer"])[equivalence_metrics].agg(seed_statistics).fillna(0)
+    df_seed.columns = [metric + "_" + statistic for metric, statistic in df_seed.columns]
+    return df_seed.reset_index()
+
+def max_relative_difference(x, y):
+    """
+    Largest difference of paired values of y to x, relative to the mean absolute value of x. Values of x close to zero (e.g. the function of a dying community) do not inflate it
+    """
+    x, y = np.asarray(x, dtype = float), np.asarray(y, dtype = float)
+    difference = np.max(np.abs(y - x), initial = 0)
+    return 0.0 if difference == 0 else float(difference / np.mean(np.abs(x)))
+
+def compare_outputs(df_reference, df_candidate, alpha = 0.01, max_ks = None, rtol = None, resolution = 1e-6):
+    """
+    Compare the distributions over seeds of the per-seed statistics of the metrics in each transfer (see aggregate_seeds)
+
+    alpha = family-wise significance level of the Kolmogorov-Smirnov tests. A significant difference fails the comparison
+    max_ks = largest KS statistic accepted, as an equivalence bound on the effect size. None to fail on significance only
+    rtol = largest difference accepted between the wells of the same seed, relative to the mean absolute value of the metric (see max_relative_difference). None to compare the distributions only
+    resolution = per-seed values closer than this, relative to the mean absolute value of the metric in the transfer, are the same
+
+    Return: the report data.frame with one row per transfer, metric and statistic
+    """
+    from scipy.stats import ks_2samp
+    df_reference_seed, df_candidate_seed = aggregate_seeds(df_reference), aggregate_seeds(df_candidate)
+    transfers = sorted(set(df_reference.Transfer) & set(df_candidate.Transfer))
+    n_tests = len(transfers) * len(equivalence_metrics) * len(seed_statistics)
+    records = list()
+    if rtol is not None:
+        df_paired = df_reference.merge(df_candidate, on = ["seed", "Transfer", "Well"], suffixes = ("", "Candidate"))
+    for transfer in transfers:
+        for metric in equivalence_metrics:
+            atol = resolution * np.mean(np.abs(df_reference.loc[df_reference.Transfer == transfer, metric].values))
+            for statistic_name in seed_statistics:
+                column = metric + "_" + statistic_name
+                x = df_reference_seed.loc[df_reference_seed.Transfer == transfer, column].values
+                y = df_candidate_seed.loc[df_candidate_seed.Transfer == transfer, column].values
+                if np.allclose(np.sort(x), np.sort(y), rtol = 0, atol = atol):
+                    statistic, p_value = 0.0, 1.0
+                else:
+                    statistic, p_value = ks_2samp(x, y)
+                record = {"Transfer": transfer, "Metric": metric, "Statistic": statistic_name, "ReferenceMean": np.mean(x), "CandidateMean": np.mean(y),
+                          "KS": statistic, "PValue": p_value,
+                          "Pass": bool(p_value >= alpha / n_tests and (max_ks is None or statistic <= max_ks))}
+                if rtol is not None:
+                    paired = df_paired[df_paired.Transfer == transfer]
+                    record["MaxRelativeDifference"] = max_relative_difference(paired[metric], paired[metric + "Candidate"])
+                    record["Pass"] = record["Pass"] and record["MaxRelativeDifference"] <= rtol
+                records.append(record)
+    return pd.DataFrame(records)
+
+def check_equivalence(mapping_file, row, seeds, candidate_overrides = None, candidate_patches = None, reference_overrides = None, alpha = 0.01, max_ks = None, rtol = None, resolution = 1e-6):
+    """
+    Run the reference and the candidate over the seeds and compare their outcomes. Return the report of compare_outputs()
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        df_reference = run_seeds(mapping_file, row, seeds, output_dir + "/", overrides = reference_overrides, label = "reference")
+        df_candidate = run_seeds(mapping_file, row, seeds, output_dir + "/", overrides = dict(reference_overrides or dict(), **(candidate_overrides or dict())), patches = candidate_patches, label = "candidate")
+    return compare_outputs(df_reference, df_candidate, alpha = alpha, max_ks = max_ks, rtol = rtol, resolution = resolution)
+
+def parse_pairs(pairs):
+    return dict(x.split("=", 1) for x in pairs)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Statistical equivalence of a candidate implementation to the reference")
+    parser.add_argument("mapping_file", nargs = "?", default = None, help = "Mapping file. By default the baseline row of benchmarks/simulation.py")
+    parser.add_argument("row", nargs = "?", type = int, default = 0, help = "Row of the mapping file")
+    parser.add_argument("--seeds", type = int, default = 20, help = "Number of seeds, starting from 1")
+    parser.add_argument("--reference-set", nargs = "*", default = [], metavar = "COLUMN=VALUE", help = "Mapping columns replaced in both runs")
+    parser.add_argument("--candidate-set", nargs = "*", default = [], metavar = "COLUMN=VALUE", help = "Mapping columns replaced in the candidate run")
+    parser.add_argument("--candidate-patch", nargs = "*", default = [], metavar = "TARGET=REPLACEMENT", help = "Functions replaced in the candidate run, e.g. community_selection.Metacommunity.Passage=my_module:fast_passage")
+    parser.add_argument("--alpha", type = float, default = 0.01, help = "Family-wise significance level")
+    parser.add_argument("--max-ks", type = float, default = None, help = "Largest KS statistic accepted, as an equivalence bound. By default only significant differences fail")
+    parser.add_argument("--rtol", type = float, default = None, help = "Largest relative difference accepted between the wells of the same seed, for candidates that keep the random draws")
+    parser.add_argument("--resolution", type = float, default = 1e-6, help = "Per-seed values closer than this, relative to the mean absolute value of the metric, are the same")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as mapping_dir:
+        mapping_file = args.mapping_file
+        if mapping_file is None:
+            from simulation import make_scenarios, write_mapping_file
+            mapping_file = write_mapping_file(make_scenarios()[:1], mapping_dir + "/")
+        report = check_equivalence(mapping_file, args.row, range(1, args.seeds + 1),
+                                   candidate_overrides = parse_pairs(args.candidate_set), candidate_patches = parse_pairs(args.candidate_patch),
+                                   reference_overrides = parse_pairs(args.reference_set), alpha = args.alpha, max_ks = args.max_ks, rtol = args.rtol, resolution = args.resolution)
+
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(report)
+    n_failed = int(np.sum(~report.Pass))
+    print("PASS" if n_failed == 0 else "FAIL: %d of %d comparisons" % (n_failed, len(report)))
+    sys.exit(1 if n_failed > 0 else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import-time benchmark of the simulation entry point
+
+Each repeat imports community_selection.usertools in a fresh interpreter and measures the wall time.
+The benchmark fails if the median time exceeds --max-seconds or if a plotting module is loaded by the import.
+
+Usage:
+    python benchmarks/import_time.py --repeat 5 --max-seconds 3
+"""
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# Modules that simulation-only entry points should not load
+lazy_modules = ["matplotlib", "seaborn", "dill"]
+
+def measure_import(module = "community_selection.usertools"):
+    """
+    Import the module in a fresh interpreter. Return the wall time and the top-level names of the loaded modules
+    """
+    code = ("import sys, time, json; t = time.perf_counter(); import " + module + "; t = time.perf_counter() - t; "
+            "print(json.dumps({'seconds': t, 'modules': sorted(set(m.split('.')[0] for m in sys.modules))}))")
+    output = subprocess.run([sys.executable, "-c", code], check = True, stdout = subprocess.PIPE, universal_newlines = True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description = "Import-time benchmark of community_selection.usertools")
+    parser.add_argument("--repeat", type = int, default = 5, help = "Number of fresh interpreters")
+    parser.add_argument("--max-seconds", type = float, default = 3.0, help = "Fail if the median import time exceeds this")
+    args = parser.parse_args()
+    
+    results = [measure_import() for i in range(args.repeat)]
+    seconds = np.median([x["seconds"] for x in results])
+    loaded_lazy_modules = [m for m in lazy_modules if m in results[0]["modules"]]
+    print("Median import time of community_selection.usertools: %.3f s" % seconds)
+    
+    failed = False
+    if seconds > args.max_seconds:
+        print("FAIL: import time exceeds %.3f s" % args.max_seconds)
+        failed = True
+    if len(loaded_lazy_modules) > 0:
+        print("FAIL: the import loads " + ", ".join(loaded_lazy_modules))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
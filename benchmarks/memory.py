@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy benchmark of estimate_peak_memory() on the rows of the simulation benchmark
+
+Each scenario of benchmarks/simulation.py is run in a fresh interpreter, and its peak resident set size is compared with the estimate of its assumptions.
+The benchmark fails if the ratio of the estimate to the measured peak of any scenario is outside [--min-ratio, --max-ratio].
+
+Usage:
+    python benchmarks/memory.py --quick
+    python benchmarks/memory.py --axis n_wells species --min-ratio 1 --max-ratio 1.5
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo_dir, "benchmarks"))
+from simulation import scale_axes, make_scenarios, write_mapping_file
+
+def run_row(mapping_file, row):
+    """
+    Run one row and print its estimated and measured peak memory (bytes) as json. Called in a fresh interpreter by measure_peak_memory()
+    """
+    import io
+    import resource
+    import contextlib
+    from community_selection.usertools import make_assumptions, prepare_experiment, simulate_community
+    from community_selection.A_experiment_functions import estimate_peak_memory
+    assumptions = make_assumptions(mapping_file, row)
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulate_community(*prepare_experiment(assumptions))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"estimate": int(estimate_peak_memory(assumptions)["total"]), "peak": peak if sys.platform == "darwin" else peak * 1024})) # kilobytes on linux
+
+def measure_peak_memory(mapping_file, row):
+    """
+    Run one row in a fresh interpreter. Return the estimated and the measured peak memory (bytes)
+    """
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-row", mapping_file, str(row)], check = True, stdout = subprocess.PIPE, universal_newlines = True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare estimate_peak_memory() with the measured peak resident memory")
+    parser.add_argument("--quick", action = "store_true", help = "Keep only the two smallest values of each scale axis")
+    parser.add_argument("--axis", nargs = "*", default = None, choices = list(scale_axes.keys()), help = "Only run the scenarios of these axes")
+    parser.add_argument("--min-ratio", type = float, default = 1.0, help = "Fail if the estimate is below this fraction of the measured peak")
+    parser.add_argument("--max-ratio", type = float, default = 1.5, help = "Fail if the estimate is above this multiple of the measured peak")
+    parser.add_argument("--run-row", nargs = 2, default = None, metavar = ("MAPPING_FILE", "ROW"), help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_row is not None:
+        run_row(args.run_row[0], int(args.run_row[1]))
+        return
+
+    scenarios = make_scenarios(args.quick)
+    if args.axis is not None:
+        scenarios = [x for x in scenarios if x[0] in ["baseline"] + args.axis]
+
+    records = list()
+    with tempfile.TemporaryDirectory() as output_dir:
+        mapping_file = write_mapping_file(scenarios, output_dir + "/")
+        for i, (axis, name, row) in enumerate(scenarios):
+            memory = measure_peak_memory(mapping_file, i)
+            records.append({"scenario": name, "EstimateMB": memory["estimate"] / 2**20, "PeakMB": memory["peak"] / 2**20, "Ratio": memory["estimate"] / memory["peak"]})
+            print("%s: estimate %.0f MB, peak %.0f MB, ratio %.2f" % (name, records[-1]["EstimateMB"], records[-1]["PeakMB"], records[-1]["Ratio"]))
+
+    df = pd.DataFrame(records)
+    print("Ratio of the estimate to the measured peak: %.2f to %.2f" % (df.Ratio.min(), df.Ratio.max()))
+    failed = df[(df.Ratio < args.min_ratio) | (df.Ratio > args.max_ratio)]
+    for name in failed.scenario:
+        print("FAIL: the estimate of " + name + " is outside %.2f to %.2f times the measured peak" % (args.min_ratio, args.max_ratio))
+    sys.exit(1 if len(failed) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
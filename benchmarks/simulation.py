@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Simulation benchmark on synthetic mapping files
+
+Each scenario changes one scale axis (n_wells, sn/sf, rn/rf, n_propagation, n_transfer, the community phenotype, or the sparse plate format) of a small baseline row.
+The rows are written to a synthetic mapping file in a temporary directory, so the benchmark runs offline and writes nothing else.
+For each scenario, prepare_experiment() and simulate_community() are timed, and so are the hot functions Passage, f2_interaction, sample_from_pool, resource_perturb, and overwrite_plate.
+
+The timings are appended to a csv file together with the git commit, so that regressions across commits are visible with --compare.
+
+Usage:
+    python benchmarks/simulation.py --quick
+    python benchmarks/simulation.py --repeat 5 --results benchmarks/results/simulation.csv
+    python benchmarks/simulation.py --compare
+"""
+import os
+import sys
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+# Baseline row. Small enough that the full sweep runs in minutes on a laptop
+baseline_row = {"selected_function": "f1_additive", "protocol": "simple_screening", "seed": 1,
+                "n_wells": 24, "sn": 100, "sf": 1, "Sgen": 0, "rn": 20, "rf": 1,
+                "n_propagation": 1, "n_transfer": 4, "n_transfer_selection": 2,
+                "n_inoc": 1000000, "scale": 1000000, "dilution": 0.001, "function_lograte": 1, "composition_lograte": 1,
+                "save_function": True, "save_composition": True, "save_plate": False,
+                "sampling_D": "default", "fss": 0, "fsa": 0, "fsw": 0, "fas": 0, "faa": 0, "faw": 0, "fws": 0, "fwa": 0, "fww": 0}
+
+# Scale axes. Each scenario changes one axis of the baseline row; --quick keeps the first two values of each axis
+scale_axes = {
+    "n_wells": [{"n_wells": 24}, {"n_wells": 96}, {"n_wells": 384}],
+    "species": [{"sn": 100, "sf": 1}, {"sn": 500, "sf": 1}, {"sn": 500, "sf": 4}],
+    "resources": [{"rn": 20, "rf": 1}, {"rn": 90, "rf": 1}, {"rn": 30, "rf": 3}],
+    "n_propagation": [{"n_propagation": 1}, {"n_propagation": 4}],
+    "n_transfer": [{"n_transfer": 4, "n_transfer_selection": 2}, {"n_transfer": 16, "n_transfer_selection": 8}],
+    "phenotype": [{"selected_function": "f1_additive"}, {"selected_function": "f2_interaction"}, {"selected_function": "f6_target_resource"}],
+    "sparse": [{"sparse_density": 1}, {"sn": 2000, "sparse_density": 0}, {"sn": 2000, "sparse_density": 1}],
+}
+
+def make_scenarios(quick = False):
+    """
+    List the scenarios as (axis, name, row). The baseline appears once
+    """
+    scenarios = [("baseline", "baseline", dict(baseline_row))]
+    for axis, values in scale_axes.items():
+        for value in values[:2] if quick else values:
+            row = dict(baseline_row)
+            row.update(value)
+            if row == baseline_row:
+                continue
+            scenarios.append((axis, ",".join("%s=%s" % (k, v) for k, v in value.items()), row))
+    return scenarios
+
+def write_mapping_file(scenarios, output_dir):
+    """
+    Write the synthetic mapping file. Columns not in the rows are taken from the first row of docs/source/data/input_test.csv
+    """
+    template = pd.read_csv(os.path.join(repo_dir, "docs", "source", "data", "input_test.csv"), keep_default_na = False, dtype = str).iloc[[0]]
+    rows = list()
+    for i, (axis, name, row) in enumerate(scenarios):
+        mapping_row = template.copy()
+        for k, v in row.items():
+            mapping_row[k] = str(v)
+        mapping_row["exp_id"] = "benchmark-" + str(i)
+        mapping_row["output_dir"] = output_dir
+        rows.append(mapping_row)
+    mapping_file = os.path.join(output_dir, "benchmark_mapping.csv")
+    pd.concat(rows).fillna("NA").to_csv(mapping_file, index = False) # Columns set by only some scenarios are NA in the others
+    return mapping_file
+
+def best_time(function, repeat):
+    """
+    Minimum wall time of repeated calls. The setup of each call is not timed
+    """
+    times = list()
+    for r in range(repeat):
+        args = function()
+        start_time = time.perf_counter()
+        args()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+def benchmark_scenario(mapping_file, row, repeat, output_dir):
+    """
+    Time prepare_experiment, simulate_community, and the hot functions of one row. Return a dictionary of seconds
+    """
+    from community_selection.A_experiment_functions import fork_plate, sample_from_pool, overwrite_plate, save_plate_snapshot
+    from community_selection.B_community_phenotypes import f2_interaction
+    from community_selection.D_perturbation_algorithms import resource_perturb
+    from community_selection.usertools import make_assumptions, prepare_experiment, simulate_community
+    import io
+    import contextlib
+
+    seconds = dict()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Whole experiment
+        prepared = list()
+        def time_prepare():
+            def run():
+                prepared[:] = [prepare_experiment(make_assumptions(mapping_file, row))]
+            return run
+        seconds["prepare_experiment"] = best_time(time_prepare, repeat)
+        params, params_simulation, params_algorithm, plate = prepared[0]
+
+        def time_simulate():
+            experiment = prepare_experiment(make_assumptions(mapping_file, row))
+            return lambda: simulate_community(*experiment)
+        seconds["simulate_community"] = best_time(time_simulate, repeat)
+
+        # Hot functions on a copy of the initial plate
+        assumptions = make_assumptions(mapping_file, row)
+        n_wells = plate.N.shape[1]
+        seconds["Passage"] = best_time(lambda: (lambda p: lambda: p.Passage(np.eye(n_wells) * assumptions["dilution"]))(fork_plate(plate)), repeat)
+        seconds["f2_interaction"] = best_time(lambda: lambda: f2_interaction(plate, params_simulation), repeat)
+        seconds["sample_from_pool"] = best_time(lambda: lambda: sample_from_pool(plate.N, assumptions), repeat)
+        params_perturb = dict(params_simulation, r_type = "default", r_percent = 0.1)
+        seconds["resource_perturb"] = best_time(lambda: (lambda p: lambda: resource_perturb(p, params_perturb, keep = 0))(fork_plate(plate)), repeat)
+        snapshot_file = os.path.join(output_dir, "benchmark_snapshot.npz")
+        save_plate_snapshot(plate, snapshot_file)
+        assumptions_overwrite = dict(assumptions, overwrite_plate = snapshot_file, passage_overwrite_plate = False)
+        seconds["overwrite_plate"] = best_time(lambda: (lambda p: lambda: overwrite_plate(p, assumptions_overwrite))(fork_plate(plate)), repeat)
+    return seconds
+
+def git_commit():
+    """
+    Short hash of the checked out commit, with a + if the tree has uncommitted changes
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = repo_dir, check = True, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines = True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd = repo_dir, check = True, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines = True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare_results(results_file, n_commits = 2):
+    """
+    Print the timings of the latest commits side by side, with the ratio of the latest to the previous commit
+    """
+    df = pd.read_csv(results_file)
+    df = df[df.machine == machine_name()]
+    commits = list(pd.unique(df.commit))[-n_commits:]
+    df = df[df.commit.isin(commits)]
+    table = df.groupby(["scenario", "benchmark", "commit"], sort = False)["seconds"].min().unstack("commit")[commits]
+    if len(commits) > 1:
+        table["ratio"] = table[commits[-1]] / table[commits[-2]]
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(table)
+
+def machine_name():
+    return "%s-%s-%dcpu" % (platform.system(), platform.machine(), os.cpu_count())
+
+def main():
+    parser = argparse.ArgumentParser(description = "Simulation benchmark on synthetic mapping files")
+    parser.add_argument("--quick", action = "store_true", help = "Keep only the two smallest values of each scale axis")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Number of timed calls; the minimum is recorded")
+    parser.add_argument("--axis", nargs = "*", default = None, choices = list(scale_axes.keys()), help = "Only run the scenarios of these axes")
+    parser.add_argument("--results", default = os.path.join(repo_dir, "benchmarks", "results", "simulation.csv"), help = "csv file the timings are appended to")
+    parser.add_argument("--compare", action = "store_true", help = "Print the timings of the last two commits in the results file and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(args.results)
+        return
+
+    scenarios = make_scenarios(args.quick)
+    if args.axis is not None:
+        scenarios = [x for x in scenarios if x[0] in ["baseline"] + args.axis]
+
+    commit = git_commit()
+    records = list()
+    with tempfile.TemporaryDirectory() as output_dir:
+        mapping_file = write_mapping_file(scenarios, output_dir + "/")
+        for i, (axis, name, row) in enumerate(scenarios):
+            seconds = benchmark_scenario(mapping_file, i, args.repeat, output_dir)
+            print(name + ": " + ", ".join("%s %.4f s" % (k, v) for k, v in seconds.items()))
+            for benchmark, value in seconds.items():
+                records.append({"commit": commit, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": machine_name(), "axis": axis, "scenario": name, "benchmark": benchmark, "seconds": value})
+
+    # Append to the results
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok = True)
+    pd.DataFrame(records).to_csv(args.results, mode = "a", index = False, header = not os.path.isfile(args.results))
+    print("Timings of commit " + commit + " appended to " + args.results)
+
+if __name__ == "__main__":
+    main()
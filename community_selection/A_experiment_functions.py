@@ -3,13 +3,137 @@
 Created on Nov 26 2019
 @author: changyuchang
 """
+import time
 import numpy as np
+import pandas as pd
 from community_simulator import *
 from community_simulator.usertools import *
 import community_simulator.usertools
-from community_selection.__init__ import *
+from community_selection import Metacommunity, get_rng, cast_state, is_sparse_frame, sparse_matrix, dense_frame, format_state
 from community_selection.B_community_phenotypes import *
 
+# Optional parameters that older mapping files may not have, and their default values
+a_optional = {
+    "composition_format": "csv", # Format of the composition output file. "csv" or "parquet"
+    "save_trajectory": False, # Save the species abundances in a sparse trajectory file
+    "checkpoint_interval": 0, # Save a checkpoint every checkpoint_interval transfers. 0 for no checkpoint
+    "stock_dir": np.nan, # Directory of the frozen stock library used by save_plate. NA for a pickle file
+    "profile": "none", # Record the wall time of each stage of each transfer. "none", "time", or "allocations" (also trace the allocated memory, the resident memory, and the top allocation sites)
+    "output_queue_size": 0, # Number of logged transfers that can wait to be written by a background thread. 0 to write the outputs in the simulation thread
+    "event_log": np.nan, # File the progress events are appended to as json lines. NA for no event log
+    "species_pool_dir": np.nan, # Directory of species pools shared by the experiments on one node. NA for no shared pool
+    "sparse_density": 0, # Largest fraction of non-zero species abundances at which the plate keeps N in a sparse column format. 0 for a dense plate
+    "precision": "float64", # Floating point precision of the species parameters, the plate, and the outputs. "float64" or "float32" (the dynamics are still integrated in double precision)
+    "rng_streams": False # Draw the sampling, passage, selection, perturbation, and function noise from per-experiment numpy Generators instead of the global random state
+}
+
+# Levels of the progress events
+event_levels = {"debug": 10, "info": 20, "warning": 30}
+
+def print_event(event):
+    """
+    Sink that prints the message of a progress event
+    """
+    if event["message"] != "":
+        print(event["message"])
+
+# Sinks that receive the progress events, and the lowest level sent to them
+event_settings = {"level": "info", "sinks": [print_event]}
+
+class JsonLinesSink:
+    """
+    Sink that appends each progress event to a file as one line of json
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "a")
+    
+    def __call__(self, event):
+        import json
+        self.file.write(json.dumps(event, default = lambda x: x.item() if hasattr(x, "item") else str(x)) + "\n")
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+def add_event_sink(sink):
+    """
+    Send the progress events to sink, a callable that takes the event dictionary. Return the sink
+    """
+    event_settings["sinks"].append(sink)
+    return sink
+
+def remove_event_sink(sink):
+    event_settings["sinks"].remove(sink)
+
+def set_event_level(level):
+    """
+    Only send the events of this level or above to the sinks. "debug", "info", or "warning"
+    """
+    assert level in event_levels.keys(), "level must be one of " + ", ".join(event_levels.keys())
+    event_settings["level"] = level
+
+def emit_event(event, message = "", level = "info", **fields):
+    """
+    Send a progress event to the sinks
+    
+    event = name of the event, e.g. "transfer"
+    message = text printed by print_event()
+    level = "debug", "info", or "warning"
+    fields = data of the event, e.g. exp_id, transfer, seconds, eta
+    """
+    if event_levels[level] < event_levels[event_settings["level"]]:
+        return
+    record = dict(time = time.time(), level = level, event = event, message = message, **fields)
+    for sink in list(event_settings["sinks"]):
+        sink(record)
+
+def open_event_logs(assumptions_list):
+    """
+    Context manager that appends the progress events to the event_log of each experiment while it is open
+    """
+    import contextlib
+    @contextlib.contextmanager
+    def event_logs():
+        sinks = [add_event_sink(JsonLinesSink(filename)) for filename in set(assumptions["event_log"] for assumptions in assumptions_list if not pd.isnull(assumptions["event_log"]))]
+        try:
+            yield
+        finally:
+            for sink in sinks:
+                remove_event_sink(sink)
+                sink.close()
+    return event_logs()
+
+# Random streams of one experiment. Passage has one more stream per well
+rng_stream_names = ["sampling", "selection", "perturbation", "function"]
+
+def add_optional_assumptions(assumptions):
+    """
+    Fill in the optional parameters that are absent or NA with their default values
+    
+    The parquet composition format needs pyarrow, which is an optional dependency (pip install ecoprospector[parquet]). It is checked here rather than at the first write
+    """
+    import importlib.util
+    for k in a_optional.keys():
+        if k not in assumptions.keys() or pd.isnull(assumptions[k]):
+            assumptions[k] = a_optional[k]
+    assert assumptions["composition_format"] in ["csv", "parquet"], "composition_format must be csv or parquet"
+    if assumptions["composition_format"] == "parquet":
+        assert importlib.util.find_spec("pyarrow") is not None, "composition_format = parquet requires pyarrow. Install it with pip install pyarrow, or install ecoprospector with the parquet extra (pip install -e .[parquet])"
+    return assumptions
+
+def make_rng_streams(seed, n_wells):
+    """
+    Make the independent random streams of one experiment
+    
+    Each stream is a numpy Generator spawned from the seed of the experiment, so the draws of one subsystem or well do not depend on the others, or on the global random state
+    
+    Return: dictionary of Generators, with a list of one Generator per well for "passage"
+    """
+    rng = dict((name, np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key = (i,)))) for i, name in enumerate(rng_stream_names))
+    rng["passage"] = [np.random.default_rng(np.random.SeedSequence(int(seed), spawn_key = (len(rng_stream_names), k))) for k in range(n_wells)]
+    return rng
+
 # Species features
 
 def new_MakeMatrices(assumptions):
@@ -19,6 +143,8 @@ def new_MakeMatrices(assumptions):
     Changes:
     
     - Add BINARY_GAMMA SAMPLING
+    - Sample c and D blocks directly into numpy arrays and label them once at the end
+    - Fill the family blocks of c. Earlier versions assigned them through chained .loc indexing, which wrote to a temporary copy, so they stayed at 0 (c0/M in the Binary modes) and only the generalists were sampled. The random draws are the same, so D is unchanged, but c differs for the same seed
     """
     #PREPARE VARIABLES
     #Force number of species to be an array:
@@ -51,10 +177,19 @@ def new_MakeMatrices(assumptions):
     consumer_index = [[family_names[m] for m in range(F) for k in range(assumptions['SA'][m])]
                       +['GEN' for k in range(assumptions['Sgen'])],consumer_names]
     
+    #Row and column boundaries of each consumer family and resource type block:
+    family_edges = np.append(0,np.cumsum(assumptions['SA']))
+    type_edges = np.append(0,np.cumsum(assumptions['MA']))
+    def family_rows(k):
+        return slice(family_edges[k],family_edges[k+1])
+    def type_columns(j):
+        return slice(type_edges[j],type_edges[j+1])
+    gen_rows = slice(family_edges[-1],S)
+    
     #PERFORM GAUSSIAN SAMPLING
     if assumptions['sampling'] == 'Gaussian':
-        #Initialize dataframe:
-        c = pd.DataFrame(np.zeros((S,M)),columns=resource_index,index=consumer_index)
+        #Initialize array:
+        c = np.zeros((S,M))
         #Add Gaussian-sampled values, biasing consumption of each family towards its preferred resource:
         for k in range(F):
             for j in range(T):
@@ -64,17 +199,17 @@ def new_MakeMatrices(assumptions):
                 else:
                     c_mean = (assumptions['muc']/M)*(1-assumptions['q'])
                     c_var = (assumptions['sigc']**2/M)*(1-assumptions['q'])
-                c.loc['F'+str(k)]['T'+str(j)] = c_mean + np.random.randn(assumptions['SA'][k],assumptions['MA'][j])*np.sqrt(c_var)
-        if 'GEN' in c.index:
+                c[family_rows(k),type_columns(j)] = c_mean + np.random.randn(assumptions['SA'][k],assumptions['MA'][j])*np.sqrt(c_var)
+        if assumptions['Sgen'] > 0:
             c_mean = assumptions['muc']/M
             c_var = assumptions['sigc']**2/M
-            c.loc['GEN'] = c_mean + np.random.randn(assumptions['Sgen'],M)*np.sqrt(c_var)
+            c[gen_rows,:] = c_mean + np.random.randn(assumptions['Sgen'],M)*np.sqrt(c_var)
                     
     #PERFORM BINARY SAMPLING
     elif assumptions['sampling'] == 'Binary':
         assert assumptions['muc'] < M*assumptions['c1'], 'muc not attainable with given M and c1.'
         #Construct uniform matrix at total background consumption rate c0:
-        c = pd.DataFrame(np.ones((S,M))*assumptions['c0']/M,columns=resource_index,index=consumer_index)
+        c = np.ones((S,M))*assumptions['c0']/M
         #Sample binary random matrix blocks for each pair of family/resource type:
         for k in range(F):
             for j in range(T):
@@ -82,43 +217,38 @@ def new_MakeMatrices(assumptions):
                     p = (assumptions['muc']/(M*assumptions['c1']))*(1+assumptions['q']*(M-assumptions['MA'][j])/assumptions['MA'][j])
                 else:
                     p = (assumptions['muc']/(M*assumptions['c1']))*(1-assumptions['q'])
-                    
-                c.loc['F'+str(k)]['T'+str(j)] = (c.loc['F'+str(k)]['T'+str(j)].values 
-                                                + assumptions['c1']*BinaryRandomMatrix(assumptions['SA'][k],assumptions['MA'][j],p))
+                c[family_rows(k),type_columns(j)] += assumptions['c1']*BinaryRandomMatrix(assumptions['SA'][k],assumptions['MA'][j],p)
         #Sample uniform binary random matrix for generalists:
-        if 'GEN' in c.index:
+        if assumptions['Sgen'] > 0:
             p = assumptions['muc']/(M*assumptions['c1'])
-            c.loc['GEN'] = c.loc['GEN'].values + assumptions['c1']*BinaryRandomMatrix(assumptions['Sgen'],M,p)
+            c[gen_rows,:] += assumptions['c1']*BinaryRandomMatrix(assumptions['Sgen'],M,p)
 
     elif assumptions['sampling'] == 'Gamma':
-        #Initialize dataframe
-        c = pd.DataFrame(np.zeros((S,M)),columns=resource_index,index=consumer_index)
+        #Initialize array
+        c = np.zeros((S,M))
         #Add Gamma-sampled values, biasing consumption of each family towards its preferred resource
         for k in range(F):
             for j in range(T):
                 if k==j:
                     c_mean = (assumptions['muc']/M)*(1+assumptions['q']*(M-assumptions['MA'][j])/assumptions['MA'][j])
                     c_var = (assumptions['sigc']**2/M)*(1+assumptions['q']*(M-assumptions['MA'][j])/assumptions['MA'][j])
-                    thetac = c_var/c_mean
-                    kc = c_mean**2/c_var
-                    c.loc['F'+str(k)]['T'+str(j)] = np.random.gamma(kc,scale=thetac,size=(assumptions['SA'][k],assumptions['MA'][j]))
                 else:
                     c_mean = (assumptions['muc']/M)*(1-assumptions['q'])
                     c_var = (assumptions['sigc']**2/M)*(1-assumptions['q'])
-                    thetac = c_var/c_mean
-                    kc = c_mean**2/c_var
-                    c.loc['F'+str(k)]['T'+str(j)] = np.random.gamma(kc,scale=thetac,size=(assumptions['SA'][k],assumptions['MA'][j]))
-        if 'GEN' in c.index:
+                thetac = c_var/c_mean
+                kc = c_mean**2/c_var
+                c[family_rows(k),type_columns(j)] = np.random.gamma(kc,scale=thetac,size=(assumptions['SA'][k],assumptions['MA'][j]))
+        if assumptions['Sgen'] > 0:
             c_mean = assumptions['muc']/M
             c_var = assumptions['sigc']**2/M
             thetac = c_var/c_mean
             kc = c_mean**2/c_var
-            c.loc['GEN'] = np.random.gamma(kc,scale=thetac,size=(assumptions['Sgen'],M))
+            c[gen_rows,:] = np.random.gamma(kc,scale=thetac,size=(assumptions['Sgen'],M))
     
     #PERFORM UNIFORM SAMPLING
     elif assumptions['sampling'] == 'Uniform':
-        #Initialize dataframe:
-        c = pd.DataFrame(np.zeros((S,M)),columns=resource_index,index=consumer_index)
+        #Initialize array:
+        c = np.zeros((S,M))
         #Add uniformly sampled values, biasing consumption of each family towards its preferred resource:
         for k in range(F):
             for j in range(T):
@@ -126,16 +256,16 @@ def new_MakeMatrices(assumptions):
                     c_mean = (assumptions['muc']/M)*(1+assumptions['q']*(M-assumptions['MA'][j])/assumptions['MA'][j])
                 else:
                     c_mean = (assumptions['muc']/M)*(1-assumptions['q'])
-                c.loc['F'+str(k)]['T'+str(j)] = c_mean + (np.random.rand(assumptions['SA'][k],assumptions['MA'][j])-0.5)*assumptions['b']
-        if 'GEN' in c.index:
+                c[family_rows(k),type_columns(j)] = c_mean + (np.random.rand(assumptions['SA'][k],assumptions['MA'][j])-0.5)*assumptions['b']
+        if assumptions['Sgen'] > 0:
             c_mean = assumptions['muc']/M
-            c.loc['GEN'] = c_mean + (np.random.rand(assumptions['Sgen'],M)-0.5)*assumptions['b']
+            c[gen_rows,:] = c_mean + (np.random.rand(assumptions['Sgen'],M)-0.5)*assumptions['b']
     
     #PERFORM BINARY_GAMMA SAMPLING
     elif assumptions['sampling'] == 'Binary_Gamma':
         assert assumptions['muc'] < M*assumptions['c1'], 'muc not attainable with given M and c1.'
         #Construct uniform matrix at total background consumption rate c0:
-        c = pd.DataFrame(np.ones((S,M))*assumptions['c0']/M,columns=resource_index,index=consumer_index)
+        c = np.ones((S,M))*assumptions['c0']/M
         #Sample binary random matrix blocks for each pair of family/resource type:
         for k in range(F):
             for j in range(T):
@@ -153,9 +283,10 @@ def new_MakeMatrices(assumptions):
                 c_var_gamma = (c_var - c_var_binary*(c_mean_gamma**2))/(c_var_binary + c_mean_binary**2)
                 thetac = c_var_gamma/c_mean_gamma
                 kc = c_mean_gamma**2/c_var_gamma
-                c.loc['F'+str(k)]['T'+str(j)] = (c.loc['F'+str(k)]['T'+str(j)].values + assumptions['c1']*BinaryRandomMatrix(assumptions['SA'][k],assumptions['MA'][j],p))*np.random.gamma(kc,scale=thetac,size=(assumptions['SA'][k],assumptions['MA'][j]))
+                block = (family_rows(k),type_columns(j))
+                c[block] = (c[block] + assumptions['c1']*BinaryRandomMatrix(assumptions['SA'][k],assumptions['MA'][j],p))*np.random.gamma(kc,scale=thetac,size=(assumptions['SA'][k],assumptions['MA'][j]))
         #Sample uniform binary random matrix for generalists:
-        if 'GEN' in c.index:
+        if assumptions['Sgen'] > 0:
             p = assumptions['muc']/(M*assumptions['c1'])
             c_mean = assumptions['muc']/M
             c_var = assumptions['sigc']**2/M
@@ -165,85 +296,72 @@ def new_MakeMatrices(assumptions):
             c_var_gamma = (c_var - c_var_binary*(c_mean_gamma**2))/(c_var_binary + c_mean_binary**2)
             thetac = c_var_gamma/c_mean_gamma
             kc = c_mean_gamma**2/c_var_gamma
-            c.loc['GEN'] = (c.loc['GEN'].values + assumptions['c1']*BinaryRandomMatrix(assumptions['Sgen'],M,p))*np.random.gamma(kc,scale=thetac,size=(assumptions['Sgen'],M))
+            c[gen_rows,:] = (c[gen_rows,:] + assumptions['c1']*BinaryRandomMatrix(assumptions['Sgen'],M,p))*np.random.gamma(kc,scale=thetac,size=(assumptions['Sgen'],M))
     else:
-        print('Invalid distribution choice. Valid choices are kind=Gaussian and kind=Binary.')
+        emit_event("invalid_assumption", 'Invalid distribution choice. Valid choices are kind=Gaussian and kind=Binary.', level = "warning")
         return 'Error'
 
     #SAMPLE METABOLIC MATRIX FROM DIRICHLET DISTRIBUTION
+    #Rows of DT are the consumed resources, so D is its transpose
+    DT = np.zeros((M,M))
+    waste_columns = type_columns(assumptions['waste_type'])
     if assumptions["sampling_D"] == "default":
-        print("default sampling D")
-        DT = pd.DataFrame(np.zeros((M,M)),index=c.keys(),columns=c.keys())
-        for type_name in type_names:
-            MA = len(DT.loc[type_name])
-            if type_name is not waste_name:
+        emit_event("sampling_D", "default sampling D", level = "debug")
+        for j in range(T):
+            MA = assumptions['MA'][j]
+            if type_names[j] != waste_name:
                 #Set background secretion levels
-                p = pd.Series(np.ones(M)*(1-assumptions['fs']-assumptions['fw'])/(M-MA-M_waste),index = DT.keys())
+                p = np.ones(M)*(1-assumptions['fs']-assumptions['fw'])/(M-MA-M_waste)
                 #Set self-secretion level
-                p.loc[type_name] = assumptions['fs']/MA
+                p[type_columns(j)] = assumptions['fs']/MA
                 #Set waste secretion level
-                p.loc[waste_name] = assumptions['fw']/M_waste
+                p[waste_columns] = assumptions['fw']/M_waste
                 #Sample from dirichlet
-                DT.loc[type_name] = dirichlet(p/assumptions['sparsity'],size=MA)
+                DT[type_columns(j)] = dirichlet(p/assumptions['sparsity'],size=MA)
             else:
                 if M > MA:
                     #Set background secretion levels
-                    p = pd.Series(np.ones(M)*(1-assumptions['fw']-assumptions['fs'])/(M-MA),index = DT.keys())
+                    p = np.ones(M)*(1-assumptions['fw']-assumptions['fs'])/(M-MA)
                     #Set self-secretion level
-                    p.loc[type_name] = (assumptions['fw']+assumptions['fs'])/MA
+                    p[type_columns(j)] = (assumptions['fw']+assumptions['fs'])/MA
                 else:
-                    p = pd.Series(np.ones(M)/M,index = DT.keys())
+                    p = np.ones(M)/M
                 #Sample from dirichlet
-                DT.loc[type_name] = dirichlet(p/assumptions['sparsity'],size=MA)
+                DT[type_columns(j)] = dirichlet(p/assumptions['sparsity'],size=MA)
     elif assumptions["sampling_D"] == "fermenter_respirator":
-        print("fermenter_respirator")
+        emit_event("sampling_D", "fermenter_respirator", level = "debug")
         if len(assumptions["MA"]) != 2:
-            print("Number of family has to be 2")
-        DT = pd.DataFrame(np.zeros((M,M)),index=c.keys(),columns=c.keys())
-        for type_name in type_names:
-            MA = len(DT.loc[type_name])
-            if type_name == "T0":
-                print("draw sugar")
+            emit_event("invalid_assumption", "Number of family has to be 2", level = "warning")
+        for j in range(T):
+            MA = assumptions['MA'][j]
+            if type_names[j] == "T0":
+                emit_event("sampling_D", "draw sugar", level = "debug")
                 # Set background secretion levels
-                #p = pd.Series(np.ones(M)*(1-assumptions["fss"]-assumptions["fsa"]-assumptions["fsw"])/(M-MA-M_waste),index = DT.keys())
-                p = pd.Series(np.ones(M)*(1-assumptions["fss"]-assumptions["fsa"])/(M-MA),index = DT.keys())
+                p = np.ones(M)*(1-assumptions["fss"]-assumptions["fsa"])/(M-MA)
                 # Set suger to sugar secretion level
-                p.loc["T0"] = assumptions["fss"]/MA
+                p[type_columns(0)] = assumptions["fss"]/MA
                 # Set sugar to acid secretion level
-                p.loc["T1"] = assumptions["fsa"]/MA
-                # Set waste secretion level
-                # p.loc["T2"] = assumptions["fsw"]/M_waste
+                p[type_columns(1)] = assumptions["fsa"]/MA
                 # Sample from dirichlet
-                DT.loc["T0"] = dirichlet(p/assumptions['sparsity'],size=MA)
-            elif type_name == "T1":
-                print("draw acid")
+                DT[type_columns(0)] = dirichlet(p/assumptions['sparsity'],size=MA)
+            elif type_names[j] == "T1":
+                emit_event("sampling_D", "draw acid", level = "debug")
                 # Set background secretion levels
-                #p = pd.Series(np.ones(M)*(1-assumptions["fas"]-assumptions["faa"]-assumptions["faw"])/(M-MA-M_waste),index = DT.keys())
-                p = pd.Series(np.ones(M)*(1-assumptions["fas"]-assumptions["faa"])/(M-MA),index = DT.keys())
+                p = np.ones(M)*(1-assumptions["fas"]-assumptions["faa"])/(M-MA)
                 # Set acid to sugar secretion level
-                p.loc["T0"] = assumptions["fas"]/MA
+                p[type_columns(0)] = assumptions["fas"]/MA
                 # Set acid to acid secretion level
-                p.loc["T1"] = assumptions["faa"]/MA
-                # Set waste secretion level
-                #p.loc["T2"] = assumptions["faw"]/M_waste
+                p[type_columns(1)] = assumptions["faa"]/MA
                 # Sample from dirichlet
-                DT.loc["T1"] = dirichlet(p/assumptions['sparsity'],size=MA)
-            # elif type_name == "T2":
-            #     print("draw waste")
-            #     #Set background secretion levels
-            #     p = pd.Series(np.ones(M)*(1-assumptions["fws"]-assumptions["fwa"]-assumptions["fww"])/(M-MA-M_waste),index = DT.keys())
-            #     # Set waste to sugar secretion level
-            #     p.loc["T0"] = assumptions["fws"]/MA
-            #     # Set waste to acid secretion level
-            #     p.loc["T1"] = assumptions["fwa"]/MA
-            #     # Set waste secretion level
-            #     p.loc["T2"] = assumptions["fww"]/M_waste
-            #     #Sample from dirichlet
-            #     DT.loc["T2"] = dirichlet(p/assumptions['sparsity'],size=MA)
+                DT[type_columns(1)] = dirichlet(p/assumptions['sparsity'],size=MA)
     else:
-        print('Invalid distribution choice. Valid choices are sampling_D=default and sampling_D=fermenter_respirator.')
+        emit_event("invalid_assumption", 'Invalid distribution choice. Valid choices are sampling_D=default and sampling_D=fermenter_respirator.', level = "warning")
+    
+    #Label the matrices only once all blocks are filled
+    c = pd.DataFrame(c,columns=resource_index,index=consumer_index)
+    D = pd.DataFrame(DT.T,columns=resource_index,index=resource_index)
         
-    return c, DT.T
+    return c, D
 community_simulator.usertools.MakeMatrices = new_MakeMatrices
 
 def create_invader(params, assumptions):
@@ -310,7 +428,7 @@ def draw_species_cost(per_capita_function, assumptions):
 
     return gi
 
-def add_community_function(plate, assumptions, params):
+def add_community_function(plate, assumptions, params, species_pool = None):
     """
     Add the function attribute to the community
     
@@ -320,11 +438,17 @@ def add_community_function(plate, assumptions, params):
     For f6, f7, and f8, add resident_plate_t0_N, resident_plate_t1_N, resident_plate_t0_R, and resident_plate_t1_R
     
     if isolates calculate function for every isolate in monoculture.
+    
+    species_pool = shared species pool returned by attach_species_pool(). Its species function and random state replace the draws from the seed
     """
     
-    # Generate per capita species function
-    np.random.seed(assumptions['seed']) 
-    f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
+    # Generate per capita species function, or take it from the shared species pool
+    if species_pool is None:
+        np.random.seed(assumptions['seed']) 
+        f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
+    else:
+        f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = species_pool["species_function"]
+        np.random.set_state(species_pool["random_state"])
     
     # Species function for f1 additive community function
     setattr(plate, "f1_species_smooth", f1_species_smooth)
@@ -337,7 +461,7 @@ def add_community_function(plate, assumptions, params):
 
     # Invasion function f5 or knock_in with a threshold requires us to grow isolates in monoculture to obtain their abundance.
     if assumptions['knock_in']:
-        print("\nStabilizing monoculture plate")
+        emit_event("knock_in", "Stabilizing monoculture plate", exp_id = assumptions["exp_id"])
         # Update assumptions
         assumptions_monoculture = assumptions.copy()
         params_invasion = params.copy()
@@ -346,15 +470,15 @@ def add_community_function(plate, assumptions, params):
 
         # Monoculture plate for knock in
         plate_monoculture = make_plate(assumptions_monoculture, params_invasion)
-        print("\nStabilizing monoculture plate for knock-in")
+        emit_event("knock_in", "Stabilizing monoculture plate for knock-in", exp_id = assumptions["exp_id"])
         for i in range(assumptions_monoculture["n_transfer"] - assumptions_monoculture["n_transfer_selection"]):
             plate_monoculture.Propagate(assumptions_monoculture["n_propagation"])
             plate_monoculture = passage_monoculture(plate_monoculture, assumptions_monoculture["dilution"])
-            print("Transfer " + str(i+1))
+            emit_event("knock_in_transfer", "Transfer " + str(i+1), level = "debug", exp_id = assumptions["exp_id"], transfer = i+1)
         plate_monoculture.Propagate(assumptions_monoculture["n_propagation"]) #  1 final growth cycle before storing data
-        print("\nFinished stabilizing monoculture plate")
+        emit_event("knock_in", "Finished stabilizing monoculture plate", exp_id = assumptions["exp_id"])
         
-        print("\nMeasuring monocultures for preparing knock_in list")
+        emit_event("knock_in", "Measuring monocultures for preparing knock_in list", exp_id = assumptions["exp_id"])
         if "f1" in assumptions["selected_function"]:
             setattr(plate_monoculture, "f1_species_smooth", f1_species_smooth)
             setattr(plate_monoculture, "f1_species_rugged", f1_species_rugged)
@@ -364,7 +488,6 @@ def add_community_function(plate, assumptions, params):
         elif "f6" in assumptions["selected_function"]:
             setattr(plate_monoculture, "target_resource", assumptions["target_resource"])
         setattr(plate, "knock_in_species_function", globals()[assumptions["selected_function"]](plate_monoculture, params_simulation = assumptions_monoculture))
-        print("\nknock_in_species_function ", plate.knock_in_species_function)
     
 
     # f6_target_resource
@@ -374,10 +497,11 @@ def add_community_function(plate, assumptions, params):
     return plate
 
 
-def sample_from_pool(plate_N, assumptions, n = None):
+def sample_from_pool(plate_N, assumptions, n = None, rng = np.random):
     """
     Sample communities from regional species pool.
     plate_N = consumer data.frame
+    rng = random generator (see get_rng). Default is the global numpy random state
     """
     S_tot = plate_N.shape[0] # Total number of species in the pool
     N0 = np.zeros((plate_N.shape)) # Make empty plate
@@ -390,20 +514,18 @@ def sample_from_pool(plate_N, assumptions, n = None):
     if assumptions['monoculture'] == False and assumptions['metacommunity_sampling'] == 'Power':
         # Sample initial community for each well
         for k in range(plate_N.shape[1]):
-            pool = np.random.power(assumptions['power_alpha'], size = S_tot) # Power-law distribution
+            pool = rng.power(assumptions['power_alpha'], size = S_tot) # Power-law distribution
             pool = pool/np.sum(pool) # Normalize the pool
-            consumer_list = np.random.choice(S_tot, size = n , replace = True, p = pool) # Draw from the pool
-            my_tab = pd.crosstab(index = consumer_list, columns = "count") # Calculate the cell count
-            N0[my_tab.index.values,k] = np.ravel(my_tab.values / assumptions['scale']) # Scale to biomass
+            consumer_list = rng.choice(S_tot, size = n , replace = True, p = pool) # Draw from the pool
+            N0[:,k] = np.bincount(consumer_list, minlength = S_tot) / assumptions['scale'] # Count the cells and scale to biomass
         # Make data.frame
         N0 = pd.DataFrame(N0, index = consumer_index, columns = well_names)
     elif assumptions['monoculture'] == False and assumptions['metacommunity_sampling'] == 'Lognormal':
         for k in range(plate_N.shape[1]):
-            pool = np.random.lognormal(assumptions['lognormal_mean'], assumptions['lognormal_sd'], size = S_tot) # Power-law distribution
+            pool = rng.lognormal(assumptions['lognormal_mean'], assumptions['lognormal_sd'], size = S_tot) # Power-law distribution
             pool = pool/np.sum(pool) # Normalize the pool
-            consumer_list = np.random.choice(S_tot, size = n , replace = True, p = pool) # Draw from the pool
-            my_tab = pd.crosstab(index = consumer_list, columns = "count") # Calculate the cell count
-            N0[my_tab.index.values,k] = np.ravel(my_tab.values / assumptions['scale']) # Scale to biomass
+            consumer_list = rng.choice(S_tot, size = n , replace = True, p = pool) # Draw from the pool
+            N0[:,k] = np.bincount(consumer_list, minlength = S_tot) / assumptions['scale'] # Count the cells and scale to biomass
         # Make data.frame
         N0 = pd.DataFrame(N0, index = consumer_index, columns = well_names)
     elif assumptions['monoculture'] == False and assumptions['metacommunity_sampling'] == 'Default':
@@ -428,7 +550,7 @@ def sample_from_pool(plate_N, assumptions, n = None):
 
 
 
-def sample_from_pool2(plate_N, assumptions, synthetic_community_size = 2, n = None):
+def sample_from_pool2(plate_N, assumptions, synthetic_community_size = 2, n = None, rng = np.random):
     """
     Make synthetic communities with given initial richness
     """
@@ -441,7 +563,7 @@ def sample_from_pool2(plate_N, assumptions, synthetic_community_size = 2, n = No
         n = assumptions['n_inoc']
         
     for k in range(plate_N.shape[1]):
-        consumer_list = np.random.choice(S_tot, size = synthetic_community_size, replace = False) 
+        consumer_list = rng.choice(S_tot, size = synthetic_community_size, replace = False) 
         
         for v in range(synthetic_community_size):
                 N0[consumer_list[v], k] = n / synthetic_community_size / assumptions["scale"]
@@ -457,25 +579,26 @@ def migrate_from_pool(plate,migration_factor,params_simulation, power_law = True
     If power_law is false sample s_migration species from isolates with each total number of cells equivalent to n
     """
     from community_selection.usertools import sample_from_pool
+    rng = get_rng(plate, "perturbation")
     if n is None:
         n = params_simulation['n_inoc']
     if power_law:
         if np.sum(migration_factor) != 0:
             temp_params_simulation = params_simulation.copy() 
-            migration_plate = sample_from_pool(plate.N, params_simulation,n=n) * migration_factor # Migration factor is a list determined by migration algorithms and community function
+            migration_plate = sample_from_pool(plate.N, params_simulation,n=n, rng=rng) * migration_factor # Migration factor is a list determined by migration algorithms and community function
             plate_migrated = plate.N + migration_plate 
         else:
             plate_migrated = plate.N
     else: 
         if np.sum(migration_factor) != 0:
-            migration_plate = plate.N.copy()
-            migration_plate[:]  = 0
-            for k in plate.N.columns:
-                if migration_factor[np.where(plate.N.columns == k)[0]]>0: 
-                    for j in range(0,params_simulation['s_migration']):
-                        s_id = np.random.choice(np.where(plate.N[k]==0)[0])
-                        migration_plate[k][s_id]= n * 1/params_simulation["scale"] * 1/params_simulation['s_migration']
-            plate_migrated = plate.N + migration_plate
+            N = np.asarray(plate.N)
+            migration_plate = np.zeros(N.shape)
+            for k in np.nonzero(np.asarray(migration_factor) > 0)[0]:
+                absent_species = np.nonzero(N[:,k] == 0)[0]
+                for j in range(0,params_simulation['s_migration']):
+                    s_id = rng.choice(absent_species)
+                    migration_plate[s_id,k] = n * 1/params_simulation["scale"] * 1/params_simulation['s_migration']
+            plate_migrated = plate.N + pd.DataFrame(migration_plate, index = plate.N.index, columns = plate.N.columns)
         else:
             plate_migrated = plate.N
     return plate_migrated
@@ -498,9 +621,9 @@ def passage_monoculture(plate_mono, f, scale = None, refresh_resource = True):
     N = np.zeros(np.shape(self.N))
     
     #Poisson sample cells
-    print(self.N)
     self.N = self.N * f *scale
-    self.N.applymap(np.random.poisson)   
+    if getattr(self, "rng", None) is None:
+        np.random.poisson(np.asarray(self.N).T) # The Poisson draws are not used. Kept for the random state of runs with the global random state (drawn well by well)
     self.N = self.N/scale
 
     if refresh_resource:
@@ -514,7 +637,7 @@ def passage_monoculture(plate_mono, f, scale = None, refresh_resource = True):
         R = np.zeros(np.shape(self.R))
         for k in range(self.n_wells):
             if f[k,k] > 0 and R_tot[k] > 0:
-                R[:,k] += np.random.multinomial(int(scale*R_tot[k]*f[k,k]),(self.R/R_tot).values[:,k])*1./scale
+                R[:,k] += get_rng(self, "passage", k).multinomial(int(scale*R_tot[k]*f[k,k]),(self.R/R_tot).values[:,k])*1./scale
         self.R = pd.DataFrame(R, index = self.R.index, columns = self.R.keys())
 
     return self
@@ -525,7 +648,12 @@ def make_medium(plate_R, assumptions):
     if assumptions['rich_medium'] == True, make rich medium
     """
     if assumptions['rich_medium'] == True:
-        np.random.seed(1)
+        # The medium is the same for all seeds
+        if assumptions.get('rng_streams', False):
+            rng = np.random.default_rng(1)
+        else:
+            np.random.seed(1)
+            rng = np.random
     
         # Total number of resource in this universe
         R_tot = plate_R.shape[0] 
@@ -539,9 +667,9 @@ def make_medium(plate_R, assumptions):
         # Well index
         well_names = plate_R.columns
     
-        resource_pool = np.random.uniform(0, 1, size = R_tot) # Uniform distribution
+        resource_pool = rng.uniform(0, 1, size = R_tot) # Uniform distribution
         resource_pool = resource_pool/np.sum(resource_pool)
-        resource_list = np.random.choice(R_tot, size = assumptions["R0_food"], replace = True, p = resource_pool) # Draw from the pool
+        resource_list = rng.choice(R_tot, size = assumptions["R0_food"], replace = True, p = resource_pool) # Draw from the pool
         my_tab = pd.crosstab(index = resource_list, columns = "count")
         food_compostion = np.ravel(my_tab.values)
         for i in range(plate_R.shape[1]):
@@ -566,6 +694,8 @@ def make_plate(assumptions, params):
     # Make initial state
     init_state = MakeInitialState(assumptions)
     plate = Metacommunity(init_state, dynamics, params, scale = assumptions["scale"], parallel = False) 
+    if assumptions.get('rng_streams', False):
+        setattr(plate, "rng", make_rng_streams(assumptions["seed"], plate.n_wells))
     
     # Add media to plate (overrides community simulator)
     plate.R = make_medium(plate.R, assumptions)
@@ -578,7 +708,7 @@ def make_plate(assumptions, params):
     
     # If plate is to be replaced by overwritting plate, skip the sampling
     if pd.isnull(assumptions["overwrite_plate"]):
-        plate.N = sample_from_pool(plate.N, assumptions)
+        plate.N = sample_from_pool(plate.N, assumptions, rng = get_rng(plate, "sampling"))
 
     # Remove invader in the plate 
     if assumptions["selected_function"] == "f5_invader_suppression":
@@ -586,34 +716,253 @@ def make_plate(assumptions, params):
     
     return plate
 
+# Batched propagation
+
+# Largest number of species x resources x wells elements of the uptake arrays computed at once by make_batched_dynamics()
+batched_chunk_size = 2**22
+
+# Dormand-Prince 5(4) coefficients used by integrate_wells(). The last row of dopri_a is the fifth order solution, and dopri_e the difference of the fifth and fourth order weights
+dopri_a = [[], [1/5], [3/40, 9/40], [44/45, -56/15, 32/9], [19372/6561, -25360/2187, 64448/6561, -212/729],
+           [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656], [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+dopri_e = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+def stack_block_parameters(params_list, shapes):
+    """
+    Stack the parameters of the blocks of a batched propagation along a first axis, in double precision
+    
+    params_list = list of parameter dictionaries, one per block or one shared by all blocks
+    shapes = dictionary of the parameters to stack and their shape in one well, e.g. (S, M) for c. Scalars and vectors are broadcast to this shape as in community-simulator
+    
+    Return: dictionary of arrays. Parameters of one well shape are stacked as (blocks, species or resources, 1) so that they broadcast over the wells
+    """
+    stacked = dict()
+    for k, shape in shapes.items():
+        stacked[k] = np.stack([np.broadcast_to(np.asarray(params[k], dtype = float), shape) for params in params_list])
+        if len(shape) == 1:
+            stacked[k] = stacked[k][:, :, None]
+    return stacked
+
+def make_batched_dynamics(params_list, assumptions, n_species, n_resources):
+    """
+    Consumer and resource dynamics of community-simulator (MakeConsumerDynamics and MakeResourceDynamics) for a stack of plates with the same numbers of species, resources and wells
+    
+    params_list = parameter dictionaries of the plates (blocks), or a list of one dictionary shared by all blocks
+    assumptions = dictionary with the response, regulation and supply of the dynamics
+    
+    The state Y has shape (blocks, species + resources, wells). With a type I response and independent regulation, the uptake of each block is one matrix product. Other responses are computed in chunks of wells of at most batched_chunk_size species x resources x wells elements
+    Return: function of Y returning dY/dt
+    """
+    response, regulation, supply = assumptions["response"], assumptions["regulation"], assumptions["supply"]
+    assert response in ["type I", "type II", "type III"], "response " + str(response) + " is not supported in batched propagation"
+    assert regulation in ["independent", "energy", "mass"], "regulation " + str(regulation) + " is not supported in batched propagation"
+    assert supply in ["off", "external", "self-renewing"], "supply " + str(supply) + " is not supported in batched propagation"
+    S, M = n_species, n_resources
+    shapes = {"c": (S, M), "D": (M, M), "g": (S,), "m": (S,), "w": (M,), "l": (M,)}
+    if response != "type I":
+        shapes.update({"sigma_max": (S, M), "n": (S, M)})
+    if regulation != "independent":
+        shapes.update({"nreg": (S, M)})
+    if supply == "external":
+        shapes.update({"R0": (M,), "tau": (M,)})
+    elif supply == "self-renewing":
+        shapes.update({"R0": (M,), "r": (M,)})
+    p = stack_block_parameters(params_list, shapes)
+    for k in ["sigma_max", "n", "nreg"]:
+        if k in p and np.all(p[k] == p[k].flat[0]):
+            p[k] = float(p[k].flat[0]) # Same value for all species and resources
+    
+    buffer = dict() # Uptake array of each chunk width, allocated once
+    
+    def power(X, n):
+        # X**n in place. Small integer exponents, such as the default n and nreg, are computed by repeated squaring, which is much faster than np.power
+        if np.ndim(n) > 0 or n != int(n) or not 1 <= n <= 64:
+            return np.power(X, n, out = X)
+        n, X_power = int(n), None
+        while n > 0:
+            if n % 2 == 1:
+                X_power = X.copy() if X_power is None else np.multiply(X_power, X, out = X_power)
+            n = n // 2
+            if n > 0:
+                np.square(X, out = X)
+        X[...] = X_power
+        return X
+    
+    def block(k, q):
+        # Parameter k (species x resources) of block q, with an axis for the wells
+        return p[k] if np.ndim(p[k]) == 0 else p[k][q][:, :, None]
+    
+    def uptake(X, q):
+        # Uptake J_in/w of the species (S x M x wells) at X = c*R, computed in place of X
+        if regulation == "energy":
+            u = power(p["w"][q]*X, block("nreg", q))
+        elif regulation == "mass":
+            u = power(X.copy(), block("nreg", q))
+        if response == "type II":
+            X /= 1 + X/block("sigma_max", q)
+        elif response == "type III":
+            power(X, block("n", q))
+            X /= 1 + X/block("sigma_max", q)
+        if regulation != "independent":
+            X *= u
+            X /= np.sum(u, axis = 1, keepdims = True)
+        return X
+    
+    def dYdt(Y):
+        N, R = Y[:, :S], Y[:, S:]
+        if response == "type I" and regulation == "independent":
+            G = np.matmul(p["c"], (1 - p["l"])*p["w"]*R) # Growth of each species
+            U = R*np.matmul(np.swapaxes(p["c"], 1, 2), N) # Consumption of each resource
+        else:
+            G, U = np.empty_like(N), np.empty_like(R)
+            n_chunk = max(1, batched_chunk_size // (S*M))
+            for b in range(Y.shape[0]):
+                q = b if len(params_list) > 1 else 0
+                growth_weight = ((1 - p["l"][q])*p["w"][q])[:, 0]
+                for k in range(0, Y.shape[2], n_chunk):
+                    wells = slice(k, k + n_chunk)
+                    R_wells = R[b, None, :, wells]
+                    if R_wells.shape[2] not in buffer:
+                        buffer[R_wells.shape[2]] = np.empty((S, M, R_wells.shape[2]))
+                    J = uptake(np.multiply(p["c"][q][:, :, None], R_wells, out = buffer[R_wells.shape[2]]), q)
+                    G[b, :, wells] = np.einsum("smw,m->sw", J, growth_weight)
+                    U[b, :, wells] = np.einsum("smw,sw->mw", J, N[b, :, wells])
+        dR = np.matmul(p["D"], p["l"]*p["w"]*U)/p["w"] - U
+        if supply == "external":
+            dR = dR + (p["R0"] - R)/p["tau"]
+        elif supply == "self-renewing":
+            dR = dR + p["r"]*R*(p["R0"] - R)
+        return np.concatenate([p["g"]*N*(G - p["m"]), dR], axis = 1)
+    
+    return dYdt
+
+def check_batched_dynamics(plate_list, dYdt, Y):
+    """
+    Assert that the batched dynamics give the same rates as the dynamics of each plate (plate.dNdt and plate.dRdt) in its first well
+    """
+    S = plate_list[0].N.shape[0]
+    Y_first = dYdt(Y[:, :, :1])[:, :, 0]
+    for b, plate in enumerate(plate_list):
+        rates = np.concatenate([plate.dNdt(Y[b, :S, 0], Y[b, S:, 0], plate.params), plate.dRdt(Y[b, :S, 0], Y[b, S:, 0], plate.params)])
+        assert np.allclose(Y_first[b], rates, rtol = 1e-4, atol = 1e-6 * np.max(np.abs(rates), initial = 1), equal_nan = True), "The batched dynamics do not match the dynamics of the plate"
+
+def integrate_wells(dYdt, Y, T, atol = 1e-4, rtol = 1e-6, max_steps = 100000):
+    """
+    Integrate dY/dt = dYdt(Y) from 0 to T with the explicit Dormand-Prince 5(4) method, for a state Y of shape (blocks, variables, wells)
+    
+    Each well takes its own adaptive steps, accepted when the largest error of its variables is at most atol + rtol*|Y| (the max norm of LSODA), so a well is integrated as if it was alone. The stages of all wells are evaluated together in one call of dYdt. atol is the absolute tolerance of the per-well integration of community-simulator
+    
+    Return: Y at time T
+    """
+    def norm(x):
+        return np.sqrt(np.mean(x**2, axis = 1, keepdims = True))
+    
+    # Initial step of each well (Hairer, Norsett and Wanner, Solving ODE I, II.4)
+    k1 = dYdt(Y)
+    scale = atol + rtol*np.abs(Y)
+    d0, d1 = norm(Y/scale), norm(k1/scale)
+    h0 = np.minimum(np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01*d0/np.maximum(d1, 1e-300)), T)
+    d2 = np.maximum(d1, norm((dYdt(Y + h0*k1) - k1)/scale)/h0)
+    h = np.minimum(np.minimum(100*h0, np.where(d2 <= 1e-15, np.maximum(1e-6, h0*1e-3), (0.01/np.maximum(d2, 1e-300))**(1/5))), T)
+    
+    t = np.zeros(h.shape)
+    n_steps = 0
+    while True:
+        active = T - t > 1e-12*T
+        if not active.any():
+            return Y
+        assert n_steps < max_steps, "Batched propagation did not reach T in " + str(max_steps) + " steps"
+        h = np.where(active, np.minimum(h, T - t), 0)
+        k = [k1]
+        for a in dopri_a[1:]:
+            Y_stage = Y + h*sum([a_j*k_j for a_j, k_j in zip(a, k) if a_j != 0])
+            k.append(dYdt(Y_stage))
+        error = np.max(np.abs(h*sum([e_j*k_j for e_j, k_j in zip(dopri_e, k) if e_j != 0])/(atol + rtol*np.maximum(np.abs(Y), np.abs(Y_stage)))), axis = 1, keepdims = True)
+        assert np.all(np.isfinite(error[active])), "The batched dynamics are not finite"
+        accept = active & (error <= 1)
+        Y = np.where(accept, Y_stage, Y)
+        k1 = np.where(accept, k[-1], k1)
+        t = np.where(accept, t + h, t)
+        factor = np.clip(0.9*np.maximum(error, 1e-10)**(-1/5), 0.2, 10)
+        h = h*np.where(accept, factor, np.minimum(factor, 1))
+        n_steps = n_steps + 1
+
+def propagate_plates(plate_list, T, assumptions):
+    """
+    Propagate plates with the same numbers of species, resources and wells in one batched integration (see make_batched_dynamics and integrate_wells), in place of plate.Propagate(T) on each plate
+    
+    assumptions = dictionary with the response, regulation and supply of the plates
+    
+    Plates that share one parameter dictionary are integrated with one copy of the parameters; otherwise each plate is a block with its own parameters. As in Propagate(), a sparse N is integrated dense and made sparse again, and N and R are stored back in the dtype of each plate
+    Return: list of plates
+    """
+    S, M = plate_list[0].N.shape[0], plate_list[0].R.shape[0]
+    assert all([plate.N.shape == plate_list[0].N.shape and plate.R.shape == plate_list[0].R.shape for plate in plate_list]), "The batched plates have different numbers of species, resources or wells"
+    params_list = [plate.params for plate in plate_list]
+    assert all([isinstance(params, dict) for params in params_list]), "Batched propagation needs one parameter dictionary per plate"
+    if all([params is params_list[0] for params in params_list]):
+        params_list = params_list[:1]
+    dYdt = make_batched_dynamics(params_list, assumptions, S, M)
+    Y = np.stack([np.concatenate([np.asarray(dense_frame(plate.N), dtype = float), np.asarray(plate.R, dtype = float)]) for plate in plate_list])
+    check_batched_dynamics(plate_list, dYdt, Y)
+    Y = integrate_wells(dYdt, Y, T)
+    for b, plate in enumerate(plate_list):
+        plate.N = pd.DataFrame(Y[b, :S], index = plate.N.index, columns = plate.N.columns)
+        plate.R = pd.DataFrame(Y[b, S:], index = plate.R.index, columns = plate.R.columns)
+        cast_state(plate)
+        format_state(plate)
+    return plate_list
+
 # Data operation
 
+def nonzero_entries(df):
+    """
+    Non-zero entries of a dense data.frame or of one in the sparse column format, ordered by column and then by row
+    
+    Return: column indices, row indices, and values
+    """
+    if is_sparse_frame(df):
+        matrix = sparse_matrix(df)
+        column_index = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+        is_nonzero = matrix.data != 0
+        return column_index[is_nonzero], matrix.indices[is_nonzero].astype(np.int64), matrix.data[is_nonzero]
+    values = np.asarray(df)
+    column_index, row_index = np.nonzero(values.T)
+    return column_index, row_index, values[row_index, column_index]
+
+def sparse_richness_biomass(plate_N, threshold):
+    """
+    Richness (number of species with abundance >= threshold) and biomass of each well of N in the sparse column format
+    """
+    matrix = sparse_matrix(plate_N)
+    column_index = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+    richness = np.bincount(column_index, weights = matrix.data >= threshold, minlength = matrix.shape[1]).astype(int)
+    biomass = np.bincount(column_index, weights = matrix.data, minlength = matrix.shape[1]).astype(matrix.dtype)
+    return richness, biomass
+
 def reshape_plate_data(plate, params_simulation,transfer_loop_index):
     """
     Reshape the plate resource and consumer matrices (wider form) into a melted data.frame (longer form)
     """
-    # Temporary function for adding variables to and melting df
+    # Temporary function for melting the non-zero entries of df
     def melt_df(plate_df, data_type = "consumer"):
-        # Consumers
-        temp_df = pd.DataFrame(plate_df)
-        total_number = temp_df.shape[0]
+        # Non-zero entries, ordered by well and then by ID
+        well_index, ID, abundance = nonzero_entries(plate_df)
+        total_number = len(ID)
         
-        ## Add variables
-        temp_df["Type"] = np.repeat(data_type, total_number)
-        temp_df["ID"] = range(total_number)
-        temp_df["Transfer"] = np.repeat(str(transfer_loop_index), total_number)
-        temp_df["exp_id"] = np.repeat(params_simulation['exp_id'] , total_number)
-
-        ## Melt the df
-        temp_df = pd.melt(temp_df, id_vars = ["exp_id","Transfer", "Type", "ID"], var_name = "Well", value_name = "Abundance")
-        temp_df = temp_df[temp_df.Abundance != 0] # Remove zero abundances
+        ## Make the melted df
+        temp_df = pd.DataFrame({
+            "exp_id": np.repeat(params_simulation['exp_id'], total_number),
+            "Transfer": np.repeat(transfer_loop_index, total_number),
+            "Type": np.repeat(data_type, total_number),
+            "ID": ID,
+            "Well": np.asarray(plate_df.columns)[well_index],
+            "Abundance": abundance})
         return temp_df
         
     # Melt the df
-    temp_plate = plate.copy() # Copy the original plate 
-    df_N = melt_df(temp_plate.N, data_type = "consumer")
-    df_R = melt_df(temp_plate.R, data_type = "resource")
-    df_R0 = melt_df(temp_plate.R0,data_type = "R0")
+    df_N = melt_df(plate.N, data_type = "consumer")
+    df_R = melt_df(plate.R, data_type = "resource")
+    df_R0 = melt_df(plate.R0,data_type = "R0")
     
     # Concatenate dataframes
     merged_df = pd.concat([df_N, df_R,df_R0]) 
@@ -647,60 +996,660 @@ def reshape_function_data(params_simulation,community_function, richness, biomas
     
     return temp_df 
 
-def overwrite_plate(plate, assumptions):
-    """ 
-    Overwrite the plate N, R, and R0 dataframe by the input composition file
+class DataWriter:
+    """
+    Append melted data.frames to an output file while the simulation proceeds, so that the data do not pile up in memory
+    
+    filename = output file name. For "parquet", a directory of which each chunk is a file
+    file_format = "csv" writes one text file with a single header. "parquet" writes each chunk as a compressed columnar file with string columns stored as categories
+    position = position returned by DataWriter.position(). If given, the data written after this position are discarded and writing continues from there
+    """
+    def __init__(self, filename, file_format = "csv", position = None):
+        import os
+        assert file_format in ["csv", "parquet"], "file_format must be csv or parquet"
+        self.filename = filename
+        self.file_format = file_format
+        self.n_chunk = 0 if position is None else position["n_chunk"]
+        if file_format == "csv" and position is not None and self.n_chunk > 0:
+            with open(filename, "r+") as f:
+                f.truncate(position["size"])
+        elif file_format == "parquet":
+            os.makedirs(filename, exist_ok = True)
+            for chunk_file in os.listdir(filename): # Remove chunks left by an earlier run
+                if chunk_file.endswith(".parquet") and int(chunk_file[5:10]) >= self.n_chunk:
+                    os.remove(os.path.join(filename, chunk_file))
+    
+    def write(self, df):
+        """Append one chunk of data"""
+        if self.file_format == "csv":
+            df.to_csv(self.filename, mode = "w" if self.n_chunk == 0 else "a", header = self.n_chunk == 0, index = False)
+        elif self.file_format == "parquet":
+            import os
+            df = df.astype({k: "category" for k in df.columns if df[k].dtype == object})
+            df.to_parquet(os.path.join(self.filename, "part-%05d.parquet" % self.n_chunk), index = False)
+        self.n_chunk += 1
+    
+    def position(self):
+        """Current position of the writer, for resuming from a checkpoint"""
+        import os
+        if self.file_format == "csv" and self.n_chunk > 0:
+            return {"n_chunk": self.n_chunk, "size": os.path.getsize(self.filename)}
+        return {"n_chunk": self.n_chunk}
+
+class PlateState:
+    """
+    Copy of the N, R, and R0 data.frames of a plate (see copy_frame), handed to a BackgroundWriter in place of the plate
+    """
+    def __init__(self, N, R, R0):
+        self.N = N
+        self.R = R
+        self.R0 = R0
+
+class BackgroundWriter:
+    """
+    Run the output writes of one experiment in a background thread, so that the simulation only pays for copying the plate state
+    
+    maxsize = number of writes that can wait in the queue. submit() blocks while the queue is full, so that the memory of the pending plate states stays bounded
+    
+    An error of a write is raised by the next submit(), flush(), or close()
+    """
+    def __init__(self, maxsize):
+        import queue
+        import threading
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.error = None
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None: # Skip the writes after a failed one
+                    function, args = task
+                    function(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+    
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Background output write failed") from self.error
+    
+    def submit(self, function, *args):
+        """Queue the call function(*args)"""
+        self.raise_error()
+        self.queue.put((function, args))
+    
+    def flush(self):
+        """Wait for the queued writes to finish"""
+        self.queue.join()
+        self.raise_error()
+    
+    def close(self):
+        """Finish the queued writes and stop the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+class TrajectoryWriter:
+    """
+    Store the species abundances of each logged transfer in a sparse coordinate (COO) format
+    
+    Only non-zero abundances are kept, as integer (transfer, well, species) indices and float abundances. 
+    Entries of transfer k are trajectory["well"][offsets[k]:offsets[k+1]] etc, ordered by well and then by species.
+    The trajectory is saved as an npz file by close() and can be read by read_trajectory()
+    """
+    def __init__(self, filename, n_species, n_wells):
+        self.filename = filename
+        self.n_species = n_species
+        self.n_wells = n_wells
+        self.transfer = list()
+        self.well = list()
+        self.species = list()
+        self.abundance = list()
+    
+    def write(self, plate_N, transfer_loop_index):
+        """Append the non-zero abundances of one transfer"""
+        well_index, species_index, abundance = nonzero_entries(plate_N)
+        self.transfer.append(transfer_loop_index)
+        self.well.append(well_index.astype(np.int32))
+        self.species.append(species_index.astype(np.int32))
+        self.abundance.append(abundance)
+    
+    def close(self):
+        """Save the trajectory"""
+        offsets = np.append(0, np.cumsum([len(x) for x in self.abundance]))
+        np.savez_compressed(self.filename, 
+            transfer = np.array(self.transfer, dtype = np.int32), offsets = offsets.astype(np.int64), 
+            well = np.concatenate(self.well) if len(self.well) > 0 else np.zeros(0, dtype = np.int32),
+            species = np.concatenate(self.species) if len(self.species) > 0 else np.zeros(0, dtype = np.int32),
+            abundance = np.concatenate(self.abundance) if len(self.abundance) > 0 else np.zeros(0),
+            shape = np.array([self.n_species, self.n_wells]))
+
+def resident_memory():
+    """
+    Resident set size of this process in bytes. Where /proc is not available, the peak resident set size is returned instead
     """
     import os
-    assert(os.path.isfile(assumptions['overwrite_plate'])), "The overwrite_plate does not exist"
-    # Read the input data file
-    df = pd.read_csv(assumptions["overwrite_plate"])
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import sys
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024 # kilobytes on linux
+
+class StageProfiler:
+    """
+    Record the wall time, the number of evaluations of the right hand side (dNdt) of the dynamics, and the allocated memory of the stages of simulate_community() in each transfer
+    
+    Memory is traced by tracemalloc only if allocations = True, since tracing slows down the simulation. 
+    Each stage then records the peak allocated memory, the resident memory at its end, and the n_top source lines that allocated the most memory in it.
+    The peak of a stage needs tracemalloc.reset_peak() (Python 3.9 or later). On older interpreters it is NaN
+    The report is saved as a csv file by close()
+    """
+    def __init__(self, filename, exp_id, allocations = False, n_top = 3):
+        import tracemalloc
+        self.filename = filename
+        self.exp_id = exp_id
+        self.allocations = allocations
+        self.n_top = n_top
+        self.records = list()
+        self.n_rhs = 0
+        self.started_tracemalloc = False
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+    
+    def stage(self, stage, transfer_loop_index, plate = None):
+        """
+        Context manager that records one stage
+        
+        plate = if given, count the dNdt evaluations of the plate during the stage
+        """
+        import contextlib
+        @contextlib.contextmanager
+        def record_stage():
+            import tracemalloc
+            if plate is not None:
+                dNdt = plate.dNdt
+                def counted_dNdt(N, R, params):
+                    self.n_rhs += 1
+                    return dNdt(N, R, params)
+                plate.dNdt = counted_dNdt
+            n_rhs = self.n_rhs
+            if self.allocations:
+                snapshot = self.take_snapshot()
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                memory = tracemalloc.get_traced_memory()[0]
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                record = {"exp_id": self.exp_id, "Transfer": transfer_loop_index, "Stage": stage, "WallTime": time.perf_counter() - start_time, "RHSEvaluations": self.n_rhs - n_rhs}
+                if self.allocations:
+                    record["PeakAllocated"] = tracemalloc.get_traced_memory()[1] - memory if hasattr(tracemalloc, "reset_peak") else np.nan
+                    record["RSS"] = resident_memory()
+                    top_allocations = self.take_snapshot().compare_to(snapshot, "lineno")[:self.n_top]
+                    record["TopAllocations"] = "; ".join("%s:%d %+d" % (x.traceback[0].filename, x.traceback[0].lineno, x.size_diff) for x in top_allocations)
+                self.records.append(record)
+                if plate is not None:
+                    plate.dNdt = dNdt
+        return record_stage()
+    
+    def take_snapshot(self):
+        """Snapshot of the traced memory, without the allocations of tracemalloc itself"""
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    
+    def close(self):
+        """Save the report"""
+        import tracemalloc
+        pd.DataFrame(self.records).to_csv(self.filename, index = False)
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+def estimate_peak_memory(assumptions):
+    """
+    Rough estimate of the peak memory of one experiment from its assumptions, so that jobs can request enough memory
     
-    # By default, use the latest transfer to avoid well name conflict
+    The estimate adds up the largest arrays alive at the same time. It does not include memory mapped from a shared species pool only once per node
+    On the rows of benchmarks/simulation.py (up to 384 wells and 2000 species), it is 8% to 19% above the measured peak resident memory, as checked by benchmarks/memory.py. Most of the peak of these rows is the interpreter; larger rows are not covered
+    
+    Return: dictionary of the memory (bytes) of each component and the total
+    """
+    float_size = np.dtype(assumptions["precision"]).itemsize
+    S_tot = int(np.sum(assumptions["SA"]) + assumptions["Sgen"])
+    M_tot = int(np.sum(assumptions["MA"]))
+    n_wells = S_tot if assumptions["monoculture"] else int(assumptions["n_wells"])
+    n_present = min(S_tot, int(assumptions["n_inoc"]))
+    plate_size = float_size * n_wells * (3 * S_tot + 5 * M_tot) # N, prior_N, and the passaged copy; R, R0, prior_R, prior_R0, and the passaged copy
+    if assumptions["sparse_density"] > 0 and n_present <= assumptions["sparse_density"] * S_tot:
+        plate_size = float_size * n_wells * (S_tot + 5 * M_tot) + 2 * (float_size + 4) * n_wells * n_present # N is dense only while it is propagated
+    
+    memory = dict()
+    memory["interpreter"] = 150 * 2**20 # Python, numpy, pandas, and the community-simulator
+    memory["species_parameters"] = float_size * (S_tot * M_tot + M_tot**2 + 4 * S_tot**2) # c, D, and two draws of the smooth and rugged S x S interaction functions
+    memory["plate"] = plate_size
+    memory["phenotype"] = 0
+    if "interaction" in assumptions["selected_function"]:
+        memory["phenotype"] = float_size * 3 * S_tot**2 # Outer product of the composition of one well and its product with the interaction function
+    elif "invader" in assumptions["selected_function"] or "target_resource" in assumptions["selected_function"]:
+        memory["phenotype"] = plate_size # Plate copied to grow the invader or to measure the resources
+    memory["knock_in"] = float_size * S_tot * (3 * S_tot + 5 * M_tot) if assumptions["knock_in"] else 0 # Monoculture plate of every species
+    
+    # Outputs built in one transfer: the long-format composition data.frame (about 150 bytes per row) and the sparse trajectory kept until the end
+    memory["outputs"] = 150 * n_wells * (n_present + 2 * M_tot) if assumptions["save_composition"] else 0
+    if assumptions["save_trajectory"]:
+        memory["outputs"] += 16 * n_wells * n_present * (assumptions["n_transfer"] // assumptions["composition_lograte"] + 1)
+    memory["total"] = sum(memory.values())
+    return memory
+
+def profile_stage(profiler, stage, transfer_loop_index, plate = None):
+    """
+    Record one stage with the profiler, or do nothing if profiler is None
+    """
+    import contextlib
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(stage, transfer_loop_index, plate = plate)
+
+def save_checkpoint(filename, checkpoint):
+    """
+    Save a checkpoint of a running experiment (plate, random states, output writers and transfer) with dill
+    
+    The checkpoint is first written to a temporary file so that a job killed while writing keeps the previous checkpoint
+    """
+    import os
+    import dill as pickle
+    with open(filename + ".tmp", "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(filename + ".tmp", filename)
+
+def load_checkpoint(filename):
+    """
+    Load the checkpoint saved by save_checkpoint(). Return None if there is no checkpoint
+    """
+    import os
+    import dill as pickle
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+def save_plate_snapshot(plate, filename):
+    """
+    Save the N, R, and R0 of a plate in a binary snapshot (npz) that can be read by overwrite_plate
+    """
+    np.savez(filename, N = plate.N.values, R = plate.R.values, R0 = plate.R0.values, wells = np.array(plate.N.columns, dtype = str))
+
+# Code version computed once per process
+code_version_cache = dict()
+
+def code_version():
+    """
+    Hash of the source code of community_selection, so that results of a changed code are not taken as finished
+    """
+    import os
+    import hashlib
+    if "code_version" in code_version_cache:
+        return code_version_cache["code_version"]
+    h = hashlib.sha1()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith(".py"):
+            with open(os.path.join(package_dir, filename), "rb") as f:
+                h.update(filename.encode())
+                h.update(f.read())
+    code_version_cache["code_version"] = h.hexdigest()
+    return code_version_cache["code_version"]
+
+def copy_frame(df):
+    """
+    Copy a data.frame of one dtype. Unlike df.copy(), the values keep their memory layout, so sums over the copy give the same floating point results
+    """
+    if is_sparse_frame(df):
+        return df.copy()
+    return pd.DataFrame(np.asarray(df).copy(order = "K"), index = df.index.copy(), columns = df.columns.copy())
+
+def cast_params(params, dtype):
+    """
+    Cast the floating point arrays and data.frames of the species parameters to dtype
+    
+    params = dictionary, list, or tuple of parameters (e.g. from MakeParams, or the per-capita species function)
+    dtype = "float32" or "float64"
+    
+    Return: parameters of the same structure. Integer arrays and other values are not changed
+    """
+    if isinstance(params, dict):
+        return dict((k, cast_params(v, dtype)) for k, v in params.items())
+    elif isinstance(params, (list, tuple)):
+        return type(params)(cast_params(v, dtype) for v in params)
+    elif isinstance(params, np.ndarray) and np.issubdtype(params.dtype, np.floating):
+        return params.astype(dtype, copy = False)
+    elif isinstance(params, pd.DataFrame) and all([np.issubdtype(x, np.floating) for x in params.dtypes]):
+        return params.astype(dtype, copy = False)
+    else:
+        return params
+
+def set_plate_precision(plate, dtype):
+    """
+    Store the plate, its species parameters, and its per-capita functions in dtype. Propagate() and Passage() keep the plate in dtype (see cast_state)
+    
+    dtype = "float32" or "float64"
+    """
+    for k, v in plate.__dict__.items():
+        if k in ["params", "f1_species_smooth", "f1_species_rugged", "f2_species_smooth", "f2_species_rugged", "knock_in_species_function"]:
+            setattr(plate, k, cast_params(v, dtype))
+    setattr(plate, "dtype", dtype)
+    return cast_state(plate)
+
+def set_plate_sparsity(plate, sparse_density):
+    """
+    Keep N of the plate in a sparse column format while at most a fraction sparse_density of its abundances are non-zero. Propagate() and Passage() switch between the sparse and the dense format (see format_state)
+    
+    sparse_density = between 0 and 1. 1 keeps N sparse at any density
+    """
+    setattr(plate, "sparse_density", sparse_density)
+    return format_state(plate)
+
+def fork_plate(plate):
+    """
+    Copy a plate at the divergence point of experiments sharing a protocol prefix
+    
+    Unlike plate.copy(), arrays and data.frames keep their memory layout, so the forked plate gives the same floating point results as the original plate
+    """
+    import copy
+    def copy_like(x):
+        if isinstance(x, dict):
+            return dict((k, copy_like(v)) for k, v in x.items())
+        elif isinstance(x, np.ndarray) and not x.flags.writeable: # Shared species pool
+            return x
+        elif isinstance(x, np.ndarray):
+            return x.copy(order = "K")
+        elif is_sparse_frame(x):
+            return x.copy()
+        elif isinstance(x, pd.DataFrame) and len(set(x.dtypes)) == 1 and not np.asarray(x).flags.writeable:
+            return x
+        elif isinstance(x, pd.DataFrame) and len(set(x.dtypes)) == 1:
+            return copy_frame(x)
+        else:
+            return copy.deepcopy(x)
+    new_plate = copy.copy(plate)
+    for k, v in plate.__dict__.items():
+        setattr(new_plate, k, copy_like(v))
+    return new_plate
+
+def make_hash(x):
+    """
+    Compute a hash of nested dictionaries, lists, arrays, data.frames and scalars from their content
+    """
+    import hashlib
+    h = hashlib.sha1()
+    def update(x):
+        if isinstance(x, dict):
+            for k in sorted(x.keys(), key = str):
+                h.update(str(k).encode())
+                update(x[k])
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                update(v)
+        elif isinstance(x, (np.ndarray, pd.DataFrame, pd.Series)):
+            values = np.ascontiguousarray(np.asarray(x))
+            h.update(str((values.dtype, values.shape)).encode())
+            h.update(values.tobytes() if values.dtype != object else str(values.tolist()).encode())
+        else:
+            h.update(repr(x).encode())
+    update(x)
+    return h.hexdigest()
+
+def freeze_plate(plate, stock_dir, stock_name, params = None):
+    """
+    Store the plate in a frozen stock library. Like saving a frozen stock at -80C
+    
+    Each stock is a directory stock_dir/stock_name of plain arrays (N, R, R0, and well, species, and resource labels) that can be loaded by memory mapping.
+    The params are saved only once per distinct parameter set, in stock_dir/params/ named by their hash
+    
+    params = parameters of the plate. Default is plate.params
+    
+    The params and the stock are written to temporary paths that replace them at the end, so that a job killed while freezing, or a concurrent reader, never sees a partial stock
+    """
+    import os
+    import json
+    import shutil
+    import dill as pickle
+    if params is None:
+        params = plate.params
+    
+    # Deduplicated params
+    params_hash = make_hash(params)
+    params_filename = os.path.join(stock_dir, "params", params_hash + ".p")
+    if not os.path.isfile(params_filename):
+        os.makedirs(os.path.join(stock_dir, "params"), exist_ok = True)
+        with open(params_filename + ".tmp" + str(os.getpid()), "wb") as f:
+            pickle.dump(params, f)
+        os.replace(params_filename + ".tmp" + str(os.getpid()), params_filename)
+    
+    # Plate arrays
+    stock_path = os.path.join(stock_dir, stock_name)
+    temp_path = os.path.join(stock_dir, "." + stock_name + ".tmp" + str(os.getpid())) # Hidden from list_stocks()
+    if os.path.isdir(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    np.save(os.path.join(temp_path, "N.npy"), np.ascontiguousarray(plate.N.values))
+    np.save(os.path.join(temp_path, "R.npy"), np.ascontiguousarray(plate.R.values))
+    np.save(os.path.join(temp_path, "R0.npy"), np.ascontiguousarray(plate.R0.values))
+    np.save(os.path.join(temp_path, "wells.npy"), np.array(plate.N.columns, dtype = str))
+    np.save(os.path.join(temp_path, "species.npy"), np.array(plate.N.index.get_level_values(-1), dtype = str))
+    np.save(os.path.join(temp_path, "resources.npy"), np.array(plate.R.index.get_level_values(-1), dtype = str))
+    with open(os.path.join(temp_path, "stock.json"), "w") as f:
+        json.dump({"params_hash": params_hash, "n_species": plate.N.shape[0], "n_resources": plate.R.shape[0], "n_wells": plate.N.shape[1]}, f)
+    if os.path.isdir(stock_path): # A directory cannot be replaced by a rename, so the old stock is moved aside first
+        old_path = os.path.join(stock_dir, "." + stock_name + ".old" + str(os.getpid()))
+        os.rename(stock_path, old_path)
+        os.rename(temp_path, stock_path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(temp_path, stock_path)
+
+def is_stock(path):
+    """Check if the path is a frozen stock saved by freeze_plate()"""
+    import os
+    return os.path.isfile(os.path.join(path, "stock.json"))
+
+def thaw_plate(stock_path, mmap = True):
+    """
+    Load a frozen stock saved by freeze_plate()
+    
+    mmap = set True to memory-map the arrays (read-only) instead of reading them into memory
+    
+    Return: dictionary of N, R, R0, wells, species, resources, and params_hash
+    """
+    import os
+    import json
+    with open(os.path.join(stock_path, "stock.json"), "r") as f:
+        stock = json.load(f)
+    mmap_mode = "r" if mmap else None
+    for k in ["N", "R", "R0", "wells", "species", "resources"]:
+        stock[k] = np.load(os.path.join(stock_path, k + ".npy"), mmap_mode = mmap_mode)
+    return stock
+
+def load_stock_params(stock_dir, params_hash):
+    """
+    Load the params of a frozen stock from the stock library
+    """
+    import os
+    import dill as pickle
+    with open(os.path.join(stock_dir, "params", params_hash + ".p"), "rb") as f:
+        return pickle.load(f)
+
+def list_stocks(stock_dir):
+    """
+    List the frozen stocks in the stock library
+    """
+    import os
+    import json
+    stocks = list()
+    for stock_name in sorted(os.listdir(stock_dir)):
+        if not stock_name.startswith(".") and is_stock(os.path.join(stock_dir, stock_name)):
+            with open(os.path.join(stock_dir, stock_name, "stock.json"), "r") as f:
+                stocks.append(dict(stock_name = stock_name, **json.load(f)))
+    return pd.DataFrame(stocks, columns = ["stock_name", "params_hash", "n_species", "n_resources", "n_wells"])
+
+# Columns that do not change the species pool (params and per-capita species function) drawn in prepare_experiment()
+species_pool_independent_columns = ["exp_id", "protocol", "output_dir", "save_function", "save_composition", "save_plate", "save_trajectory", 
+    "function_lograte", "composition_lograte", "composition_format", "checkpoint_interval", "stock_dir", "species_pool_dir", "rng_streams", "profile", "event_log", "output_queue_size", "sparse_density",
+    "overwrite_plate", "passage_overwrite_plate", "n_transfer", "n_transfer_selection", "n_propagation", "dilution"]
+
+def species_pool_key(assumptions):
+    """
+    Hash of the assumptions that determine the species pool of one experiment
+    """
+    return make_hash(dict((k, assumptions[k]) for k in assumptions.keys() if k not in species_pool_independent_columns))
+
+def is_species_pool(path):
+    """Check if the path is a species pool published by publish_species_pool()"""
+    import os
+    return os.path.isfile(os.path.join(path, "pool.p"))
+
+def publish_species_pool(pool_path, species_pool):
+    """
+    Save a species pool as plain arrays that experiments on the same node can memory-map instead of drawing their own copy
+    
+    species_pool = dictionary of params, species_function (tuple of per-capita function arrays), and random_state (global numpy random state after drawing the species function)
+    
+    The pool is written to a temporary directory that is renamed at the end, so concurrent experiments never attach to a partial pool. If another experiment published the same pool first, its copy is kept
+    """
+    import os
+    import shutil
+    import pickle
+    temp_path = pool_path + ".tmp" + str(os.getpid())
+    os.makedirs(temp_path, exist_ok = True)
+    params_meta = dict()
+    for k, v in species_pool["params"].items():
+        if isinstance(v, pd.DataFrame) and len(set(v.dtypes)) == 1:
+            np.save(os.path.join(temp_path, "params_" + k + ".npy"), np.asarray(v))
+            params_meta[k] = ("frame", v.index, v.columns)
+        elif isinstance(v, np.ndarray) and v.dtype != object:
+            np.save(os.path.join(temp_path, "params_" + k + ".npy"), v)
+            params_meta[k] = ("array", None, None)
+        else:
+            params_meta[k] = ("value", v, None)
+    for i, v in enumerate(species_pool["species_function"]):
+        np.save(os.path.join(temp_path, "species_function_" + str(i) + ".npy"), np.asarray(v))
+    with open(os.path.join(temp_path, "pool.p"), "wb") as f:
+        pickle.dump({"params": params_meta, "n_species_function": len(species_pool["species_function"]), "random_state": species_pool["random_state"]}, f)
+    try:
+        os.rename(temp_path, pool_path)
+    except OSError:
+        shutil.rmtree(temp_path) # Published by another experiment
+
+def attach_species_pool(pool_path):
+    """
+    Memory-map a species pool published by publish_species_pool(). The arrays are read-only and shared by all processes attached to the same pool
+    
+    The arrays are plain ndarray views of the memory maps, so plates holding them can still be pickled
+    
+    Return: dictionary of params, species_function, and random_state
+    """
+    import os
+    import pickle
+    with open(os.path.join(pool_path, "pool.p"), "rb") as f:
+        pool_meta = pickle.load(f)
+    def load(filename):
+        return np.asarray(np.load(os.path.join(pool_path, filename), mmap_mode = "r"))
+    params = dict()
+    for k, (kind, index, columns) in pool_meta["params"].items():
+        if kind == "value":
+            params[k] = index
+        elif kind == "array":
+            params[k] = load("params_" + k + ".npy")
+        else:
+            params[k] = pd.DataFrame(load("params_" + k + ".npy"), index = index, columns = columns, copy = False)
+    species_function = tuple(load("species_function_" + str(i) + ".npy") for i in range(pool_meta["n_species_function"]))
+    return {"params": params, "species_function": species_function, "random_state": pool_meta["random_state"]}
+
+def composition_to_arrays(df, n_species, n_resources):
+    """
+    Scatter the long-format composition records (Type, ID, Well, Abundance) into arrays
+    
+    Return: N (n_species x n_wells), R and R0 (n_resources x n_wells), with wells ordered by their number
+    """
+    # Column of each record
+    well_number = df["Well"].str.slice(1).astype(int).values
+    well_list, well_index = np.unique(well_number, return_inverse = True)
+    
+    # Stack consumer, resource and R0 rows so that all records are filled in one scatter
+    type_offset = {"consumer": 0, "resource": n_species, "R0": n_species + n_resources}
+    row_index = df["Type"].map(type_offset).values + df["ID"].values.astype(int)
+    stacked = np.zeros((n_species + 2*n_resources, len(well_list)))
+    stacked[row_index, well_index] = df["Abundance"].values
+    
+    return stacked[:n_species], stacked[n_species:(n_species + n_resources)], stacked[(n_species + n_resources):]
+
+def read_overwrite_plate(filename, n_species, n_resources):
+    """
+    Read the plate used for overwrite_plate. 
+    
+    filename = a composition file (csv or parquet), a plate snapshot (npz) saved by save_plate_snapshot(), or a frozen stock saved by freeze_plate()
+    
+    Return: N, R, and R0 arrays. By default only the latest transfer of a composition file is used to avoid well name conflict
+    """
+    if is_stock(filename):
+        stock = thaw_plate(filename, mmap = True)
+        assert stock["n_species"] == n_species and stock["n_resources"] == n_resources, "The frozen stock does not have the same species and resources as the current plate"
+        return stock["N"], stock["R"], stock["R0"]
+    if filename.endswith(".npz"):
+        with np.load(filename) as snapshot:
+            N, R, R0 = snapshot["N"], snapshot["R"], snapshot["R0"]
+        assert N.shape[0] == n_species and R.shape[0] == n_resources, "The plate snapshot does not have the same species and resources as the current plate"
+        return N, R, R0
+    
+    # Read the input data file
+    if filename.rstrip("/").endswith(".parquet"):
+        df = pd.read_parquet(filename, columns = ["Transfer", "Type", "ID", "Well", "Abundance"])
+        df = df.astype({"Type": str, "Well": str})
+    else:
+        df = pd.read_csv(filename, usecols = ["Transfer", "Type", "ID", "Well", "Abundance"])
     df = df[df.Transfer == np.max(df.Transfer)]
+    
+    # Check if the input file type has consumer, resurce and R0
+    assert all(pd.Series(df["Type"].unique()).isin(["consumer", "resource", "R0"])), "overwrite_plate must have three types of rows: consumer, resource, R0"
+    
+    return composition_to_arrays(df, n_species, n_resources)
+
+def overwrite_plate(plate, assumptions):
+    """ 
+    Overwrite the plate N, R, and R0 dataframe by the input composition file or plate snapshot
+    """
+    import os
+    assert(os.path.exists(assumptions['overwrite_plate'])), "The overwrite_plate does not exist"
+    N, R, R0 = read_overwrite_plate(assumptions["overwrite_plate"], plate.N.shape[0], plate.R.shape[0])
 
     # If only one community, repeat filling this community into n_wells wells
-    if len(df["Well"].unique()) == 1:
-        print("The overwrite plate has only one community (well). Replicate it to the number of wells in current plate")
-        temp_df = df.copy()
-        df = pd.concat([temp_df.assign(Well = "W" + str(i)) for i in range(assumptions["n_wells"])])
+    if N.shape[1] == 1:
+        emit_event("overwrite_plate", "The overwrite plate has only one community (well). Replicate it to the number of wells in current plate", exp_id = assumptions["exp_id"])
+        N, R, R0 = [np.repeat(x, assumptions["n_wells"], axis = 1) for x in [N, R, R0]]
     # Else if n_wells does not conform to the number of wells in the overwrite_plate, overwrite it
     else:
-        assumptions["n_wells"] = len(df["Well"].unique())
-    # If the input overwrite file has multiple communities, check if it has the same number as n_wells
-    #assert len(df["Well"].unique()) == assumptions["n_wells"], "overwrite_plate does not have the same number of wells as n_wells"
-    # Check if the input file type has consumer, resurce and R0
-    assert all(pd.Series(df["Type"].unique()).isin(["consumer", "resource", "R0"])), "overwrite_plate must have three types of rows: consumer, resource, R0"
-    # Make empty dataframes
-    N = plate.N.copy()
-    R = plate.R.copy()
-    R0 = plate.R.copy()
-    # N0
-    for w in range(assumptions["n_wells"]):
-        temp_comm = df[(df["Well"] == ("W" + str(w))) & (df["Type"] == "consumer")][["ID", "Abundance"]]
-        temp = np.zeros(N.shape[0])
-        for i in range(temp_comm.shape[0]):
-            temp[int(temp_comm.iloc[i]["ID"])] = temp_comm.iloc[i]["Abundance"]
-            N["W" + str(w)] = temp
-
-    # R
-    for w in range(assumptions["n_wells"]):
-        temp_res = df[(df["Well"] == ("W" + str(w))) & (df["Type"] == "resource")][["ID", "Abundance"]]
-        temp = np.zeros(R.shape[0])
-        for i in range(temp_res.shape[0]):
-            temp[int(temp_res.iloc[i]["ID"])] = temp_res.iloc[i]["Abundance"]
-            R["W" + str(w)] = temp
-    # R0
-    for w in range(assumptions["n_wells"]):
-        temp_R0 = df[(df["Well"] == ("W" + str(w))) & (df["Type"] == "R0")][["ID", "Abundance"]]
-        temp = np.zeros(R0.shape[0])
-        for i in range(temp_R0.shape[0]):
-            temp[int(temp_R0.iloc[i]["ID"])] = temp_R0.iloc[i]["Abundance"]
-            R0["W" + str(w)] = temp
-    plate.N = N
-    plate.N0 = N
-    plate.R = R
-    plate.R0 = R0
+        assumptions["n_wells"] = N.shape[1]
+    
+    # Make dataframes. Arrays are copied so that a memory-mapped stock is not modified
+    N, R, R0 = [np.array(x) for x in [N, R, R0]]
+    well_names = ["W" + str(w) for w in range(assumptions["n_wells"])]
+    plate.N = pd.DataFrame(N, index = plate.N.index, columns = well_names)
+    plate.N0 = plate.N
+    plate.R = pd.DataFrame(R, index = plate.R.index, columns = well_names)
+    plate.R0 = pd.DataFrame(R0, index = plate.R.index, columns = well_names)
+    if getattr(plate, "rng", None) is not None:
+        plate.rng["passage"] = make_rng_streams(assumptions["seed"], assumptions["n_wells"])["passage"] # One passage stream per well of the overwrite plate
     
     # Passaage the overwrite plate
     if assumptions["passage_overwrite_plate"]:
@@ -5,6 +5,7 @@ Created on Nov 26 2019
 @author: changyuchang
 """
 import numpy as np
+from community_selection import get_rng, is_sparse_frame, sparse_matrix, dense_frame
 
 def f1_additive(plate, params_simulation):
     """
@@ -13,6 +14,8 @@ def f1_additive(plate, params_simulation):
     plate = plate object from package
     k = an 1-D array of saturation factors. set k = np.zeros(n) for binary function (species presence or absense)
     """
+    if is_sparse_frame(plate.N): # Sum over the non-zero abundances only
+        return sparse_matrix(plate.N).T.dot(plate.f1_species_smooth)
     
     community_function = np.sum(plate.N.values * plate.f1_species_smooth[:,None], axis = 0)
     
@@ -22,6 +25,8 @@ def f1a_additive(plate, params_simulation):
     """
     Additive community function (F1) with ruggedness
     """
+    if is_sparse_frame(plate.N): # Sum over the non-zero abundances only
+        return sparse_matrix(plate.N).T.dot(plate.f1_species_rugged)
     
     community_function = np.sum(plate.N.values * plate.f1_species_rugged[:,None], axis = 0)
     
@@ -42,9 +47,10 @@ def f2_interaction(plate, params_simulation):
     #additive_term = np.sum(plate.N.values * plate.f1_species_smooth[:,None], axis = 0)
     
     # Interaction term
-    interaction_term = np.zeros(plate.N.shape[1])
-    for i in range(plate.N.shape[1]): # For each community
-        community_composition = np.array(plate.N.iloc[:,i]).reshape(S_tot, 1)
+    N = np.asarray(plate.N)
+    interaction_term = np.zeros(N.shape[1])
+    for i in range(N.shape[1]): # For each community
+        community_composition = N[:,i].reshape(S_tot, 1)
         community_composition_square = np.multiply(community_composition, community_composition.reshape(1, S_tot))
         interaction_term[i] = np.sum(community_composition_square * plate.f2_species_smooth)
 
@@ -65,9 +71,10 @@ def f2a_interaction(plate, params_simulation):
     #additive_term = np.sum(plate.N.values * plate.f1_species_smooth[:,None], axis = 0)
     
     # Interaction term
-    interaction_term = np.zeros(plate.N.shape[1])
-    for i in range(plate.N.shape[1]): # For each community
-        community_composition = np.array(plate.N.iloc[:,i]).reshape(S_tot, 1)
+    N = np.asarray(plate.N)
+    interaction_term = np.zeros(N.shape[1])
+    for i in range(N.shape[1]): # For each community
+        community_composition = N[:,i].reshape(S_tot, 1)
         community_composition_square = np.multiply(community_composition, community_composition.reshape(1, S_tot))
         interaction_term[i] = np.sum(community_composition_square * plate.f2_species_rugged)
 
@@ -81,11 +88,10 @@ def f3_additive_binary(plate, params_simulation):
     species_function = a n by n 2-D array; n is the size of species pool
     """
     # Binary function using type III response
-    plate_temp = plate.copy()
     n = 10; Sm = 1
-    plate_temp.N = plate_temp.N / params_simulation["binary_threshold"]
-    plate_temp.N = plate_temp.N**n / (1 + plate_temp.N**n/Sm) 
-    community_function = np.sum(plate_temp.N.values * plate_temp.species_function[:,None], axis = 0)
+    N = np.asarray(plate.N) / params_simulation["binary_threshold"]
+    N = N**n / (1 + N**n/Sm) 
+    community_function = np.sum(N * plate.species_function[:,None], axis = 0)
 
     return community_function
 
@@ -102,20 +108,19 @@ def f4_interaction_binary(plate, params_simulation):
     S_tot = plate.N.shape[0]
 
     # Binary function using type III response
-    plate_temp = plate.copy()
     n = 10; Sm = 1
-    plate_temp.N = plate_temp.N / params_simulation["binary_threshold"]
-    plate_temp.N = plate_temp.N**n / (1 + plate_temp.N**n/Sm) 
+    N = np.asarray(plate.N) / params_simulation["binary_threshold"]
+    N = N**n / (1 + N**n/Sm) 
     
     # Additive term
-    additive_term = np.sum(plate_temp.N.values * plate_temp.species_function[:,None], axis = 0)
+    additive_term = np.sum(N * plate.species_function[:,None], axis = 0)
     
     # Interaction term
-    interaction_term = np.zeros(plate_temp.N.shape[1])
-    for i in range(plate_temp.N.shape[1]): # For each community
-        community_composition = np.array(plate_temp.N.iloc[:,i]).reshape(S_tot, 1)
+    interaction_term = np.zeros(N.shape[1])
+    for i in range(N.shape[1]): # For each community
+        community_composition = N[:,i].reshape(S_tot, 1)
         community_composition_square = np.multiply(community_composition, community_composition.reshape(1, S_tot))
-        interaction_term[i] = np.sum(community_composition_square * plate_temp.interaction_function)
+        interaction_term[i] = np.sum(community_composition_square * plate.interaction_function)
     
     return additive_term + interaction_term
 
@@ -130,6 +135,7 @@ def f5_invader_suppression(plate, params_simulation):
     n_wells = plate.N.shape[1]
     plate_test = plate.copy()
     plate_test.Passage(params_simulation['dilution']*np.eye(params_simulation['n_wells']))
+    plate_test.N = dense_frame(plate_test.N)
     plate_test.N.iloc[params_simulation["invader_index"],:] = plate_test.N.iloc[params_simulation["invader_index"],:] + 10 / params_simulation['scale']
     plate_test.Propagate(params_simulation["n_propagation"])
     invader_growth_together = plate_test.N.iloc[params_simulation["invader_index"],:]
@@ -143,7 +149,7 @@ def f6_target_resource(plate, params_simulation):
     If rich medium is provided, the target resource amount in the initial plate is set to 0
     """
     target_resource_index = plate.target_resource
-    community_function_temp = plate.R.iloc[target_resource_index,:].tolist()
+    community_function_temp = np.asarray(plate.R)[target_resource_index,:].tolist()
     community_function = [-i for i in community_function_temp]
     return community_function
     
@@ -154,7 +160,7 @@ def f6a_target_resource(plate, params_simulation):
     If rich medium is provided, the target resource amount in the initial plate is set to 0
     """
     target_resource_index = plate.target_resource
-    community_function = plate.R.iloc[target_resource_index,:].tolist()
+    community_function = np.asarray(plate.R)[target_resource_index,:].tolist()
     
     return community_function
 
@@ -169,5 +175,5 @@ def resource_distance_community_function(plate, R_target, sigma = 0.01): # Sigma
     relative_resource[0,:]  = 0.0 #Set supplied resource to 0
     relative_resource = relative_resource/relative_resource.sum(0)  #Look at relative abundance of remaining resource
     R_dist = np.sqrt(np.sum(np.array((np.tile(R_target,(well_tot,1)) - relative_resource.T)**2)[:,1:],axis=1))
-    return (np.array(R_dist.T)* -1) * (1+ np.random.normal(0,sigma,well_tot))#(so we select for positive community function)
+    return (np.array(R_dist.T)* -1) * (1+ get_rng(plate, "function").normal(0,sigma,well_tot))#(so we select for positive community function)
 
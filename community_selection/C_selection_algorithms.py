@@ -33,10 +33,10 @@ for i in [10, 15, 16, 20, 25, 28, 30, 33, 40, 50, 60]:
 
 
 ## Select top n% control
-def temp_select_top_control(community_function, p):
+def temp_select_top_control(community_function, p, rng = np.random):
     n_wells = len(community_function)
     randomized_community_function = community_function.copy()
-    np.random.shuffle(randomized_community_function)
+    rng.shuffle(randomized_community_function)
     sorted_community_function = np.sort(randomized_community_function)
     cut_off = sorted_community_function[int(np.floor(len(randomized_community_function)*(1-p)))]
     winner_index = np.where(randomized_community_function >= cut_off)[0][::-1] 
@@ -65,10 +65,10 @@ for i in [10, 15, 16, 20, 25, 28, 30, 33, 40, 50, 60]:
     globals()['pool_top%spercent' %i] = partial(temp_pool_top, p = i/100)
 
 ## Pooling control
-def temp_pool_top_control(community_function, p):
+def temp_pool_top_control(community_function, p, rng = np.random):
     n_wells = len(community_function)
     randomized_community_function = community_function.copy()
-    np.random.shuffle(randomized_community_function)
+    rng.shuffle(randomized_community_function)
     sorted_community_function = np.sort(randomized_community_function)
     cut_off = sorted_community_function[int(np.floor(len(randomized_community_function)*(1-p)))]
     winner_index = np.where(randomized_community_function >= cut_off)[0][::-1] 
@@ -98,7 +98,7 @@ def Arora2019(community_function, n_rep = 3):
     return transfer_matrix
     
     
-def Arora2019_control(community_function, n_rep = 3):
+def Arora2019_control(community_function, n_rep = 3, rng = np.random):
     """
   	Same as Arora2019 except the line member is selected at Random
     """
@@ -108,10 +108,10 @@ def Arora2019_control(community_function, n_rep = 3):
     for i in range(n_lines):
   	    sorted_community_function = np.sort(community_function[i*n_rep:(i*n_rep)+n_rep])
   	    cut_off = np.max(sorted_community_function)
-  	    winner_index = np.random.randint(0,n_rep)
+  	    winner_index = rng.choice(n_rep)
   	    if winner_index+i*n_rep >= n_wells:
   	    	  corrected_n_rep  = n_wells % n_rep
-  	    	  winner_index = np.random.randint(0,corrected_n_rep)
+  	    	  winner_index = rng.choice(corrected_n_rep)
   	    transfer_matrix[i*n_rep:(i*n_rep)+n_rep, winner_index+i*n_rep] = 1
     return transfer_matrix
     
@@ -133,7 +133,7 @@ def Raynaud2019a(community_function, n_lines = 3):
     return transfer_matrix
 
 
-def Raynaud2019a_control(community_function, n_lines = 3):
+def Raynaud2019a_control(community_function, n_lines = 3, rng = np.random):
     """
 	Same as Raynaud2019a except the lineage member is selected at Random
     """
@@ -143,10 +143,10 @@ def Raynaud2019a_control(community_function, n_lines = 3):
     for i in range(n_lines):
 	    sorted_community_function = np.sort(community_function[i*n_rep:(i*n_rep)+n_rep])
 	    cut_off = np.max(sorted_community_function)
-	    winner_index = np.random.randint(0,n_rep)
+	    winner_index = rng.choice(n_rep)
 	    if winner_index+i*n_rep >= n_wells:
 	    	  corrected_n_rep  = n_wells % n_rep
-	    	  winner_index = np.random.randint(0,corrected_n_rep)
+	    	  winner_index = rng.choice(corrected_n_rep)
 	    transfer_matrix[i*n_rep:(i*n_rep)+n_rep, winner_index+i*n_rep] = 1
     return transfer_matrix
 
@@ -166,7 +166,7 @@ def Raynaud2019b(community_function, n_lines = 3):
     return transfer_matrix
 
 
-def Raynaud2019b_control(community_function, n_lines = 3):
+def Raynaud2019b_control(community_function, n_lines = 3, rng = np.random):
     """
 	Same as Raynaud2019b except the lineage member is selected at Random
     """
@@ -176,10 +176,10 @@ def Raynaud2019b_control(community_function, n_lines = 3):
     for i in range(n_lines):
 	    sorted_community_function = np.sort(community_function[i*n_rep:(i*n_rep)+n_rep])
 	    cut_off = np.max(sorted_community_function)
-	    winner_index = np.random.randint(0,n_rep)
+	    winner_index = rng.choice(n_rep)
 	    if winner_index+i*n_rep >= n_wells:
 	    	  corrected_n_rep  = n_wells % n_rep
-	    	  winner_index = np.random.randint(0,corrected_n_rep)
+	    	  winner_index = rng.choice(corrected_n_rep)
 	    transfer_matrix[:, winner_index+i*n_rep] = 1
     return transfer_matrix
 
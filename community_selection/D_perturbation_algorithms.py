@@ -6,6 +6,7 @@ Created on Nov 27 2019
 """
 import numpy as np
 import random
+import pandas as pd
 from community_selection.A_experiment_functions import *
 
 def resource_perturb(plate, params_simulation, keep):
@@ -41,28 +42,39 @@ def resource_perturb(plate, params_simulation, keep):
         else: #default_resource_swap
             metabolite_choice = [(x,y) for x in old_R0.index for y in old_R0.index if x !=y and x != target_resource and y != target_resource]
 
-    #next randomly pick element in list and apply pertubation 
-    for k in plate.R0.columns:
-        if k != plate.R0.columns[keep]:
+    #next randomly pick element in list and apply pertubation (on the array of R0; resources are picked by name and looked up by position)
+    R0 = np.asarray(plate.R0).copy(order = "K")
+    old_R0_values = np.array(old_R0)
+    resource_position = {x: i for i, x in enumerate(plate.R0.index)}
+    for k in range(R0.shape[1]):
+        if k != keep:
             #So first default to kept media
-            plate.R0[k] = old_R0
+            R0[:,k] = old_R0_values
             if len(metabolite_choice) ==0: #If all possible pertubations have been carried out skip
                 continue
             #Pick random pertubation
-            r_id = random.choice(metabolite_choice)
+            if getattr(plate, "rng", None) is None:
+                r_id = random.choice(metabolite_choice)
+            else:
+                r_id = metabolite_choice[get_rng(plate, "perturbation").choice(len(metabolite_choice))]
             #perform pertubations
             if params_simulation['r_type']  == 'rescale_add': 
-                plate.R0[k][r_id] = plate.R0[k][r_id]*(1+params_simulation['r_percent'])
+                i = resource_position[r_id]
+                R0[i,k] = R0[i,k]*(1+params_simulation['r_percent'])
             elif params_simulation['r_type'] == 'rescale_remove':
-                plate.R0[k][r_id] = plate.R0[k][r_id]*(1-params_simulation['r_percent']) 
+                i = resource_position[r_id]
+                R0[i,k] = R0[i,k]*(1-params_simulation['r_percent']) 
             elif params_simulation['r_type'] == 'old':
-                plate.R0[k] = plate.R0[k] * (1-params_simulation['R_percent']) #Dilute old resource
-                plate.R0[k][r_id] = plate.R0[k][r_id] + (params_simulation['R0_food']*params_simulation['R_percent']) #Add fixed percent
+                i = resource_position[r_id]
+                R0[:,k] = R0[:,k] * (1-params_simulation['R_percent']) #Dilute old resource
+                R0[i,k] = R0[i,k] + (params_simulation['R0_food']*params_simulation['R_percent']) #Add fixed percent
             else:
-                plate.R0[k][r_id[0]] = plate.R0[k][r_id[0]] + (plate.R0[k][r_id[1]]*params_simulation['r_percent']) #add new resources
-                plate.R0[k][r_id[1]] = plate.R0[k][r_id[1]]*(1-params_simulation['r_percent']) #remove new resources
+                i, j = resource_position[r_id[0]], resource_position[r_id[1]]
+                R0[i,k] = R0[i,k] + (R0[j,k]*params_simulation['r_percent']) #add new resources
+                R0[j,k] = R0[j,k]*(1-params_simulation['r_percent']) #remove new resources
             # Remove chosen pertubation as option for subsequent loop
             metabolite_choice = [x for x in metabolite_choice if x != r_id]
+    plate.R0 = pd.DataFrame(R0, index = plate.R0.index, columns = plate.R0.columns)
     plate.R0 = plate.R0/np.sum(plate.R0)*params_simulation['R0_food'] #Keep this to avoid floating point error and rescale when neeeded.
     #add new fresh environment (so that this round uses R0
     plate.R = plate.R + plate.R0
@@ -73,7 +85,10 @@ def perturb(plate, params_simulation, keep):
     """
     Perturbs all communities except for the one specified by the argument keep. Default is the first well so keep = 0
     Only runs if directed selection is true
+    
+    A plate in the sparse column format is perturbed in the dense format. The next Propagate() or Passage() switches it back
     """
+    plate.N = dense_frame(plate.N)
     #Bottleneck
     if params_simulation['bottleneck']:
         dilution_matrix = np.eye(params_simulation['n_wells'])*params_simulation['bottleneck_size'] 
@@ -81,28 +96,33 @@ def perturb(plate, params_simulation, keep):
         old_R = plate.R.copy()
         plate.Passage(dilution_matrix)
         plate.R = old_R.copy()  #knock_in isolates absent from all communities
+    #knock_in and knock_out edit one copy of the abundance array, wrapped back into plate.N once
+    if params_simulation['knock_in'] or params_simulation['knock_out']:
+        N = np.asarray(plate.N).copy(order = "K")
     if params_simulation['knock_in']:
-        knock_in_list = np.where(np.logical_and(np.array(np.sum(plate.N,axis=1)==0.0), plate.knock_in_species_function >= np.percentile(plate.knock_in_species_function, q = 100*params_simulation['knock_in_threshold'])))[0]
+        knock_in_list = np.where(np.logical_and(np.sum(N,axis=1)==0.0, plate.knock_in_species_function >= np.percentile(plate.knock_in_species_function, q = 100*params_simulation['knock_in_threshold'])))[0]
         # If f5, avoid using invader
         if "invader" in params_simulation["selected_function"]:
             knock_in_list[params_simulation["invader_index"]] = False
-        for k in plate.N.columns:
-            if k == plate.N.columns[keep] or len(knock_in_list) ==0.0:
+        for k in range(N.shape[1]):
+            if k == keep or len(knock_in_list) ==0.0:
                 continue
             else:
-                s_id = np.random.choice(knock_in_list) 
-                plate.N[k][s_id]= 1/params_simulation["dilution"] * 1/params_simulation["scale"] #Knock in enough to survive 1 dilution even with no growth
+                s_id = get_rng(plate, "perturbation").choice(knock_in_list) 
+                N[s_id,k]= 1/params_simulation["dilution"] * 1/params_simulation["scale"] #Knock in enough to survive 1 dilution even with no growth
                 knock_in_list = knock_in_list[knock_in_list != s_id] 
     #knock_out isolates present in all communities
     if params_simulation['knock_out']:
-        knock_out_list = np.where(np.sum(plate.N>0.0,axis=1) == params_simulation['n_wells'])[0]
-        for k in plate.N.columns:
-            if k == plate.N.columns[keep] or len(knock_out_list) ==0.0:
+        knock_out_list = np.where(np.sum(N>0.0,axis=1) == params_simulation['n_wells'])[0]
+        for k in range(N.shape[1]):
+            if k == keep or len(knock_out_list) ==0.0:
                 continue
             else:
-                s_id = np.random.choice(knock_out_list) 
-                plate.N[k][s_id]= 0
+                s_id = get_rng(plate, "perturbation").choice(knock_out_list) 
+                N[s_id,k]= 0
                 knock_out_list = knock_out_list[knock_out_list != s_id] 
+    if params_simulation['knock_in'] or params_simulation['knock_out']:
+        plate.N = pd.DataFrame(N, index = plate.N.index, columns = plate.N.columns)
     #Migrate taxa into the best performing community. By default migrations are done using power law model but can tune the diversity of migration using s_migration
     if params_simulation['migration']:
         migration_factor = np.ones(params_simulation['n_wells'])
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run many rows of a mapping file in one process pool
+"""
+import os
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+# Mapping file read once by each worker process
+worker_input = dict()
+
+# Columns that only change the wells of one experiment and not the species parameters. Rows that differ only in these columns can be stacked in one batched propagation
+# n_wells is not included because the number of wells changes the random draws of the species parameters in prepare_experiment()
+stack_separable_columns = ["exp_id", "protocol", "dilution", "n_inoc"]
+
+def estimate_experiment_cost(row_dat):
+    """
+    Rough relative cost of one experiment (row of the mapping file)
+    
+    The cost is proportional to the number of species-resource updates during propagation, plus the S x S interaction term for interaction functions
+    """
+    S_tot = int(row_dat["sn"]) * int(row_dat["sf"]) + int(row_dat["Sgen"])
+    M_tot = int(row_dat["rn"]) * int(row_dat["rf"])
+    if str(row_dat["monoculture"]).lower() == "true":
+        n_wells = S_tot
+    else:
+        n_wells = int(float(row_dat["n_wells"]))
+    n_transfer = int(row_dat["n_transfer"])
+    cost = n_wells * n_transfer * float(row_dat["n_propagation"]) * S_tot * M_tot
+    if "interaction" in str(row_dat["selected_function"]):
+        cost = cost + n_wells * n_transfer * S_tot**2
+    return cost
+
+def init_batch_worker(input_csv, quiet, group_mode = None):
+    """
+    Read the mapping file index once per worker process
+    """
+    from community_selection.usertools import read_mapping_file
+    worker_input["input_csv"] = input_csv
+    worker_input["group_mode"] = group_mode
+    worker_input["mapping"] = read_mapping_file(input_csv)
+    worker_input["quiet"] = quiet
+
+@contextlib.contextmanager
+def worker_output():
+    """
+    Discard the printed progress of the rows run inside the context if the batch is quiet. Errors are still reported in the row status
+    """
+    if not worker_input["quiet"]:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def run_batch_row(row):
+    """
+    Run one row in a worker process and report its status
+    """
+    from community_selection.usertools import run_experiment
+    start_time = time.time()
+    status = {"row": row, "exp_id": worker_input["mapping"]["rows"][row]["exp_id"], "status": "finished", "start_time": start_time, "elapsed": np.nan, "error": ""}
+    try:
+        with worker_output():
+            run_experiment(worker_input["input_csv"], row, force = True) # Finished rows are skipped by run_batch()
+    except BaseException as e: # Also catch the SystemExit raised by a failed phenotype test
+        status.update({"status": "failed", "error": repr(e)})
+    status["elapsed"] = time.time() - start_time
+    return status
+
+def shared_prefix_key(assumptions):
+    """
+    Hash of the assumptions of one experiment except the protocol and exp_id. Rows with the same key start from the same plate and differ only in their protocol schedule
+    """
+    from community_selection.A_experiment_functions import make_hash
+    return make_hash(dict((k, assumptions[k]) for k in assumptions.keys() if k not in ["protocol", "exp_id"]))
+
+def simulate_shared_prefix(assumptions_list):
+    """
+    Simulate several experiments that differ only in protocol and exp_id, running each shared prefix of their protocol schedules once
+    
+    assumptions_list = list of assumptions dictionaries returned by make_assumptions(). They must share the same shared_prefix_key
+    
+    The schedules of the experiments form a trie of (community phenotype, selection algorithm) stages. The plate and the random states are forked where the schedules diverge, so the outputs of each experiment are the same as those of simulate_community() on its own. Checkpoints are not saved in this mode
+    
+    Return: list of plates after the last transfer, one for each experiment
+    """
+    from community_selection import usertools
+    from community_selection.usertools import prepare_experiment, make_algorithms, make_output_writers, write_outputs, emit_event
+    key_list = [shared_prefix_key(assumptions) for assumptions in assumptions_list]
+    assert len(set(key_list)) == 1, "The experiments differ in assumptions other than protocol and exp_id"
+    
+    exp_ids = [assumptions["exp_id"] for assumptions in assumptions_list]
+    emit_event("experiment_started", "Starting " + ", ".join(exp_ids) + " with shared prefix", exp_id = exp_ids, n_transfer = assumptions_list[0]["n_transfer"])
+    params, params_simulation, params_algorithm, plate = prepare_experiment(assumptions_list[0])
+    algorithms = make_algorithms(params_simulation)
+    
+    # Protocol schedule of each experiment: one growth and one passage stage per transfer
+    experiments = list()
+    for n, assumptions in enumerate(assumptions_list):
+        temp_params_simulation = dict(params_simulation, protocol = assumptions["protocol"], exp_id = assumptions["exp_id"])
+        temp_params_algorithm = algorithms[algorithms["algorithm_name"] == assumptions["protocol"]]
+        stages = list()
+        for i in range(params_simulation["n_transfer"]):
+            stages.append(("grow", list(temp_params_algorithm["community_phenotype"])[i]))
+            stages.append(("passage", list(temp_params_algorithm["selection_algorithm"])[i]))
+        experiments.append({"index": n, "params_simulation": temp_params_simulation, "stages": stages})
+    
+    # Test the community function
+    phenotype_algorithm = experiments[0]["stages"][0][1]
+    getattr(usertools, phenotype_algorithm)(plate, params_simulation = params_simulation)
+    try:
+        community_function = getattr(usertools, phenotype_algorithm)(plate, params_simulation = params_simulation) # Community phenotype
+    except:
+        emit_event("phenotype_test_failed", 'Community phenotype test failed', level = "warning", exp_id = exp_ids)
+        raise SystemExit
+    
+    # Save the inocula composition and the initial community function + richness + biomass
+    for experiment in experiments:
+        experiment["writers"] = make_output_writers(experiment["params_simulation"], plate)
+        write_outputs(experiment["writers"], experiment["params_simulation"], plate, community_function, transfer_loop_index = 0)
+    
+    emit_event("propagation_started", "Start propogation", exp_id = exp_ids)
+    plate_list = [None for assumptions in assumptions_list]
+    run_shared_stages(plate, community_function, experiments, 0, plate_list)
+    return plate_list
+
+def run_shared_stages(plate, community_function, experiments, k, plate_list):
+    """
+    Run the stages from stage k onward for a group of experiments that share all stages before k. Fork the plate and the random states where the stages diverge
+    """
+    import random
+    from community_selection import usertools
+    from community_selection.usertools import write_outputs, close_output_writers, passage_plate, fork_plate, emit_event
+    params_simulation = experiments[0]["params_simulation"]
+    n_stage = len(experiments[0]["stages"])
+    while k < n_stage:
+        # Fork at the divergence point
+        branches = dict()
+        for experiment in experiments:
+            branches.setdefault(experiment["stages"][k], []).append(experiment)
+        if len(branches) > 1:
+            np_random_state = np.random.get_state()
+            random_state = random.getstate()
+            branch_list = list(branches.values())
+            for j, branch in enumerate(branch_list):
+                np.random.set_state(np_random_state)
+                random.setstate(random_state)
+                branch_plate = plate if j == len(branch_list) - 1 else fork_plate(plate) # The last branch reuses the plate
+                run_shared_stages(branch_plate, community_function, branch, k, plate_list)
+            return
+        
+        stage, algorithm = experiments[0]["stages"][k]
+        i = k // 2
+        if stage == "grow":
+            # Propagation
+            plate.Propagate(params_simulation["n_propagation"])
+            
+            # Measure Community phenotype
+            community_function = getattr(usertools, algorithm)(plate, params_simulation = params_simulation) # Community phenotype
+            for experiment in experiments:
+                write_outputs(experiment["writers"], experiment["params_simulation"], plate, community_function, transfer_loop_index = i+1)
+        else:
+            # Passage, transfer matrix and perturbation
+            plate = passage_plate(plate, params_simulation, community_function, algorithm)
+            exp_ids = [experiment["params_simulation"]["exp_id"] for experiment in experiments]
+            emit_event("transfer", "Transfer " + str(i+1) + " (" + ", ".join(exp_ids) + ")", exp_id = exp_ids, transfer = i+1, n_transfer = params_simulation["n_transfer"])
+        k = k + 1
+    
+    for experiment in experiments:
+        close_output_writers(experiment["writers"])
+        plate_list[experiment["index"]] = plate
+        emit_event("experiment_finished", experiment["params_simulation"]["exp_id"] + " finished", exp_id = experiment["params_simulation"]["exp_id"])
+
+def run_shared_rows(input_csv, rows):
+    """
+    Run rows of the mapping file that share their protocol prefix (see shared_prefix_key), and save their plates
+    
+    Return: list of assumptions
+    """
+    from community_selection.usertools import make_assumptions, save_plate, start_experiment_manifest, write_experiment_manifest, open_event_logs
+    assumptions_list = [make_assumptions(input_csv, row) for row in rows]
+    hash_list = [start_experiment_manifest(assumptions) for assumptions in assumptions_list]
+    with open_event_logs(assumptions_list):
+        plate_list = simulate_shared_prefix(assumptions_list)
+    for assumptions, assumptions_hash, plate in zip(assumptions_list, hash_list, plate_list):
+        save_plate(assumptions, plate)
+        write_experiment_manifest(assumptions, assumptions_hash)
+    return assumptions_list
+
+def stack_key(assumptions):
+    """
+    Hash of the assumptions of one experiment except the stack_separable_columns. Rows with the same key have the same species parameters and can be stacked in one batched propagation
+    """
+    from community_selection.A_experiment_functions import make_hash
+    return make_hash(dict((k, assumptions[k]) for k in assumptions.keys() if k not in stack_separable_columns))
+
+def batch_key(assumptions):
+    """
+    Hash of the assumptions of one experiment except the stack_separable_columns and the seed. Rows with the same key have plates of the same size and the same dynamics, and can be propagated together as blocks with their own species parameters
+    """
+    from community_selection.A_experiment_functions import make_hash
+    return make_hash(dict((k, assumptions[k]) for k in assumptions.keys() if k not in stack_separable_columns + ["seed"]))
+
+def group_rows(input_csv, rows, key_function = shared_prefix_key):
+    """
+    Group the rows of a mapping file that have the same key
+    
+    key_function = shared_prefix_key for rows that can share their protocol prefix (see simulate_shared_prefix), or stack_key for rows that can be stacked in one batched propagation (see simulate_batched)
+    
+    Return: list of lists of rows
+    """
+    from community_selection.usertools import make_assumptions
+    groups = dict()
+    for row in rows:
+        key = key_function(make_assumptions(input_csv, row))
+        groups.setdefault(key, []).append(row)
+    return list(groups.values())
+
+@contextlib.contextmanager
+def experiment_random_state(experiment):
+    """
+    Switch the global random states (numpy and random) to those of one experiment of a batch inside the context, and save them back to the experiment after
+    """
+    import random
+    np.random.set_state(experiment["np_random_state"])
+    random.setstate(experiment["random_state"])
+    try:
+        yield
+    finally:
+        experiment["np_random_state"] = np.random.get_state()
+        experiment["random_state"] = random.getstate()
+
+def simulate_batched(assumptions_list):
+    """
+    Simulate several experiments whose plates are propagated together in one batched integration (see propagate_plates)
+    
+    assumptions_list = list of assumptions dictionaries returned by make_assumptions(). They must share the same batch_key, and may differ in seed and in the stack_separable_columns
+    
+    The plates of experiments with the same stack_key share one copy of the species parameters. Experiments with different seeds are blocks with their own c, D, g, ... in the batched dynamics.
+    Each experiment keeps its own plate, outputs and events, and its own global random states, which are saved after prepare_experiment() and switched in around its community phenotype, selection, passage, and perturbation (see experiment_random_state). Its random draws are thus those of the experiment run on its own.
+    The propagation is a Dormand-Prince integration of all wells (see integrate_wells) instead of the per-well integration of community-simulator, so the outputs match those of simulate_community() within the integration tolerance. Checkpoints are not saved in this mode
+    
+    Return: list of plates after the last transfer, one for each experiment
+    """
+    import random
+    from community_selection import usertools
+    from community_selection.usertools import prepare_experiment, make_output_writers, write_outputs, close_output_writers, passage_plate, emit_event
+    from community_selection.A_experiment_functions import propagate_plates, make_hash
+    assert len(set([batch_key(assumptions) for assumptions in assumptions_list])) == 1, "The experiments differ in assumptions other than seed, " + ", ".join(stack_separable_columns)
+    
+    exp_ids = [assumptions["exp_id"] for assumptions in assumptions_list]
+    emit_event("experiment_started", "Starting " + ", ".join(exp_ids) + " in one batched propagation", exp_id = exp_ids, n_transfer = assumptions_list[0]["n_transfer"])
+    experiments = list()
+    for assumptions in assumptions_list:
+        params, params_simulation, params_algorithm, plate = prepare_experiment(assumptions)
+        experiments.append({"params_simulation": params_simulation, "params_algorithm": params_algorithm, "plate": plate, "np_random_state": np.random.get_state(), "random_state": random.getstate()})
+    
+    # Stacked plates share one parameter dictionary
+    if len(set([stack_key(assumptions) for assumptions in assumptions_list])) == 1:
+        assert len(set([make_hash(experiment["plate"].params) for experiment in experiments])) == 1, "The stacked plates have different species parameters"
+        for experiment in experiments:
+            experiment["plate"].params = experiments[0]["plate"].params
+    
+    for experiment in experiments:
+        params_simulation, params_algorithm, plate = experiment["params_simulation"], experiment["params_algorithm"], experiment["plate"]
+        with experiment_random_state(experiment):
+            # Test the community function
+            getattr(usertools, params_algorithm["community_phenotype"][0])(plate, params_simulation = params_simulation)
+            try:
+                community_function = getattr(usertools, params_algorithm["community_phenotype"][0])(plate, params_simulation = params_simulation) # Community phenotype
+            except:
+                emit_event("phenotype_test_failed", 'Community phenotype test failed', level = "warning", exp_id = params_simulation["exp_id"])
+                raise SystemExit
+        
+        # Save the inocula composition and the initial community function + richness + biomass
+        experiment["writers"] = make_output_writers(params_simulation, plate)
+        write_outputs(experiment["writers"], params_simulation, plate, community_function, transfer_loop_index = 0)
+    
+    emit_event("propagation_started", "Start propogation", exp_id = exp_ids)
+    n_transfer = experiments[0]["params_simulation"]["n_transfer"]
+    try:
+        for i in range(n_transfer):
+            # Propagation of all plates in one integration
+            propagate_plates([experiment["plate"] for experiment in experiments], experiments[0]["params_simulation"]["n_propagation"], assumptions_list[0])
+            
+            for experiment in experiments:
+                params_simulation, params_algorithm, plate = experiment["params_simulation"], experiment["params_algorithm"], experiment["plate"]
+                with experiment_random_state(experiment):
+                    # Measure Community phenotype
+                    community_function = getattr(usertools, params_algorithm["community_phenotype"][i])(plate, params_simulation = params_simulation) # Community phenotype
+                    
+                    # Append the composition and function to the output files
+                    write_outputs(experiment["writers"], params_simulation, plate, community_function, transfer_loop_index = i+1)
+                    
+                    # Passage, transfer matrix and perturbation
+                    experiment["plate"] = passage_plate(plate, params_simulation, community_function, params_algorithm["selection_algorithm"][i])
+                emit_event("transfer", "Transfer " + str(i+1), exp_id = params_simulation["exp_id"], transfer = i+1, n_transfer = n_transfer)
+    finally:
+        for experiment in experiments:
+            close_output_writers(experiment["writers"])
+    
+    for experiment in experiments:
+        emit_event("experiment_finished", experiment["params_simulation"]["exp_id"] + " finished", exp_id = experiment["params_simulation"]["exp_id"])
+    return [experiment["plate"] for experiment in experiments]
+
+def run_batched_assumptions(assumptions_list):
+    """
+    Run experiments in one batched propagation (see simulate_batched), and save their plates and manifests
+    
+    Return: list of assumptions
+    """
+    from community_selection.usertools import save_plate, start_experiment_manifest, write_experiment_manifest, open_event_logs
+    hash_list = [start_experiment_manifest(assumptions) for assumptions in assumptions_list]
+    with open_event_logs(assumptions_list):
+        plate_list = simulate_batched(assumptions_list)
+    for assumptions, assumptions_hash, plate in zip(assumptions_list, hash_list, plate_list):
+        save_plate(assumptions, plate)
+        write_experiment_manifest(assumptions, assumptions_hash)
+    return assumptions_list
+
+def run_stacked_rows(input_csv, rows):
+    """
+    Run rows of the mapping file with the same stack_key in one batched propagation (see simulate_batched), and save their plates
+    
+    Return: list of assumptions
+    """
+    from community_selection.usertools import make_assumptions
+    return run_batched_assumptions([make_assumptions(input_csv, row) for row in rows])
+
+def make_ensemble(assumptions, seeds):
+    """
+    Make the assumptions of replicate experiments that differ only in seed. The exp_id of each replicate is <exp_id>_seed<seed>
+    
+    Return: list of assumptions dictionaries
+    """
+    assumptions_list = list()
+    for seed in seeds:
+        assumptions_list.append(dict(assumptions, seed = seed, exp_id = str(assumptions["exp_id"]) + "_seed" + str(seed)))
+    return assumptions_list
+
+def run_ensemble(input_file, row, seeds):
+    """
+    Run replicates of one row of the mapping file with the given seeds (see make_ensemble) in one batched propagation, and save their plates
+    
+    Each replicate is a block of the batched dynamics with the species parameters (c, D, g, ...) of its seed, and the plates of all replicates are integrated together (see simulate_batched). The outputs of each replicate are written under its own exp_id
+    
+    Return: list of assumptions
+    """
+    from community_selection.usertools import make_assumptions
+    return run_batched_assumptions(make_ensemble(make_assumptions(input_file, row), seeds))
+
+def run_batch_group(rows):
+    """
+    Run a group of rows together in a worker process and report the status of each row
+    """
+    start_time = time.time()
+    status_list = [{"row": row, "exp_id": worker_input["mapping"]["rows"][row]["exp_id"], "status": "finished", "start_time": start_time, "elapsed": np.nan, "error": ""} for row in rows]
+    try:
+        with worker_output():
+            if worker_input["group_mode"] == "stack":
+                run_stacked_rows(worker_input["input_csv"], rows)
+            else:
+                run_shared_rows(worker_input["input_csv"], rows)
+    except BaseException as e: # Also catch the SystemExit raised by a failed phenotype test
+        for status in status_list:
+            status.update({"status": "failed", "error": repr(e)})
+    for status in status_list:
+        status["elapsed"] = time.time() - start_time
+    return status_list
+
+def run_batch(input_csv, rows, n_processes = None, manifest_file = None, quiet = True, share_prefix = False, stack = False, force = False):
+    """
+    Run the rows of a mapping file in a local process pool
+    
+    input_csv = mapping file
+    rows = list of rows (0-based) to run
+    n_processes = number of worker processes. Default is the number of CPUs
+    manifest_file = csv file to which the status of each row is appended as soon as the row finishes. Default is input_csv with suffix _manifest.csv
+    quiet = set True to silence the printed progress of the workers
+    share_prefix = set True to run the rows that differ only in protocol and exp_id together, simulating their shared protocol prefix once (see simulate_shared_prefix)
+    stack = set True to run the rows that differ only in the stack_separable_columns together, propagating their plates in one batched integration (see simulate_batched)
+    force = set True to also run the rows whose results are already finished (see is_experiment_finished)
+    
+    Rows are dispatched from the most to the least expensive (see estimate_experiment_cost) so that long rows do not end up last
+    
+    Return: data.frame of row status
+    """
+    if manifest_file is None:
+        manifest_file = os.path.splitext(input_csv)[0] + "_manifest.csv"
+    from community_selection.usertools import read_mapping_file, make_assumptions, is_experiment_finished, emit_event
+    mapping = read_mapping_file(input_csv)
+    rows = list(rows)
+    n_rows = len(rows)
+    cost = dict((row, estimate_experiment_cost(mapping["rows"][row])) for row in rows)
+    status_list = list()
+    def append_status(status):
+        status["cost"] = cost[status["row"]]
+        status_df = pd.DataFrame([status], columns = ["row", "exp_id", "status", "cost", "start_time", "elapsed", "error"])
+        status_df.to_csv(manifest_file, mode = "a", header = not os.path.isfile(manifest_file), index = False)
+        status_list.append(status_df)
+        emit_event("row_status", "Row " + str(status["row"]) + " " + status["status"] + " (" + str(len(status_list)) + "/" + str(n_rows) + ")", level = "warning" if status["status"] == "failed" else "info",
+                   row = status["row"], exp_id = status["exp_id"], status = status["status"], n_finished = len(status_list), n_rows = n_rows, elapsed = status["elapsed"], error = status["error"])
+    
+    # Skip the rows already finished
+    if not force:
+        for row in list(rows):
+            if is_experiment_finished(make_assumptions(input_csv, row)):
+                append_status({"row": row, "exp_id": mapping["rows"][row]["exp_id"], "status": "skipped", "start_time": time.time(), "elapsed": 0, "error": ""})
+                rows.remove(row)
+    if len(rows) == 0:
+        return pd.concat(status_list)
+    assert not (share_prefix and stack), "share_prefix and stack cannot be used together"
+    if share_prefix:
+        groups = group_rows(input_csv, rows, key_function = shared_prefix_key)
+        group_mode = "share_prefix"
+    elif stack:
+        groups = group_rows(input_csv, rows, key_function = stack_key)
+        group_mode = "stack"
+    else:
+        groups = [[row] for row in rows]
+        group_mode = None
+    groups = sorted(groups, key = lambda group: -max([cost[row] for row in group]))
+    
+    emit_event("batch_started", "Running " + str(len(rows)) + " rows of " + input_csv + " in " + str(len(groups)) + " groups", input_csv = input_csv, n_rows = len(rows), n_groups = len(groups))
+    with Pool(n_processes, initializer = init_batch_worker, initargs = (input_csv, quiet, group_mode)) as pool:
+        if group_mode is not None:
+            group_status = pool.imap_unordered(run_batch_group, groups)
+        else:
+            group_status = ([status] for status in pool.imap_unordered(run_batch_row, [group[0] for group in groups]))
+        for status_group in group_status:
+            for status in status_group:
+                append_status(status)
+    
+    return pd.concat(status_list)
@@ -6,14 +6,127 @@
 from __future__ import division
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import copy
-import community_selection
-from multiprocessing import Pool
-from functools import partial
 
 from community_simulator import Community
 
+def get_rng(plate, stream, well = None):
+    """
+    Random generator of one subsystem of the experiment on this plate
+    
+    stream = "sampling", "passage", "selection", "perturbation", or "function"
+    well = well index, for the per-well passage streams
+    
+    Plates made with rng_streams = True carry their own numpy Generators (see make_rng_streams). Otherwise the global numpy random state is returned
+    """
+    rng = getattr(plate, "rng", None)
+    if rng is None:
+        return np.random
+    if well is None:
+        return rng[stream]
+    return rng[stream][well]
+
+def cast_state(plate, dtype = None):
+    """
+    Store N, R and R0 of the plate in a floating point dtype
+    
+    dtype = "float32" or "float64". None for the dtype of the plate, if any (see set_plate_precision)
+    
+    Plates without a dtype are left as they are. Data.frames already in dtype are not rebuilt
+    """
+    if dtype is None:
+        dtype = getattr(plate, "dtype", None)
+    if dtype is None:
+        return plate
+    plate.N = cast_frame(plate.N, pd.SparseDtype(dtype, 0) if is_sparse_frame(plate.N) else np.dtype(dtype))
+    plate.R = cast_frame(plate.R, np.dtype(dtype))
+    plate.R0 = cast_frame(plate.R0, np.dtype(dtype))
+    return plate
+
+def cast_frame(df, dtype):
+    """
+    Data.frame in dtype. The data.frame is returned as it is if all its columns are already in dtype
+    """
+    if all([x == dtype for x in df.dtypes]):
+        return df
+    return df.astype(dtype, copy = False)
+
+def is_sparse_frame(df):
+    """
+    Whether all columns of a data.frame are in the sparse column format (pandas sparse columns)
+    """
+    return isinstance(df, pd.DataFrame) and df.shape[1] > 0 and all([isinstance(x, pd.SparseDtype) for x in df.dtypes])
+
+def sparse_matrix(df):
+    """
+    Compressed sparse column matrix (scipy) of a data.frame in the sparse column format, with sorted row indices
+    """
+    matrix = df.sparse.to_coo().tocsc()
+    matrix.sort_indices()
+    return matrix
+
+def dense_frame(df):
+    """
+    Dense data.frame of a data.frame in the sparse column format. Dense data.frames are returned as they are
+    """
+    if not is_sparse_frame(df):
+        return df
+    return pd.DataFrame(sparse_matrix(df).toarray(), index = df.index, columns = df.columns)
+
+def format_state(plate):
+    """
+    Keep N of the plate in the sparse column format while the fraction of non-zero abundances is at most plate.sparse_density, and dense otherwise
+    
+    Plates without sparse_density (see set_plate_sparsity) are left as they are
+    """
+    threshold = getattr(plate, "sparse_density", None)
+    if threshold is None:
+        return plate
+    if is_sparse_frame(plate.N):
+        if plate.N.sparse.density > threshold:
+            plate.N = dense_frame(plate.N)
+    else:
+        import scipy.sparse
+        values = np.asarray(plate.N)
+        if np.count_nonzero(values) <= threshold * values.size:
+            plate.N = pd.DataFrame.sparse.from_spmatrix(scipy.sparse.csc_matrix(values), index = plate.N.index, columns = plate.N.columns)
+    return plate
+
+def passage_sparse(plate, f, scale):
+    """
+    Multinomial sampling of the passage of N in the sparse column format. Only the non-zero abundances of each old well are visited
+    
+    The random draws are the same as in the dense sampling: species with zero abundance draw nothing, and the last species of the pool closes each multinomial draw
+    
+    Return: the new N in the sparse column format
+    """
+    import scipy.sparse
+    N = sparse_matrix(plate.N)
+    N.data[N.data < 0] = 0 #Remove any negative values that may have crept in
+    data = N.data.astype(float, copy = False) # Sampled in double precision
+    N_tot = np.bincount(np.repeat(np.arange(N.shape[1]), np.diff(N.indptr)), weights = data, minlength = N.shape[1])
+    S_tot = N.shape[0]
+    
+    column = np.zeros(S_tot)
+    indptr, indices, values = [0], list(), list()
+    for k in range(plate.n_wells):
+        rng = get_rng(plate, "passage", k)
+        species_list = list()
+        for j in np.nonzero((f[k,:] > 0) & (N_tot > 0))[0]:
+            species = N.indices[N.indptr[j]:N.indptr[j+1]]
+            N_relative = data[N.indptr[j]:N.indptr[j+1]] / N_tot[j]
+            if species[-1] != S_tot - 1:
+                species, N_relative = np.append(species, S_tot - 1), np.append(N_relative, 0)
+            column[species] += rng.multinomial(rng.poisson(scale*N_tot[j]*f[k,j]),N_relative)*1./scale
+            species_list.append(species)
+        species = np.unique(np.concatenate(species_list)) if len(species_list) > 0 else np.zeros(0, dtype = int)
+        indices.append(species[column[species] != 0])
+        values.append(column[indices[-1]])
+        indptr.append(indptr[-1] + len(indices[-1]))
+        column[species] = 0
+    
+    N_new = scipy.sparse.csc_matrix((np.concatenate(values + [np.zeros(0)]), np.concatenate(indices + [np.zeros(0, dtype = int)]), indptr), shape = (S_tot, plate.n_wells))
+    return pd.DataFrame.sparse.from_spmatrix(N_new, index = plate.N.index, columns = plate.N.columns)
+
 class Metacommunity(Community):
     """
     Inherited object from community-simulator package. 
@@ -21,8 +134,27 @@ class Metacommunity(Community):
     Changes:
     
     - Passage are Possion distributed
+    - Passage draws from the per-well random streams of the plate, if any (see get_rng)
+    - Passage works on the arrays of N and R, and only visits the non-zero entries of the transfer matrix
+    - Single-precision plates (see cast_state) are propagated and sampled in double precision, and stored back in single precision
+    - N can be kept in a sparse column format (see format_state). Passage samples it natively; Propagate integrates the dense wells and switches back
+    
+    N, R and R0 stay data.frames, since community-simulator and user functions index them by label. Hot loops read their arrays (np.asarray or .values) once and wrap the result in a data.frame once
     
     """
+    def Propagate(self, *args, **kwargs):
+        """
+        Propagate the plate with community-simulator, and store N and R back in the dtype of the plate
+        
+        A dense plate in float64 is not converted: only a sparse N is made dense before and sparse again after, and only the data.frames community-simulator returns in float64 are cast to a float32 plate
+        """
+        self.N = dense_frame(self.N) # community-simulator integrates dense wells
+        result = Community.Propagate(self, *args, **kwargs)
+        cast_state(self)
+        format_state(self)
+        return result
+    
+
     def Passage(self,f,scale=None,refresh_resource=True):
         """
         Transfer cells to a fresh plate.
@@ -42,21 +174,26 @@ class Metacommunity(Community):
         if scale == None:
             scale = self.scale #Use scale from initialization by default
         f = np.asarray(f) #Allow for f to be a dataframe
-        self.N[self.N<0] = 0 #Remove any negative values that may have crept in
         self.R[self.R<0] = 0
         
-        #DEFINE NEW VARIABLES
-        N_tot = np.sum(self.N)
-        R_tot = np.sum(self.R)
-        N = np.zeros(np.shape(self.N))
-        
-        #MULTINOMIAL SAMPLING
-        #(simulate transfering a finite fraction of a discrete collection of cells)
-        for k in range(self.n_wells):
-            for j in range(self.n_wells):
-                if f[k,j] > 0 and N_tot[j] > 0:
-                    N[:,k] += np.random.multinomial(np.random.poisson(scale*N_tot[j]*f[k,j]),(self.N/N_tot).values[:,j])*1./scale  
-        self.N = pd.DataFrame(N, index = self.N.index, columns = self.N.keys())
+        if is_sparse_frame(self.N):
+            self.N = passage_sparse(self, f, scale)
+        else:
+            self.N[self.N<0] = 0 #Remove any negative values that may have crept in
+            
+            #DEFINE NEW VARIABLES
+            N_tot = np.sum(self.N.astype(float, copy = False)) # Sampled in double precision, so that the relative abundances sum to 1
+            N_relative = (self.N/N_tot).values # Relative abundances in each old well, computed once
+            N_tot = N_tot.values
+            N = np.zeros(np.shape(self.N))
+            
+            #MULTINOMIAL SAMPLING
+            #(simulate transfering a finite fraction of a discrete collection of cells)
+            for k in range(self.n_wells):
+                rng = get_rng(self, "passage", k)
+                for j in np.nonzero((f[k,:] > 0) & (N_tot > 0))[0]:
+                    N[:,k] += rng.multinomial(rng.poisson(scale*N_tot[j]*f[k,j]),N_relative[:,j])*1./scale  
+            self.N = pd.DataFrame(N, index = self.N.index, columns = self.N.keys())
         
         #In batch culture, there is no need to do multinomial sampling on the resources,
         #since they are externally replenished before they cause numerical problems
@@ -67,10 +204,14 @@ class Metacommunity(Community):
         #In continuous culture, it is useful to eliminate the resources that are
         #going extinct, to avoid numerical instability
         else:
-            R_tot = np.sum(self.R)
+            R_tot = np.sum(self.R.astype(float, copy = False))
+            R_relative = (self.R/R_tot).values
+            R_tot = R_tot.values
             R = np.zeros(np.shape(self.R))
             for k in range(self.n_wells):
-                for j in range(self.n_wells):
-                    if f[k,j] > 0 and R_tot[j] > 0:
-                        R[:,k] += np.random.multinomial(int(scale*R_tot[j]*f[k,j]),(self.R/R_tot).values[:,j])*1./scale
+                rng = get_rng(self, "passage", k)
+                for j in np.nonzero((f[k,:] > 0) & (R_tot > 0))[0]:
+                    R[:,k] += rng.multinomial(int(scale*R_tot[j]*f[k,j]),R_relative[:,j])*1./scale
             self.R = pd.DataFrame(R, index = self.R.index, columns = self.R.keys())
+        cast_state(self)
+        format_state(self)
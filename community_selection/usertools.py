@@ -4,6 +4,10 @@
 Created on Mar 09 2020
 @author: changyuchang
 """
+import os
+import time
+import inspect
+import threading
 import numpy as np
 import pandas as pd
 from community_selection.A_experiment_functions import *
@@ -13,12 +17,15 @@ from community_selection.D_perturbation_algorithms import *
 from community_selection.E_protocols import *
 
 
+# Plotting libraries are imported only when a plot is made, so that simulations do not load them
+
 def plot_community_function(function_df):
     """Plot community function"""
     function_df.plot.scatter(x = "Transfer", y = "CommunityPhenotype")
 
 def plot_transfer_matrix(transfer_matrix):
     """Plot transfer matrix"""
+    import matplotlib.pyplot as plt
     import seaborn as sns
     fig,ax=plt.subplots()
     sns.heatmap(transfer_matrix,ax=ax)
@@ -27,16 +34,192 @@ def plot_transfer_matrix(transfer_matrix):
     ax.set_title(r'Transfer Matrix',fontsize=14)
     plt.show()
 
+# Default values of the parameters that are not in a_default but are set by MakeParams
+params_default = {'m': 1, 'w': 1, 'g': 1, 'l': 0, 'tau': 1, 'r': 1, 'sigma_max': 1, 'nreg': 10, 'n': 2}
+
+# Types of the mapping file columns. Columns not listed here are numeric
+mapping_string_columns = ["selected_function", "protocol", "exp_id", "overwrite_plate", "output_dir", "metacommunity_sampling", "phi_distribution", 
+    "cost_distribution", "invader_sampling", "r_type", "sampling", "sampling_D", "response", "regulation", "supply", "composition_format", "stock_dir", "species_pool_dir", "profile", "event_log", "precision"]
+mapping_boolean_columns = ["passage_overwrite_plate", "save_function", "save_composition", "save_plate", "rich_medium", "monoculture", 
+    "directed_selection", "knock_out", "knock_in", "bottleneck", "migration", "coalescence", "resource_shift", "save_trajectory", "rng_streams"]
+mapping_required_columns = ["selected_function", "protocol", "seed", "exp_id", "sn", "sf", "Sgen", "rn", "rf", "sampling_D", 
+    "fss", "fsa", "fsw", "fas", "faa", "faw", "fws", "fwa", "fww"]
+
+# Mapping file indices already loaded in this process
+mapping_index_cache = dict()
+
+# Held while the species pool and the plate are drawn from the global random state seeded by seed, so that experiments prepared in threads of one process do not interleave their draws
+global_random_lock = threading.Lock()
+
+def type_mapping_value(column, value):
+    """
+    Convert a text cell of the mapping file to the type of its column. NA cells stay 'NA'
+    
+    Cells that pandas has already typed (columns without NA) are kept as they are
+    """
+    if not isinstance(value, str) or value == 'NA' or column in mapping_string_columns:
+        return value
+    if column in mapping_boolean_columns:
+        assert value.lower() in ["true", "false"], "Column " + column + " must be True or False, not " + value
+        return value.lower() == "true"
+    try:
+        number = float(value)
+    except ValueError:
+        return value # Extra text columns not in the schema
+    return int(number) if number.is_integer() and "." not in value and "e" not in value.lower() else number
+
+def mapping_schema_hash():
+    """
+    Hash of the column types and the required columns used to compile mapping files. Indices compiled with another schema are rebuilt
+    """
+    return make_hash([mapping_string_columns, mapping_boolean_columns, mapping_required_columns])
+
+def mapping_file_hash(input_file):
+    """
+    SHA-1 hash of the content of a mapping file
+    """
+    import hashlib
+    file_hash = hashlib.sha1()
+    with open(input_file, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def compile_mapping_file(input_file):
+    """
+    Parse and validate the mapping file into an index of typed rows
+    
+    Return: dictionary of the file hash, the schema hash, the columns and their dtypes, and a list of row dictionaries
+    """
+    file_hash = mapping_file_hash(input_file)
+    df = pd.read_csv(input_file, keep_default_na=False)
+    missing_columns = [k for k in mapping_required_columns if k not in df.columns]
+    assert len(missing_columns) == 0, "The mapping file does not have the columns " + ", ".join(missing_columns)
+    rows = list()
+    for i in range(df.shape[0]):
+        row_dat = df.iloc[i]
+        rows.append(dict((k, type_mapping_value(k, row_dat[k])) for k in df.columns))
+    return {"hash": file_hash, "schema": mapping_schema_hash(), "columns": list(df.columns), "dtypes": dict((k, str(df[k].dtype)) for k in df.columns), "rows": rows}
+
+class MappingRows(object):
+    """
+    Rows of a mapping index file. Each row is parsed from its byte offset when it is first used, so loading one row does not read the whole index
+    """
+    def __init__(self, index_file, offsets, dtypes):
+        self.index_file = index_file
+        self.offsets = offsets
+        self.dtypes = dtypes
+        self.rows = dict()
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def __getitem__(self, row):
+        import json
+        row = range(len(self.offsets))[row] # Negative rows and IndexError as for a list
+        if row not in self.rows:
+            with open(self.index_file, "rb") as f:
+                f.seek(self.offsets[row])
+                row_dat = json.loads(f.readline())
+            for k, dtype in self.dtypes.items():
+                if dtype != "object": # Cells that pandas typed are restored to their numpy type
+                    row_dat[k] = np.dtype(dtype).type(row_dat[k])
+            self.rows[row] = row_dat
+        return self.rows[row]
+
+def write_mapping_index(index_file, mapping_index, file_stat):
+    """
+    Write the compiled index of a mapping file as JSON lines: a header, then one line per row
+    
+    The header holds the hash, the size and the modification time of the mapping file, the schema hash, the columns and their dtypes, and the byte offset of each row after the header
+    """
+    import json
+    row_lines = [(json.dumps(dict((k, v.item() if isinstance(v, np.generic) else v) for k, v in row_dat.items())) + "\n").encode() for row_dat in mapping_index["rows"]]
+    header = dict((k, mapping_index[k]) for k in ["hash", "schema", "columns", "dtypes"])
+    header.update({"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "offsets": [int(x) for x in np.cumsum([0] + [len(x) for x in row_lines])[:-1]]})
+    with open(index_file + "." + str(os.getpid()), "wb") as f: # Write to a temporary file first so that concurrent jobs do not read a partial index
+        f.write((json.dumps(header) + "\n").encode())
+        f.writelines(row_lines)
+    os.replace(index_file + "." + str(os.getpid()), index_file)
+
+def read_mapping_index(index_file, file_stat, input_file):
+    """
+    Read the header of the index file of a mapping file
+    
+    The index is valid if it has the current schema and was built from a mapping file of the same size and modification time, so the mapping file itself is not read.
+    If only the modification time differs (for example after a copy that does not keep it), the mapping file is hashed and the index is kept if the hash matches. Its header then records the new modification time
+    
+    Return: the mapping index with lazily read rows (see MappingRows), or None if there is no valid index
+    """
+    import json
+    try:
+        with open(index_file, "rb") as f:
+            header = json.loads(f.readline())
+            header_size = f.tell()
+    except (OSError, ValueError):
+        return None
+    if not isinstance(header, dict) or header.get("schema") != mapping_schema_hash():
+        return None
+    if header.get("size") != file_stat.st_size:
+        return None
+    if header.get("mtime_ns") != file_stat.st_mtime_ns:
+        if header.get("hash") != mapping_file_hash(input_file):
+            return None
+        header["mtime_ns"] = file_stat.st_mtime_ns
+        try:
+            with open(index_file, "rb") as f:
+                f.seek(header_size)
+                row_lines = f.read()
+            with open(index_file + "." + str(os.getpid()), "wb") as f:
+                f.write((json.dumps(header) + "\n").encode())
+                new_header_size = f.tell()
+                f.write(row_lines)
+            os.replace(index_file + "." + str(os.getpid()), index_file)
+            header_size = new_header_size
+        except OSError:
+            pass # The directory of the mapping file is read-only. The row offsets are relative to the end of the header, which is then unchanged
+    offsets = [header_size + x for x in header["offsets"]]
+    return {"hash": header["hash"], "schema": header["schema"], "columns": header["columns"], "dtypes": header["dtypes"], "rows": MappingRows(index_file, offsets, header["dtypes"])}
+
+def read_mapping_file(input_file):
+    """
+    Read the compiled index of the mapping file. 
+    
+    The index is built once and stored next to the mapping file (input_file + ".index", see write_mapping_index). It is rebuilt when the mapping file or the schema (see mapping_schema_hash) change
+    """
+    input_file = os.path.abspath(input_file)
+    file_stat = os.stat(input_file)
+    
+    # Index already loaded in this process
+    if input_file in mapping_index_cache and mapping_index_cache[input_file][0] == (file_stat.st_mtime_ns, file_stat.st_size):
+        return mapping_index_cache[input_file][1]
+    
+    # Index stored next to the mapping file
+    index_file = input_file + ".index"
+    mapping_index = read_mapping_index(index_file, file_stat, input_file)
+    if mapping_index is None:
+        mapping_index = compile_mapping_file(input_file)
+        try:
+            write_mapping_index(index_file, mapping_index, file_stat)
+        except OSError:
+            pass # The directory of the mapping file is read-only
+    
+    mapping_index_cache[input_file] = ((file_stat.st_mtime_ns, file_stat.st_size), mapping_index)
+    return mapping_index
+
 def make_assumptions(input_file, row):
-    '''  Generate the assumptions dictionary from input file and row of input file '''
+    '''  Generate the assumptions dictionary from input file (or its data.frame read with keep_default_na=False) and row of input file '''
     #Load row dat and default assumptions
-    row_dat = pd.read_csv(input_file, keep_default_na=False).iloc[row]
+    if isinstance(input_file, pd.DataFrame):
+        row_dat = input_file.iloc[row]
+        row_dat = dict((k, type_mapping_value(k, row_dat[k])) for k in row_dat.keys())
+    else:
+        row_dat = read_mapping_file(input_file)["rows"][row]
     assumptions = a_default.copy()
     # load parameters used for make Params
     assumptions.update({'SA' :row_dat['sn']*np.ones(row_dat['sf'])  }) #Number of consumers in each Specialist family
     assumptions.update({'MA' :row_dat['rn']*np.ones(row_dat['rf'])  }) #Number of resources in each class
     assumptions.update({"sampling_D": row_dat["sampling_D"], "fss": row_dat["fss"], "fsa": row_dat["fsa"], "fsw": row_dat["fsw"], "fas": row_dat["fas"], "faa": row_dat["faa"], "faw": row_dat["faw"], "fws": row_dat["fws"], "fwa": row_dat["fwa"], "fww": row_dat["fww"]})
-    original_params = MakeParams(assumptions.copy())
     #Update assumptions based on row_dat
     for k in row_dat.keys():
         #if NA default to original value 
@@ -44,11 +227,11 @@ def make_assumptions(input_file, row):
             assumptions.update({k :row_dat[k]})
         elif k in assumptions.keys() and row_dat[k] == 'NA' :
             continue
-        #some params for who we wan't to resort to there default value are not stored in assumptions but are generated by MakeParams
-        elif k not in assumptions.keys() and k in original_params.keys() and row_dat[k] != 'NA':
+        #some params for who we wan't to resort to there default value are not stored in assumptions but are set by MakeParams
+        elif k not in assumptions.keys() and k in params_default.keys() and row_dat[k] != 'NA':
             assumptions.update({k :row_dat[k]})
-        elif k not in assumptions.keys() and k  in original_params.keys() and row_dat[k] == 'NA':
-            assumptions.update({k:original_params[k]})
+        elif k not in assumptions.keys() and k  in params_default.keys() and row_dat[k] == 'NA':
+            assumptions.update({k:params_default[k]})
         else:
             if row_dat[k] != 'NA':
                 assumptions.update({k :row_dat[k]})
@@ -109,11 +292,12 @@ def make_assumptions(input_file, row):
             
     # Overwrite plate
     if isinstance(assumptions["overwrite_plate"], str) and assumptions["overwrite_plate"] != "": 
-        print("\nUpdating the n_wells with overwrite_plate")
-        df = pd.read_csv(assumptions["overwrite_plate"])
-        df = df[df.Transfer == np.max(df.Transfer)]
-        if len(df["Well"].unique()) != 1:
-            assumptions["n_wells"] = len(df["Well"].unique())
+        emit_event("overwrite_plate", "Updating the n_wells with overwrite_plate", exp_id = assumptions["exp_id"])
+        S_tot = int(np.sum(assumptions["SA"]) + assumptions["Sgen"])
+        M_tot = int(np.sum(assumptions["MA"]))
+        N_overwrite = read_overwrite_plate(assumptions["overwrite_plate"], S_tot, M_tot)[0]
+        if N_overwrite.shape[1] != 1:
+            assumptions["n_wells"] = N_overwrite.shape[1]
     
     if np.isnan(assumptions["ruggedness"]):
         assumptions["ruggedness"] = 0
@@ -126,6 +310,9 @@ def make_assumptions(input_file, row):
         else:
             assumptions["target_resource"] = int(assumptions["target_resource"])
     
+    # Optional parameters not in the mapping file
+    assumptions = add_optional_assumptions(assumptions)
+    
     return assumptions
 
 def prepare_experiment(assumptions):
@@ -134,34 +321,68 @@ def prepare_experiment(assumptions):
     
     assumptions = dictionary of metaparameters
     
+    The species pool and the plate are drawn from the global random state seeded by seed, under global_random_lock
+    
     Return: params, params_simulation, params_algorithm,plate
     """
-    print("\nGenerate species parameters")
-    np.random.seed(assumptions['seed']) 
-    params = MakeParams(assumptions) 
-    if assumptions["selected_function"] == "f5_invader_suppression":
-        print("\nDraw invader feature")
-        params = create_invader(params, assumptions)
-    print(params["c"])
-    
-    print("\nDraw per-capita function and cost")
-    f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
-    params.update({"f1_species_smooth": f1_species_smooth, "f1_species_rugged": f1_species_rugged, "f2_species_smooth": f2_species_smooth, "f2_species_rugged": f2_species_rugged})
-    gi = draw_species_cost(f1_species_smooth, assumptions)
-    params.update({"g": gi})
-    
-    print("\nConstruct plate")
-    np.random.seed(assumptions['seed']) 
-    plate = make_plate(assumptions,params)
+    assumptions = add_optional_assumptions(assumptions)
+    assert assumptions["precision"] in ["float64", "float32"], "precision must be float64 or float32"
+    
+    # Species pool shared by the experiments on this node
+    species_pool = None
+    if not pd.isnull(assumptions["species_pool_dir"]):
+        species_pool_path = os.path.join(assumptions["species_pool_dir"], species_pool_key(assumptions))
+        if is_species_pool(species_pool_path):
+            emit_event("species_pool", "Attach the shared species pool " + species_pool_path, exp_id = assumptions["exp_id"], path = species_pool_path)
+            species_pool = attach_species_pool(species_pool_path)
+    
+    with global_random_lock: # The species pool draws from the global random state also with rng_streams = True
+        if species_pool is not None:
+            params = species_pool["params"]
+        else:
+            emit_event("prepare", "Generate species parameters", exp_id = assumptions["exp_id"])
+            np.random.seed(assumptions['seed']) 
+            params = MakeParams(assumptions) 
+            if assumptions["selected_function"] == "f5_invader_suppression":
+                emit_event("prepare", "Draw invader feature", exp_id = assumptions["exp_id"])
+                params = create_invader(params, assumptions)
         
-    print("\nAdd community function to plate")
-    plate = add_community_function(plate, assumptions, params)
+            emit_event("prepare", "Draw per-capita function and cost", exp_id = assumptions["exp_id"])
+            f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
+            params.update({"f1_species_smooth": f1_species_smooth, "f1_species_rugged": f1_species_rugged, "f2_species_smooth": f2_species_smooth, "f2_species_rugged": f2_species_rugged})
+            gi = draw_species_cost(f1_species_smooth, assumptions)
+            params.update({"g": gi})
+            if assumptions["precision"] != "float64":
+                params = cast_params(params, assumptions["precision"])
+        
+            if not pd.isnull(assumptions["species_pool_dir"]):
+                emit_event("species_pool", "Publish the shared species pool " + species_pool_path, exp_id = assumptions["exp_id"], path = species_pool_path)
+                np.random.seed(assumptions['seed']) 
+                species_function = draw_species_function(assumptions) # Same draws as in add_community_function()
+                if assumptions["precision"] != "float64":
+                    species_function = cast_params(species_function, assumptions["precision"])
+                os.makedirs(assumptions["species_pool_dir"], exist_ok = True)
+                publish_species_pool(species_pool_path, {"params": params, "species_function": species_function, "random_state": np.random.get_state()})
+                species_pool = attach_species_pool(species_pool_path)
+                params = species_pool["params"]
+    
+        emit_event("prepare", "Construct plate", exp_id = assumptions["exp_id"])
+        np.random.seed(assumptions['seed']) 
+        plate = make_plate(assumptions,params)
+        
+        emit_event("prepare", "Add community function to plate", exp_id = assumptions["exp_id"])
+        plate = add_community_function(plate, assumptions, params, species_pool = species_pool)
     
     if not pd.isnull(assumptions["overwrite_plate"]) :
-        print("\nUpdating the initial plate composition by overwrite_plate")
+        emit_event("overwrite_plate", "Updating the initial plate composition by overwrite_plate", exp_id = assumptions["exp_id"])
         plate = overwrite_plate(plate, assumptions)
+    
+    if assumptions["precision"] != "float64":
+        plate = set_plate_precision(plate, assumptions["precision"])
+    if assumptions["sparse_density"] > 0:
+        plate = set_plate_sparsity(plate, assumptions["sparse_density"])
         
-    print("\nPrepare Protocol")
+    emit_event("prepare", "Prepare Protocol", exp_id = assumptions["exp_id"])
     #Extract Protocol from protocol database
     algorithms = make_algorithms(assumptions)
     params_algorithm = algorithms[algorithms['algorithm_name'] == assumptions['protocol']]
@@ -169,117 +390,449 @@ def prepare_experiment(assumptions):
     #Params_simulation by default  contains all assumptions not stored in params.
     params_simulation  =  dict((k, assumptions[k]) for k in assumptions.keys() if k not in params.keys())
     
+    if assumptions["profile"] != "none":
+        memory = estimate_peak_memory(assumptions)["total"]
+        emit_event("memory_estimate", "Estimated peak memory: %.0f MB" % (memory / 2**20), exp_id = assumptions["exp_id"], bytes = memory)
+    
     return params, params_simulation , params_algorithm, plate
 
-def simulate_community(params, params_simulation, params_algorithm, plate):
+def make_output_writers(params_simulation, plate, checkpoint = None):
     """
-    Simulate community dynamics by given experimental regimes
+    Open the writers of the composition, trajectory, and function outputs of one experiment
     
-    params = parameter passed from community-simulator
-    params_simulation = dictionary of parameters for running experiment
-    params_algorithm = dictionary of algorithms that determine the selection regime, migration regime, and community pheotypes
-    plate = Plate object specified by community-simulator
+    checkpoint = if given, continue the outputs from the positions saved in the checkpoint
     
-    Return:
-    community_composition = concatenated, melted panda dataframe of community and resource composition in each transfer
-    community_function = melted panda dataframe of community function
+    Return: dictionary of writers
     """
-    print("\nStarting " + params_simulation["exp_id"])
-    print(params_algorithm)
-    
-    # Test the community function
-    globals()[params_algorithm["community_phenotype"][0]](plate, params_simulation = params_simulation)
-    try:
-        community_function = globals()[params_algorithm["community_phenotype"][0]](plate, params_simulation = params_simulation) # Community phenotype
-    except:
-        print('\nCommunity phenotype test failed')
-        raise SystemExit
-
-    # Save the inocula composition
+    writers = dict()
     if params_simulation['save_composition']:
-        plate_data_list = list() # Plate composition
-        plate_data = reshape_plate_data(plate, params_simulation,transfer_loop_index=0)  # Initial state
-        plate_data_list.append(plate_data)
-        composition_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_composition.txt'   
-        
-    # Save the initial community function + richness + biomass
+        if params_simulation['composition_format'] == "parquet":
+            composition_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_composition.parquet'
+        else:
+            composition_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_composition.txt'   
+        position = None if checkpoint is None else checkpoint["composition_position"]
+        writers["composition"] = DataWriter(composition_filename, params_simulation['composition_format'], position = position) # Plate composition
+    if params_simulation['save_trajectory']:
+        trajectory_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_trajectory.npz'
+        if checkpoint is None:
+            writers["trajectory"] = TrajectoryWriter(trajectory_filename, plate.N.shape[0], plate.N.shape[1])
+        else:
+            writers["trajectory"] = checkpoint["trajectory_writer"]
     if params_simulation['save_function']:
-        community_function_list = list() # Plate composition
-        richness = np.sum(plate.N >= 1/params_simulation["scale"], axis = 0) # Richness
-        biomass = list(np.sum(plate.N, axis = 0)) # Biomass
-        function_data = reshape_function_data(params_simulation,community_function, richness, biomass, transfer_loop_index =0)
-        community_function_list.append(function_data)
         function_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_function.txt'   
+        position = None if checkpoint is None else checkpoint["function_position"]
+        writers["function"] = DataWriter(function_filename, position = position) # Community function
+    if params_simulation['output_queue_size'] > 0:
+        writers["background"] = BackgroundWriter(params_simulation['output_queue_size'])
+    return writers
 
-    print("\nStart propogation")
-    # Run simulation
-    for i in range(0, params_simulation["n_transfer"]):
-        # Algorithms used in this transfer
-        phenotype_algorithm = params_algorithm["community_phenotype"][i]
-        selection_algorithm = params_algorithm["selection_algorithm"][i]
-
-        # Propagation
-        plate.Propagate(params_simulation["n_propagation"])
+def write_outputs(writers, params_simulation, plate, community_function, transfer_loop_index):
+    """
+    Append the plate composition and community function of one transfer to the outputs, at the rates set by composition_lograte and function_lograte
+    
+    With a background writer, only a copy of the plate state is made here and the outputs are formatted and written in the background thread
+    """
+    if "background" in writers:
+        log_composition = transfer_loop_index % params_simulation['composition_lograte'] == 0 and ("composition" in writers or "trajectory" in writers)
+        log_function = transfer_loop_index % params_simulation['function_lograte'] == 0 and "function" in writers
+        if log_composition or log_function:
+            plate_state = PlateState(copy_frame(plate.N), copy_frame(plate.R) if log_composition else None, copy_frame(plate.R0) if log_composition else None)
+            writers["background"].submit(write_outputs_now, writers, params_simulation, plate_state, community_function.copy(), transfer_loop_index)
+    else:
+        write_outputs_now(writers, params_simulation, plate, community_function, transfer_loop_index)
 
-        # Measure Community phenotype
-        community_function = globals()[phenotype_algorithm](plate, params_simulation = params_simulation) # Community phenotype
-        
-        # Append the composition to a list
-        if params_simulation['save_composition'] and ((i+1) % params_simulation['composition_lograte'] == 0):
-            plate_data = reshape_plate_data(plate, params_simulation, transfer_loop_index=i+1)  # Initial state
-            plate_data_list.append(plate_data)
+def write_outputs_now(writers, params_simulation, plate, community_function, transfer_loop_index):
+    """
+    Append the outputs of one transfer in the calling thread (see write_outputs)
+    """
+    # Append the composition to the output file
+    if "composition" in writers and (transfer_loop_index % params_simulation['composition_lograte'] == 0):
+        plate_data = reshape_plate_data(plate, params_simulation, transfer_loop_index = transfer_loop_index)
+        writers["composition"].write(plate_data)
+    if "trajectory" in writers and (transfer_loop_index % params_simulation['composition_lograte'] == 0):
+        writers["trajectory"].write(plate.N, transfer_loop_index = transfer_loop_index)
 
-        if params_simulation['save_function'] and ((i+1) % params_simulation['function_lograte'] == 0):
+    # Append the community function + richness + biomass
+    if "function" in writers and (transfer_loop_index % params_simulation['function_lograte'] == 0):
+        if is_sparse_frame(plate.N):
+            richness, biomass = sparse_richness_biomass(plate.N, 1/params_simulation["scale"])
+        else:
             richness = np.sum(plate.N >= 1/params_simulation["scale"], axis = 0) # Richness
             biomass = list(np.sum(plate.N, axis = 0)) # Biomass
-            function_data = reshape_function_data(params_simulation, community_function, richness, biomass, transfer_loop_index =i+1)
-            community_function_list.append(function_data)
+        function_data = reshape_function_data(params_simulation, community_function, richness, biomass, transfer_loop_index = transfer_loop_index)
+        writers["function"].write(function_data)
 
-        #Store prior state before passaging (For coalescence)
-        setattr(plate, "prior_N", plate.N)
-        setattr(plate, "prior_R", plate.R)
-        setattr(plate, "prior_R0", plate.R0)
+def flush_output_writers(writers):
+    """
+    Wait until the background writer has written all the outputs submitted so far, e.g. before the positions of the writers are saved in a checkpoint
+    """
+    if "background" in writers:
+        writers["background"].flush()
+
+def close_output_writers(writers):
+    """
+    Save the outputs that are kept in memory until the end of the experiment
+    """
+    if "background" in writers:
+        writers["background"].close()
+    if "trajectory" in writers:
+        writers["trajectory"].close()
+
+def passage_plate(plate, params_simulation, community_function, selection_algorithm, profiler = None, transfer_loop_index = None):
+    """
+    Select the communities, passage them to a new plate, and perturb them at the end of one transfer
+    
+    profiler = StageProfiler that records the selection, passage, and perturbation stages of transfer_loop_index
+    
+    Return: the passaged plate
+    """
+    #Store prior state before passaging (For coalescence)
+    setattr(plate, "prior_N", plate.N)
+    setattr(plate, "prior_R", plate.R)
+    setattr(plate, "prior_R0", plate.R0)
 
-        # Passage and transfer matrix
-        transfer_matrix = globals()[selection_algorithm](community_function)
+    # Passage and transfer matrix
+    with profile_stage(profiler, "selection", transfer_loop_index):
+        selection_function = globals()[selection_algorithm]
+        if "rng" in inspect.signature(selection_function).parameters: # Selection with random controls
+            transfer_matrix = selection_function(community_function, rng = get_rng(plate, "selection"))
+        else:
+            transfer_matrix = selection_function(community_function)
+    with profile_stage(profiler, "passage", transfer_loop_index):
         if params_simulation['monoculture']:
             plate = passage_monoculture(plate, params_simulation["dilution"])
         else:
             plate.Passage(transfer_matrix * params_simulation["dilution"])
-        
-        # Perturbation
-        if params_simulation['directed_selection']:
-            if selection_algorithm == 'select_top': # In principle it can take select_top_x% but leave it as select_top for now
+    
+    # Perturbation
+    if params_simulation['directed_selection']:
+        if selection_algorithm == 'select_top': # In principle it can take select_top_x% but leave it as select_top for now
+            with profile_stage(profiler, "perturb", transfer_loop_index, plate = plate):
                 plate = perturb(plate, params_simulation, keep = np.where(community_function >= np.max(community_function))[0][0])
-            # if selection_algorithm != 'select_top' and (params_algorithm.iloc[i]["algorithm_name"] != 'simple_screening'):
-            #   plate = perturb(plate, params_simulation, keep = None)
-            elif selection_algorithm == "no_selection": 
-                pass
-        
-        print("Transfer " + str(i+1))
+        # if selection_algorithm != 'select_top' and (params_algorithm.iloc[i]["algorithm_name"] != 'simple_screening'):
+        #   plate = perturb(plate, params_simulation, keep = None)
+        elif selection_algorithm == "no_selection": 
+            pass
+    
+    return plate
 
-    if params_simulation['save_composition']:
-        pd.concat(plate_data_list).to_csv(composition_filename, index = False)
-    if params_simulation['save_function']:
-        pd.concat(community_function_list).to_csv(function_filename, index = False)
-    print("\n" + params_simulation["exp_id"] + " finished")
+def simulate_community(params, params_simulation, params_algorithm, plate, resume = False, assumptions_hash = None):
+    """
+    Simulate community dynamics by given experimental regimes
+    
+    params = parameter passed from community-simulator
+    params_simulation = dictionary of parameters for running experiment
+    params_algorithm = dictionary of algorithms that determine the selection regime, migration regime, and community pheotypes
+    plate = Plate object specified by community-simulator
+    resume = set True to continue from the latest checkpoint saved when checkpoint_interval > 0. Starts from transfer 0 if there is no checkpoint, or if it was saved with another assumptions_hash
+    assumptions_hash = experiment_hash() of the assumptions, stored in the checkpoints. Default is a hash of params and params_simulation
+    
+    Output:
+    community_composition = melted panda dataframe of community and resource composition, appended to the output file at each logged transfer
+    community_function = melted panda dataframe of community function, appended to the output file at each logged transfer
+    
+    Return: the plate after the last transfer
+    """
+    for snapshot in iterate_community(params, params_simulation, params_algorithm, plate, resume = resume, assumptions_hash = assumptions_hash):
+        plate = snapshot["plate"]
+    return plate
+
+def iterate_community(params, params_simulation, params_algorithm, plate, resume = False, start_transfer = 0, views = False, assumptions_hash = None):
+    """
+    Simulate community dynamics one transfer at a time. The outputs are written as in simulate_community()
+    
+    start_transfer = transfer the plate is at, e.g. the transfer of a snapshot whose forked plate (see fork_plate) is continued under another exp_id or protocol. The initial outputs are then not written
+    views = set True to add read-only views of N and R before the passage to the snapshots
+    
+    Yield: a snapshot dictionary after each transfer, with exp_id, transfer, community_function, richness, biomass, and the passaged plate.
+    Stopping the iteration early (break or close()) keeps the outputs written so far and the latest checkpoint
+    """
+    import random
+    emit_event("experiment_started", "Starting " + params_simulation["exp_id"], exp_id = params_simulation["exp_id"], protocol = params_simulation["protocol"], n_transfer = params_simulation["n_transfer"])
+    
+    # Load the latest checkpoint. A checkpoint saved with other assumptions or code is not resumed
+    checkpoint_filename = params_simulation['output_dir'] + params_simulation['exp_id'] + '_checkpoint.p'
+    if assumptions_hash is None and (resume or params_simulation['checkpoint_interval'] > 0):
+        assumptions_hash = experiment_hash(dict(params, **params_simulation))
+    checkpoint = load_checkpoint(checkpoint_filename) if resume else None
+    if checkpoint is not None and checkpoint.get("hash") != assumptions_hash:
+        emit_event("checkpoint", "The checkpoint was saved with other assumptions or code version. Start from transfer " + str(start_transfer), level = "warning", exp_id = params_simulation["exp_id"], transfer = start_transfer)
+        checkpoint = None
+    elif resume and checkpoint is None:
+        emit_event("checkpoint", "No checkpoint found. Start from transfer " + str(start_transfer), exp_id = params_simulation["exp_id"], transfer = start_transfer)
+    
+    if checkpoint is not None:
+        emit_event("checkpoint", "Resume from the checkpoint at transfer " + str(checkpoint["transfer"]), exp_id = params_simulation["exp_id"], transfer = checkpoint["transfer"])
+        plate = checkpoint["plate"]
+        start_transfer = checkpoint["transfer"]
+        writers = make_output_writers(params_simulation, plate, checkpoint = checkpoint)
+        np.random.set_state(checkpoint["np_random_state"])
+        random.setstate(checkpoint["random_state"])
+    elif start_transfer > 0:
+        writers = make_output_writers(params_simulation, plate)
+    else:
+        # Test the community function
+        globals()[params_algorithm["community_phenotype"][0]](plate, params_simulation = params_simulation)
+        try:
+            community_function = globals()[params_algorithm["community_phenotype"][0]](plate, params_simulation = params_simulation) # Community phenotype
+        except:
+            emit_event("phenotype_test_failed", 'Community phenotype test failed', level = "warning", exp_id = params_simulation["exp_id"])
+            raise SystemExit
+    
+        # Save the inocula composition and the initial community function + richness + biomass
+        writers = make_output_writers(params_simulation, plate)
+        write_outputs(writers, params_simulation, plate, community_function, transfer_loop_index = 0)
+
+    # Stage profiler
+    assert params_simulation['profile'] in ["none", "time", "allocations"], "profile must be none, time, or allocations"
+    profiler = None
+    if params_simulation['profile'] != "none":
+        profiler = StageProfiler(params_simulation['output_dir'] + params_simulation['exp_id'] + '_profile.txt', params_simulation['exp_id'], allocations = params_simulation['profile'] == "allocations")
+
+    emit_event("propagation_started", "Start propogation", exp_id = params_simulation["exp_id"])
+    # Run simulation
+    transfer_seconds = list()
+    finished = False
+    try:
+        for i in range(start_transfer, params_simulation["n_transfer"]):
+            transfer_start = time.perf_counter()
+            # Algorithms used in this transfer
+            phenotype_algorithm = params_algorithm["community_phenotype"][i]
+            selection_algorithm = params_algorithm["selection_algorithm"][i]
+
+            # Propagation
+            with profile_stage(profiler, "propagate", i+1, plate = plate):
+                plate.Propagate(params_simulation["n_propagation"])
+
+            # Measure Community phenotype
+            with profile_stage(profiler, "phenotype", i+1):
+                community_function = globals()[phenotype_algorithm](plate, params_simulation = params_simulation) # Community phenotype
+            
+            # Append the composition and function to the output files
+            with profile_stage(profiler, "output", i+1):
+                write_outputs(writers, params_simulation, plate, community_function, transfer_loop_index = i+1)
+            
+            # Snapshot of the grown plate
+            snapshot = {"exp_id": params_simulation["exp_id"], "transfer": i+1, "community_function": np.asarray(community_function)}
+            if is_sparse_frame(plate.N):
+                snapshot["richness"], snapshot["biomass"] = sparse_richness_biomass(plate.N, 1/params_simulation["scale"])
+            else:
+                plate_N = np.asarray(plate.N)
+                snapshot["richness"], snapshot["biomass"] = np.sum(plate_N >= 1/params_simulation["scale"], axis = 0), np.sum(plate_N, axis = 0)
+            if views:
+                plate_N, plate_R = np.asarray(plate.N), np.asarray(plate.R)
+                snapshot["N"], snapshot["R"] = plate_N.view(), plate_R.view()
+                snapshot["N"].flags.writeable = False
+                snapshot["R"].flags.writeable = False
+
+            # Passage, transfer matrix and perturbation
+            plate = passage_plate(plate, params_simulation, community_function, selection_algorithm, profiler = profiler, transfer_loop_index = i+1)
+            
+            # Time of this transfer and the estimated time to finish the remaining transfers
+            transfer_seconds.append(time.perf_counter() - transfer_start)
+            eta = np.mean(transfer_seconds) * (params_simulation["n_transfer"] - (i+1))
+            emit_event("transfer", "Transfer " + str(i+1), exp_id = params_simulation["exp_id"], transfer = i+1, n_transfer = params_simulation["n_transfer"], seconds = transfer_seconds[-1], eta = eta)
+            
+            # Checkpoint
+            if params_simulation['checkpoint_interval'] > 0 and ((i+1) % params_simulation['checkpoint_interval'] == 0) and (i+1) < params_simulation["n_transfer"]:
+                flush_output_writers(writers)
+                checkpoint = {"hash": assumptions_hash, "transfer": i+1, "plate": plate, "np_random_state": np.random.get_state(), "random_state": random.getstate()}
+                if "composition" in writers:
+                    checkpoint["composition_position"] = writers["composition"].position()
+                if "trajectory" in writers:
+                    checkpoint["trajectory_writer"] = writers["trajectory"]
+                if "function" in writers:
+                    checkpoint["function_position"] = writers["function"].position()
+                save_checkpoint(checkpoint_filename, checkpoint)
+            
+            snapshot["plate"] = plate
+            yield snapshot
+        finished = True
+    finally:
+        close_output_writers(writers)
+        if profiler is not None:
+            profiler.close()
+        if not finished:
+            emit_event("experiment_stopped", params_simulation["exp_id"] + " stopped", exp_id = params_simulation["exp_id"], transfer = start_transfer + len(transfer_seconds))
+    
+    # Remove the checkpoint of the finished experiment
+    if os.path.isfile(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    emit_event("experiment_finished", params_simulation["exp_id"] + " finished", exp_id = params_simulation["exp_id"], seconds = float(np.sum(transfer_seconds)))
+
+def run_experiment(input_file, row, resume = False, force = False):
+    """
+    Run one experiment (row) of the mapping file: make assumptions, prepare and simulate the experiment, and save the plate
+    
+    force = set True to run the experiment even if its results are already finished (see is_experiment_finished)
+    """
+    return run_assumptions(make_assumptions(input_file, row), resume = resume, force = force)
+
+def run_assumptions(assumptions, resume = False, force = False):
+    """
+    Prepare and simulate one experiment from its assumptions dictionary (see make_assumptions), and save the plate
+    
+    force = set True to run the experiment even if its results are already finished (see is_experiment_finished)
+    """
+    with open_event_logs([assumptions]):
+        if not force and is_experiment_finished(assumptions):
+            emit_event("experiment_skipped", assumptions["exp_id"] + " already finished. Skip", exp_id = assumptions["exp_id"])
+            return assumptions
+        assumptions_hash = start_experiment_manifest(assumptions)
+        params, params_simulation , params_algorithm, plate = prepare_experiment(assumptions)
+        plate = simulate_community(params = params, params_simulation = params_simulation, params_algorithm = params_algorithm, plate = plate, resume = resume, assumptions_hash = assumptions_hash)
+        save_plate(assumptions, plate)     #Save plate (will onlys save if assumptions specify that)
+        write_experiment_manifest(assumptions, assumptions_hash)
+    return assumptions
 
 def save_plate(assumptions, plate):
     """ 
     Save the initial plate in a pickle file. Like saving a frozen stock at -80C
+    
+    If stock_dir is specified, save the plate as plain arrays in the frozen stock library instead (see freeze_plate)
     """
-    if assumptions['save_plate']:
+    if assumptions['save_plate'] and not pd.isnull(assumptions.get('stock_dir', np.nan)):
+        freeze_plate(plate, assumptions['stock_dir'], assumptions['exp_id'])
+    elif assumptions['save_plate']:
         import dill as pickle
         with open(assumptions['output_dir'] + assumptions['exp_id'] + ".p", "wb") as f:
             pickle.dump(plate, f)
 
+# Columns that do not change the results of an experiment
+experiment_hash_independent_columns = ["checkpoint_interval", "species_pool_dir", "profile", "event_log", "output_queue_size"]
+
+def experiment_hash(assumptions):
+    """
+    Canonical hash of the resolved assumptions of one experiment and the code version
+    """
+    return make_hash([code_version(), dict((k, assumptions[k]) for k in assumptions.keys() if k not in experiment_hash_independent_columns)])
+
+def experiment_outputs(assumptions):
+    """
+    List the output files of one experiment
+    """
+    outputs = list()
+    if assumptions['save_composition'] and assumptions['composition_format'] == "parquet":
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + '_composition.parquet')
+    elif assumptions['save_composition']:
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + '_composition.txt')
+    if assumptions['save_trajectory']:
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + '_trajectory.npz')
+    if assumptions['save_function']:
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + '_function.txt')
+    if assumptions['profile'] != "none":
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + '_profile.txt')
+    if assumptions['save_plate'] and not pd.isnull(assumptions['stock_dir']):
+        outputs.append(os.path.join(assumptions['stock_dir'], assumptions['exp_id']))
+    elif assumptions['save_plate']:
+        outputs.append(assumptions['output_dir'] + assumptions['exp_id'] + ".p")
+    return outputs
+
+def experiment_manifest_filename(assumptions):
+    return assumptions['output_dir'] + assumptions['exp_id'] + '_manifest.json'
+
+def is_experiment_finished(assumptions):
+    """
+    Check if the experiment has finished with the same assumptions and code version: its manifest has the same hash and all its outputs exist
+    """
+    import json
+    manifest_filename = experiment_manifest_filename(assumptions)
+    if not os.path.isfile(manifest_filename):
+        return False
+    try:
+        with open(manifest_filename, "r") as f:
+            manifest = json.load(f)
+    except ValueError:
+        return False
+    return manifest.get("hash") == experiment_hash(assumptions) and all([os.path.exists(x) for x in experiment_outputs(assumptions)])
+
+def start_experiment_manifest(assumptions):
+    """
+    Remove the manifest of an earlier run before the outputs are overwritten
+    
+    Return: hash of the assumptions before they are updated by prepare_experiment()
+    """
+    if os.path.isfile(experiment_manifest_filename(assumptions)):
+        os.remove(experiment_manifest_filename(assumptions))
+    return experiment_hash(assumptions)
+
+def write_experiment_manifest(assumptions, assumptions_hash):
+    """
+    Write the manifest of a finished experiment, after all its outputs are saved
+    """
+    import json
+    import time
+    manifest_filename = experiment_manifest_filename(assumptions)
+    manifest = {"exp_id": assumptions["exp_id"], "hash": assumptions_hash, "code_version": code_version(), "outputs": experiment_outputs(assumptions), "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(manifest_filename + ".tmp", "w") as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+def read_trajectory(filename):
+    """
+    Read the sparse trajectory of species abundances saved by simulate_community() when save_trajectory = True
+    
+    Return: dictionary of transfer, offsets, well, species, abundance, and shape arrays
+    """
+    with np.load(filename) as trajectory:
+        return dict((k, trajectory[k]) for k in trajectory.files)
+
+def extract_trajectory(trajectory, transfers = None, sparse = False):
+    """
+    Extract the species by well abundance matrices of the given transfers from a trajectory
+    
+    trajectory = dictionary returned by read_trajectory()
+    transfers = list of transfers to extract, or slice(start, stop) to extract the logged transfers with start <= transfer < stop. Default is all logged transfers
+    sparse = set True to return scipy.sparse csc matrices instead of dense arrays
+    
+    A slice is located in the offset table with two binary searches, and the entries of its transfers are read as one contiguous block
+    
+    Return: 
+    dense: an array of shape (n_transfers, n_species, n_wells)
+    sparse: a list of n_transfers sparse matrices of shape (n_species, n_wells)
+    """
+    n_species, n_wells = trajectory["shape"]
+    offsets = trajectory["offsets"]
+    if transfers is None:
+        transfers = slice(None, None)
+    if isinstance(transfers, slice):
+        assert transfers.step is None, "A slice of transfers cannot have a step"
+        first = 0 if transfers.start is None else np.searchsorted(trajectory["transfer"], transfers.start, side = "left")
+        last = len(trajectory["transfer"]) if transfers.stop is None else np.searchsorted(trajectory["transfer"], transfers.stop, side = "left")
+        positions = range(first, max(first, last))
+    else:
+        transfer_position = dict((t, k) for k, t in enumerate(trajectory["transfer"]))
+        assert all(t in transfer_position for t in transfers), "Some transfers are not logged in the trajectory"
+        positions = [transfer_position[t] for t in transfers]
+    
+    if sparse:
+        from scipy.sparse import csc_matrix
+        matrices = list()
+        for k in positions:
+            entries = slice(offsets[k], offsets[k+1])
+            matrices.append(csc_matrix((trajectory["abundance"][entries], (trajectory["species"][entries], trajectory["well"][entries])), shape = (n_species, n_wells)))
+        return matrices
+    
+    N = np.zeros((len(positions), n_species, n_wells))
+    if isinstance(positions, range):
+        # Consecutive logged transfers are stored back to back
+        entries = slice(offsets[positions.start], offsets[positions.stop])
+        position = np.repeat(np.arange(len(positions)), np.diff(offsets[positions.start:positions.stop+1]))
+        N[position, trajectory["species"][entries], trajectory["well"][entries]] = trajectory["abundance"][entries]
+    else:
+        for i, k in enumerate(positions):
+            entries = slice(offsets[k], offsets[k+1])
+            N[i, trajectory["species"][entries], trajectory["well"][entries]] = trajectory["abundance"][entries]
+    return N
+
 def extract_species_function(assumptions):
     """
     Extract the per-capita species function from the community data
     """
-    np.random.seed(assumptions['seed']) 
-    params = MakeParams(assumptions) 
-    f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
+    with global_random_lock:
+        np.random.seed(assumptions['seed']) 
+        params = MakeParams(assumptions) 
+        f1_species_smooth, f1_species_rugged, f2_species_smooth, f2_species_rugged = draw_species_function(assumptions)
     S_tot = int(assumptions["sn"]) * int(assumptions["sf"]) + int(assumptions["Sgen"])
     
     if "additive" in assumptions["selected_function"]:
@@ -11,8 +11,9 @@ setup(name='ecoprospector',
       author_email=['chang-yu.chang@yale.edu'],
       license='MIT',
       packages = ['community_selection'],
-      scripts = ['commandline_tool/ecoprospector', 'commandline_tool/extract_species_function'],
+      scripts = ['commandline_tool/ecoprospector', 'commandline_tool/ecoprospector_batch', 'commandline_tool/extract_species_function'],
       include_package_data = True,
       package_data = {"": ["*.csv"]},
       install_requires=["community-simulator@ git+https://github.com/Emergent-Behaviors-in-Biology/community-simulator.git@master"],
+      extras_require={"parquet": ["pyarrow"]},
       zip_safe=False)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched propagation (propagate_plates): the batched dynamics must give the rates of the community-simulator dynamics in every well, and integrate_wells must reach the solution of a per-well integration
+"""
+import itertools
+import numpy as np
+import pytest
+
+n_species, n_resources, n_wells, n_blocks = 7, 5, 6, 3
+
+def make_params(random_state):
+    """
+    Parameters of one block, with vectors of species and resources parameters
+    """
+    D = random_state.rand(n_resources, n_resources)
+    return {"c": random_state.rand(n_species, n_resources), "D": D / D.sum(axis = 0), "g": random_state.rand(n_species) + 0.5, "m": random_state.rand(n_species) * 0.1,
+            "w": random_state.rand(n_resources) + 0.5, "l": random_state.rand(n_resources) * 0.8, "R0": random_state.rand(n_resources) * 5, "tau": random_state.rand(n_resources) + 0.5,
+            "r": random_state.rand(n_resources), "sigma_max": 2., "n": 2, "nreg": 3}
+
+@pytest.mark.parametrize("response, regulation, supply", list(itertools.product(["type I", "type II", "type III"], ["independent", "energy", "mass"], ["off", "external", "self-renewing"])))
+def test_batched_rates_match(response, regulation, supply):
+    pytest.importorskip("community_simulator")
+    from community_simulator.usertools import MakeConsumerDynamics, MakeResourceDynamics
+    from community_selection.A_experiment_functions import make_batched_dynamics
+    assumptions = {"response": response, "regulation": regulation, "supply": supply}
+    dNdt, dRdt = MakeConsumerDynamics(assumptions), MakeResourceDynamics(assumptions)
+    random_state = np.random.RandomState(1)
+    params_list = [make_params(random_state) for b in range(n_blocks)]
+    Y = random_state.rand(n_blocks, n_species + n_resources, n_wells) * 2
+    Y[0, 0, :] = 0 # Extinct species
+    for shared in [False, True]:
+        rates = make_batched_dynamics(params_list[:1] if shared else params_list, assumptions, n_species, n_resources)(Y)
+        for b in range(n_blocks):
+            params = params_list[0] if shared else params_list[b]
+            for k in range(n_wells):
+                N, R = Y[b, :n_species, k], Y[b, n_species:, k]
+                np.testing.assert_allclose(rates[b, :, k], np.concatenate([dNdt(N, R, params), dRdt(N, R, params)]), rtol = 1e-10, atol = 1e-12)
+
+def test_integrate_wells():
+    pytest.importorskip("community_simulator")
+    from scipy.integrate import odeint
+    from community_simulator.usertools import MakeConsumerDynamics, MakeResourceDynamics
+    from community_selection.A_experiment_functions import make_batched_dynamics, integrate_wells
+    assumptions = {"response": "type III", "regulation": "independent", "supply": "external"}
+    dNdt, dRdt = MakeConsumerDynamics(assumptions), MakeResourceDynamics(assumptions)
+    random_state = np.random.RandomState(2)
+    params_list = [make_params(random_state) for b in range(n_blocks)]
+    Y0 = random_state.rand(n_blocks, n_species + n_resources, n_wells) * 2
+    Y = integrate_wells(make_batched_dynamics(params_list, assumptions, n_species, n_resources), Y0, 5.)
+    for b in range(n_blocks):
+        dydt = lambda y, t: np.concatenate([dNdt(y[:n_species], y[n_species:], params_list[b]), dRdt(y[:n_species], y[n_species:], params_list[b])])
+        for k in range(n_wells):
+            np.testing.assert_allclose(Y[b, :, k], odeint(dydt, Y0[b, :, k], [0, 5.], rtol = 1e-11, atol = 1e-12)[-1], rtol = 1e-4, atol = 1e-3)
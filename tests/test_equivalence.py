@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Negative controls of the statistical equivalence harness (benchmarks/equivalence.py): candidates with a known bias must fail
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo_dir, "benchmarks"))
+from equivalence import check_equivalence, compare_outputs
+from simulation import make_scenarios, write_mapping_file
+
+def make_outputs(seeds, n_wells, sd, random_state):
+    """
+    Synthetic function outputs of one transfer, with the wells of each seed drawn around a seed effect
+    """
+    df_list = list()
+    for seed in seeds:
+        seed_effect = random_state.normal(10, 1)
+        df_list.append(pd.DataFrame({"seed": seed, "Transfer": 0, "Well": ["W" + str(k) for k in range(n_wells)],
+                                     "Richness": 10, "Biomass": seed_effect + random_state.normal(0, sd, size = n_wells), "CommunityPhenotype": 1.0}))
+    return pd.concat(df_list, ignore_index = True)
+
+def test_spread_change_is_rejected():
+    random_state = np.random.RandomState(1)
+    df_reference = make_outputs(range(20), 24, 1, random_state)
+    assert all(compare_outputs(df_reference, make_outputs(range(20), 24, 1, random_state)).Pass)
+    report = compare_outputs(df_reference, make_outputs(range(20), 24, 3, random_state))
+    assert report.set_index("Statistic").loc["mean", "Pass"].all() # Same mean
+    assert not report.set_index("Statistic").loc["std", "Pass"].all()
+
+@pytest.fixture(scope = "module")
+def mapping_file():
+    pytest.importorskip("community_simulator")
+    with tempfile.TemporaryDirectory() as mapping_dir:
+        yield write_mapping_file(make_scenarios()[:1], mapping_dir + "/")
+
+def test_reference_is_equivalent(mapping_file):
+    report = check_equivalence(mapping_file, 0, range(1, 6))
+    assert all(report.Pass)
+
+def test_biased_passage_is_rejected(mapping_file):
+    from community_selection import Metacommunity
+    reference_passage = Metacommunity.Passage
+    def dilute_passage(self, f, *args, **kwargs):
+        # Transfer ten times more cells than the transfer matrix asks for
+        return reference_passage(self, f * 10, *args, **kwargs)
+    report = check_equivalence(mapping_file, 0, range(1, 21), candidate_patches = {"community_selection.Metacommunity.Passage": dilute_passage})
+    assert not all(report[report.Metric == "Biomass"].Pass)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression test of the consumer (c) and metabolic (D) matrices drawn by new_MakeMatrices for a fixed seed
+
+The pinned sums were drawn after the family blocks of c were first filled (earlier versions left them at 0, or at c0/M in the Binary modes, and only sampled the generalists)
+"""
+import io
+import contextlib
+import numpy as np
+import pytest
+
+base_assumptions = {"SA": [3, 3, 3], "MA": [2, 2, 2], "Sgen": 2, "muc": 2, "sigc": 3, "q": 0.5, "c0": 0.1, "c1": 1., "b": 1,
+                    "fs": 0.45, "fw": 0.45, "sparsity": 0.2, "sampling_D": "default"}
+
+# Row sums of c, column sums of c, and row sums of D for seed 1
+pinned_sums = {
+    ("Gaussian", "default"): [
+        [3.99385999066, -0.683582236471, -1.91493844749, 1.97477342653, -1.12253524503, 3.07829611452, 3.33118997502, 3.48220195274, 0.465389356571, 6.06436844933, 3.37937336099],
+        [6.05230960921, 1.02335820946, 8.82174615654, 2.62910130022, 2.14178390474, 1.3800975172],
+        [0.613294312321, 0.467165570172, 0.489794023994, 0.823620552836, 1.51102938185, 2.09509615883]],
+    ("Binary", "default"): [
+        [1.1, 3.1, 2.1, 2.1, 2.1, 1.1, 2.1, 3.1, 2.1, 2.1, 2.1],
+        [6.18333333333, 3.18333333333, 3.18333333333, 2.18333333333, 6.18333333333, 2.18333333333],
+        [0.678181879654, 1.02531662416, 0.532860110889, 0.496388386095, 1.84952302054, 1.41772997866]],
+    ("Gamma", "default"): [
+        [0.139935556696, 6.39346061115e-05, 1.4412802044, 0.00141705670187, 5.53777681731, 1.82672056102, 2.47378042026, 2.6528109733, 2.78565255111, 1.93760691759, 0.592466842662],
+        [6.29988268355, 0.354940874316, 2.46861343118, 0.165551694391, 7.70300398674, 2.39751916548],
+        [0.93085265064, 0.312531241466, 1.32636739096, 0.752205391053, 1.71985495934, 0.958188366544]],
+    ("Uniform", "default"): [
+        [1.75173712269, 0.93588625906, 1.3195031312, 1.62893870232, 2.38415995412, 2.06111246178, 2.0086538308, 1.01775461585, 2.41641117013, 1.55484578172, 1.21081970876],
+        [2.27267250447, 3.94070218214, 2.86093591486, 3.63976242571, 1.7219541982, 3.85379551303],
+        [0.678181879654, 1.02531662416, 0.532860110889, 0.496388386095, 1.84952302054, 1.41772997866]],
+    ("Binary_Gamma", "default"): [
+        [1.76267250302, 2.54593056295, 0.166748927277, 4.0722150907, 0.319904966659, 0.0828083635407, 1.43978212698, 9.93790840087, 1.51350701423, 0.784525776278, 0.164523806309],
+        [2.11227804209, 0.800495549322, 5.82015548846, 1.18695341141, 2.81321104794, 10.0574339996],
+        [0.625451135624, 0.354261778822, 0.310696960965, 1.05127599984, 1.70318222683, 1.95513189792]],
+    ("Binary_Gamma", "fermenter_respirator"): [
+        [19.8125046896, 9.45832359293, 3.60607288465, 0.207443065537, 0.922179719008, 0.170881406892, 2.1817980278, 0.0364203745037],
+        [1.15786847156, 5.78067319281, 9.86397127695, 0.138446857604, 19.3252581503, 0.12940581169],
+        [0.405189991885, 0.61454581159, 0.847880284358, 1.66228765474, 0.652951702069, 1.81714455535]],
+}
+
+def make_assumptions(sampling, sampling_D):
+    assumptions = dict(base_assumptions, sampling = sampling, sampling_D = sampling_D)
+    if sampling_D == "fermenter_respirator":
+        assumptions.update({"SA": [3, 3], "MA": [3, 3], "fss": 0.3, "fsa": 0.3, "fas": 0.2, "faa": 0.4})
+    return assumptions
+
+@pytest.mark.parametrize("sampling, sampling_D", list(pinned_sums.keys()))
+def test_matrices_are_pinned(sampling, sampling_D):
+    pytest.importorskip("community_simulator")
+    from community_selection.A_experiment_functions import new_MakeMatrices
+    with contextlib.redirect_stdout(io.StringIO()):
+        np.random.seed(1)
+        c, D = new_MakeMatrices(make_assumptions(sampling, sampling_D))
+    c_row_sums, c_column_sums, D_row_sums = pinned_sums[(sampling, sampling_D)]
+    np.testing.assert_allclose(c.values.sum(axis = 1), c_row_sums, rtol = 1e-10, atol = 1e-12)
+    np.testing.assert_allclose(c.values.sum(axis = 0), c_column_sums, rtol = 1e-10, atol = 1e-12)
+    np.testing.assert_allclose(D.values.sum(axis = 1), D_row_sums, rtol = 1e-10, atol = 1e-12)
+
+@pytest.mark.parametrize("sampling", ["Gaussian", "Gamma", "Uniform"])
+def test_family_blocks_are_sampled(sampling):
+    pytest.importorskip("community_simulator")
+    from community_selection.A_experiment_functions import new_MakeMatrices
+    with contextlib.redirect_stdout(io.StringIO()):
+        np.random.seed(1)
+        c, D = new_MakeMatrices(make_assumptions(sampling, "default"))
+    assert np.all(c.loc["F0"].values != 0)